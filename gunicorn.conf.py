@@ -7,11 +7,19 @@ bind = "0.0.0.0:{}".format(int(os.environ.get("PORT", 5000)))
 backlog = 2048
 
 # Worker processes
-# Use 1 worker for bot to avoid multiple bot instances
-# Bots should only have one instance running
-workers = 1
-worker_class = "sync"
+# WEB_SERVER_MODE=async serves main:create_async_app with aiohttp, running the bot on the same loop
+web_server_mode = os.environ.get("WEB_SERVER_MODE", "flask")
+# Bots should only have one instance running. With several sync workers (WEB_CONCURRENCY), the workers
+# elect a leader through a file lock: only the leader runs the bot, the others forward emails to it.
+# The async worker runs the bot inside the app, so it stays at one worker.
+workers = 1 if web_server_mode == "async" else int(os.environ.get("WEB_CONCURRENCY", 1))
+# PROCESS_ROLE=ingest serves /email-webhook into the durable queue only; run the bot with PROCESS_ROLE=deliver python main.py
+process_role = os.environ.get("PROCESS_ROLE", "all")
+worker_class = "aiohttp.GunicornWebWorker" if web_server_mode == "async" else "sync"
 worker_connections = 1000
+# Import main.py once in the master before forking, so a new or recycled worker serves as soon as it forks
+# (the bot is still started per worker in post_worker_init)
+preload_app = True
 timeout = 120  # Increase timeout to 120 seconds (default is 30)
 keepalive = 5
 
@@ -40,9 +48,38 @@ def post_worker_init(worker):
     Called just after a worker has been processed.
     Start the Discord bot thread here to ensure it runs in the worker process.
     """
-    worker.log.info(f"Worker initialized (PID: {os.getpid()}). Starting Discord bot...")
+    if web_server_mode == "async":
+        # The aiohttp app starts the bot on its own loop (see create_async_app)
+        return
+    if process_role == "ingest":
+        worker.log.info(f"Worker initialized (PID: {os.getpid()}). Ingest only, not starting the Discord bot")
+        return
     try:
-        from main import start_bot_thread
-        start_bot_thread()
+        if workers > 1:
+            worker.log.info(f"Worker initialized (PID: {os.getpid()}). Joining bot leader election...")
+            from main import start_bot_leader_election
+            start_bot_leader_election()
+        else:
+            worker.log.info(f"Worker initialized (PID: {os.getpid()}). Starting Discord bot...")
+            from main import start_bot_thread
+            start_bot_thread()
     except Exception as e:
         worker.log.error(f"Failed to start Discord bot in worker: {e}")
+
+def worker_exit(server, worker):
+    """
+    Called just after a worker has exited.
+    Close the Discord client and its pooled HTTP connections cleanly.
+    """
+    if web_server_mode == "async" or process_role == "ingest":
+        return
+    worker.log.info(f"Worker exiting (PID: {os.getpid()}). Stopping Discord bot...")
+    try:
+        if workers > 1:
+            from main import stop_bot_leader
+            stop_bot_leader()
+        else:
+            from main import stop_bot
+            stop_bot()
+    except Exception as e:
+        worker.log.error(f"Failed to stop Discord bot in worker: {e}")
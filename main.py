@@ -1,18 +1,293 @@
+import os
+import sys
+import time
+import json
+import socketserver
+import threading
+
+process_started_at = time.monotonic()
+
+# Importing discord.py, Flask and aiohttp below takes most of a second. When this process is the server
+# (python main.py, or the gunicorn master preloading it), answer /livez on PORT from a bare socket server meanwhile
+early_livez = os.getenv("EARLY_LIVEZ", "true").lower() == "true"  # "false" leaves PORT unbound until the app serves
+
+class EarlyLivezHandler(socketserver.StreamRequestHandler):
+    """Minimal HTTP/1.0 responder: /livez and /health answer 200, everything else 503 until the app is imported"""
+    def handle(self):
+        request_line = self.rfile.readline(8192).split()
+        while self.rfile.readline(8192).strip():
+            pass  # Skip the headers
+        path = request_line[1].split(b"?")[0] if len(request_line) > 1 else b""
+        if path in (b"/livez", b"/health"):
+            status = "200 OK"
+            body = {"status": "ok", "pid": os.getpid(), "uptime_seconds": round(time.monotonic() - process_started_at, 3)}
+        else:
+            status, body = "503 Service Unavailable", {"status": "starting"}
+        payload = json.dumps(body).encode()
+        head = f"HTTP/1.0 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(payload)}\r\nConnection: close\r\n\r\n"
+        self.wfile.write(head.encode() + (b"" if request_line[:1] == [b"HEAD"] else payload))
+
+def start_early_livez(port):
+    """Serve EarlyLivezHandler on port from a daemon thread; None if the port cannot be bound"""
+    server = socketserver.ThreadingTCPServer(("0.0.0.0", port), EarlyLivezHandler, bind_and_activate=False)
+    server.allow_reuse_address = True
+    server.daemon_threads = True
+    try:
+        server.server_bind()
+        server.server_activate()
+    except OSError:
+        server.server_close()  # Already served (e.g. a gunicorn worker importing without preload_app)
+        return None
+    threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True, name="EarlyLivez").start()
+    return server
+
+def stop_early_livez():
+    """Free PORT for the real app server"""
+    global early_livez_server
+    if early_livez_server is not None:
+        early_livez_server.shutdown()
+        early_livez_server.server_close()
+        early_livez_server = None
+
+early_livez_server = None
+if early_livez and (__name__ == "__main__" or "gunicorn" in sys.modules):
+    early_livez_server = start_early_livez(int(os.getenv("PORT", 8080 if __name__ == "__main__" else 5000)))
+
 import discord
 from discord.ext import commands
-import os
 import asyncio
-import threading
+import logging
+import logging.handlers
+import queue
+import atexit
+import fcntl
+import signal
+import socket
 from dotenv import load_dotenv
 from flask import Flask, request
 import aiohttp
-import json
+import importlib.util
+import heapq
+import html
+import itertools
 import re
-from datetime import datetime
+import random
+import sqlite3
+import tempfile
+import traceback
+import yarl
+from collections import OrderedDict, deque, namedtuple
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+def lazy_import(name):
+    """Return the module, but only execute it on first attribute access"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+web = lazy_import("aiohttp.web")  # Only WEB_SERVER_MODE=async needs the aiohttp server
 
 load_dotenv()
 token = os.getenv("token")
 
+# Logging: leveled per-subsystem loggers, written to stdout by a background thread
+log_level = os.getenv("LOG_LEVEL", "INFO").upper()
+log_format = os.getenv("LOG_FORMAT", "json")  # "json" (one object per line) or "text"
+log_queue_size = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # Records waiting to be written; extras are dropped
+
+class JsonLogFormatter(logging.Formatter):
+    """Format a record as one JSON object per line"""
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "func": record.funcName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Hand records to the log thread unformatted; drop them rather than block when the queue is full"""
+    dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            NonBlockingQueueHandler.dropped += 1
+
+def setup_logging():
+    """Route the ytt.* loggers (and discord.py warnings) through a queue to stdout"""
+    root = logging.getLogger("ytt")
+    if root.handlers:
+        return
+    log_queue = queue.Queue(maxsize=log_queue_size)
+    stream = logging.StreamHandler(sys.stdout)
+    if log_format == "json":
+        stream.setFormatter(JsonLogFormatter())
+    else:
+        stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s.%(funcName)s: %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, stream)
+    listener.start()
+    atexit.register(listener.stop)
+    handler = NonBlockingQueueHandler(log_queue)
+    # Threads don't survive fork (gunicorn preload_app): give each child its own queue and writer thread
+    os.register_at_fork(after_in_child=lambda: after_fork_in_child(handler, stream))
+    root.setLevel(log_level)
+    root.addHandler(handler)
+    root.propagate = False
+    discord_logger = logging.getLogger("discord")
+    discord_logger.setLevel(logging.WARNING)
+    discord_logger.addHandler(handler)
+
+def after_fork_in_child(handler, stream):
+    """Start a forked worker's uptime from the fork (not the master's import) and give it its own log thread"""
+    global process_started_at
+    process_started_at = time.monotonic()
+    restart_log_listener(handler, stream)
+
+def restart_log_listener(handler, stream):
+    """Point the queue handler at a fresh queue drained by a new listener thread"""
+    handler.queue = queue.Queue(maxsize=log_queue_size)
+    listener = logging.handlers.QueueListener(handler.queue, stream)
+    listener.start()
+    atexit.register(listener.stop)
+
+setup_logging()
+bot_log = logging.getLogger("ytt.bot")  # Startup, gateway and commands
+mail_log = logging.getLogger("ytt.mail")  # Discord -> email (Maileroo sends, queue, outbox)
+inbound_log = logging.getLogger("ytt.inbound")  # Email -> Discord webhook endpoint
+delivery_log = logging.getLogger("ytt.delivery")  # Channel resolution and Discord delivery
+
+# Metrics, exposed in Prometheus text format on /metrics
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in labels.values())
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}"
+
+class Counter:
+    """Counter with optional labels"""
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            values = list(self.values.items())
+        for key, value in values:
+            lines.append(f"{self.name}{format_labels(dict(zip(self.labelnames, key)))} {value}")
+        return lines
+
+class Gauge:
+    """Gauge that is either set/incremented directly or read from a function at scrape time"""
+    def __init__(self, name, help_text, func=None):
+        self.name = name
+        self.help_text = help_text
+        self.func = func
+        self.value = 0
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def render(self):
+        value = self.func() if self.func else self.value
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        if value is not None:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+class Histogram:
+    """Histogram of durations in seconds"""
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last slot is +Inf
+        self.sum = 0.0
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def observe(self, value):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def render(self):
+        with self.lock:
+            counts = self.counts[:]
+            total_sum = self.sum
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        cumulative += counts[-1]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{self.name}_sum {total_sum}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+METRICS = []
+inbound_delivery_seconds = Histogram("ytt_inbound_delivery_seconds", "Time from email webhook receipt to Discord delivery")
+inbound_emails_total = Counter("ytt_inbound_emails_total", "Inbound emails by delivery result", ("result",))
+maileroo_send_seconds = Histogram("ytt_maileroo_send_seconds", "Maileroo send request latency")
+maileroo_requests_total = Counter("ytt_maileroo_requests_total", "Maileroo send requests by HTTP status (or error)", ("status",))
+email_queue_deferred_total = Counter("ytt_email_queue_deferred_total", "Outbound emails left to the outbox retrier by a full send queue, by which one",
+                                     ("email",))
+channel_resolution_total = Counter("ytt_channel_resolution_total", "Inbound channel lookups by outcome", ("outcome",))
+discord_sends_total = Counter("ytt_discord_sends_total", "Inbound emails delivered to Discord by send path", ("path",))
+inflight_discord_sends = Gauge("ytt_inflight_discord_sends", "Scheduled Discord sends that have not finished")
+inbound_dispatch_lanes = Gauge("ytt_inbound_dispatch_lanes", "Discord channels with inbound emails queued or being delivered",
+                               func=lambda: len(inbound_dispatcher.lanes) if inbound_dispatcher else None)
+bot_loop_lag_seconds = Histogram("ytt_bot_loop_lag_seconds", "How late the bot loop ran its lag monitor's timer")
+bot_loop_stalls_total = Counter("ytt_bot_loop_stalls_total", "Times a callback blocked the bot loop past LOOP_STALL_THRESHOLD")
+maileroo_send_rate = Gauge("ytt_maileroo_send_rate", "Current global Maileroo send rate limit (lowered after 429s)",
+                           func=lambda: maileroo_bucket.rate or None)
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
 # Maileroo API configuration
 maileroo_api_key = os.getenv("MAILEROO_API_KEY")
 maileroo_from_email = os.getenv("MAILEROO_FROM_EMAIL")
@@ -20,30 +295,193 @@ maileroo_from_name = os.getenv("MAILEROO_FROM_NAME", "Discord Bot")
 maileroo_to_email = os.getenv("MAILEROO_TO_EMAIL")
 maileroo_api_url = os.getenv("MAILEROO_API_URL", "https://smtp.maileroo.com/api/v2/emails")
 
+# Shared HTTP client pool for Maileroo sends (connections are kept alive between sends)
+http_pool_size = int(os.getenv("HTTP_POOL_SIZE", "20"))  # Max open connections overall (0 = unlimited)
+http_pool_per_host = int(os.getenv("HTTP_POOL_PER_HOST", "10"))  # Max open connections per host (0 = unlimited)
+http_keepalive_timeout = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "30"))  # Seconds an idle connection is kept open
+
+# Outbound email queue (on_message enqueues, sender workers drain it)
+email_queue_size = int(os.getenv("EMAIL_QUEUE_SIZE", "1000"))  # Max emails waiting to be sent
+email_queue_workers = int(os.getenv("EMAIL_QUEUE_WORKERS", "4"))  # Number of concurrent sender workers
+email_queue_drop_policy = os.getenv("EMAIL_QUEUE_DROP_POLICY", "drop_oldest")  # "drop_oldest" or "drop_newest" when full
+
+# Maileroo send rate: one token bucket shared by all sends, and one per Discord channel so a busy channel cannot take them all
+maileroo_rate = float(os.getenv("MAILEROO_RATE", "10"))  # Sends per second overall (0 = unlimited)
+maileroo_burst = int(os.getenv("MAILEROO_BURST", "20"))  # Sends allowed back to back before MAILEROO_RATE applies
+maileroo_channel_rate = float(os.getenv("MAILEROO_CHANNEL_RATE", "1"))  # Sends per second per channel (0 = unlimited)
+maileroo_channel_burst = int(os.getenv("MAILEROO_CHANNEL_BURST", "10"))  # Sends per channel allowed back to back
+maileroo_retry_after = float(os.getenv("MAILEROO_RETRY_AFTER", "5"))  # Seconds to pause after a 429 without a usable Retry-After
+maileroo_retry_after_max = float(os.getenv("MAILEROO_RETRY_AFTER_MAX", "600"))  # Longest pause a Retry-After can ask for
+
+# Priority lane: messages in these channels, or from members with these roles, are emailed before everything else
+priority_channel_ids = {int(i) for i in os.getenv("PRIORITY_CHANNELS", "").split(",") if i.strip()}  # Comma-separated channel IDs
+priority_role_ids = {int(i) for i in os.getenv("PRIORITY_ROLES", "").split(",") if i.strip()}  # Comma-separated role IDs
+
+# Durable SQLite outbox for outbound emails (retried with backoff until Maileroo accepts them)
+outbox_path = os.getenv("OUTBOX_PATH", "outbox.db")
+outbox_retry_interval = float(os.getenv("OUTBOX_RETRY_INTERVAL", "5"))  # Seconds between retrier passes
+outbox_backoff_base = float(os.getenv("OUTBOX_BACKOFF_BASE", "2"))  # First retry delay in seconds
+outbox_backoff_max = float(os.getenv("OUTBOX_BACKOFF_MAX", "600"))  # Longest retry delay in seconds
+outbox_max_attempts = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "0"))  # Give up after this many attempts (0 = never)
+
+# Inbound channel lookup: subjects that matched no channel are remembered for a while
+channel_miss_cache_size = int(os.getenv("CHANNEL_MISS_CACHE_SIZE", "1024"))  # Max subjects remembered
+channel_miss_cache_ttl = float(os.getenv("CHANNEL_MISS_CACHE_TTL", "300"))  # Seconds a miss is remembered
+
+# Reply index: outbound Message-ID -> mirrored Discord message, so email replies route by In-Reply-To/References
+reply_index_size = int(os.getenv("REPLY_INDEX_SIZE", "100000"))  # Outbound emails remembered; the oldest are evicted first
+reply_mode = os.getenv("REPLY_MODE", "thread")  # "thread" (webhook post in a thread under the original message) or "reply" (bot reply to it)
+
+# Cache of "sophia" webhooks per channel, persisted so restarts skip the webhook listing
+webhook_cache_path = os.getenv("WEBHOOK_CACHE_PATH", "webhooks.json")
+
+# HTTP server: "flask" (Flask in a gunicorn/dev thread, bot in its own thread) or "async" (aiohttp on the bot loop)
+web_server_mode = os.getenv("WEB_SERVER_MODE", "flask")
+
+# Inbound attachments: downloaded from Maileroo and re-uploaded with the Discord message
+attachment_max_bytes = int(os.getenv("ATTACHMENT_MAX_BYTES", str(10 * 1024 * 1024)))  # Per file
+attachment_max_total_bytes = int(os.getenv("ATTACHMENT_MAX_TOTAL_BYTES", str(10 * 1024 * 1024)))  # Per email (Discord's per-message upload limit without boosts)
+attachment_spool_bytes = int(os.getenv("ATTACHMENT_SPOOL_BYTES", str(512 * 1024)))  # Held in memory up to this, then spilled to a temp file
+attachment_download_timeout = float(os.getenv("ATTACHMENT_DOWNLOAD_TIMEOUT", "60"))  # Seconds per file
+# /email-webhook is unauthenticated, so attachment URLs are only fetched over https from Maileroo (and their subdomains)
+attachment_url_hosts = [h.strip().lower() for h in os.getenv("ATTACHMENT_URL_HOSTS", "maileroo.com,maileroo.net").split(",") if h.strip()]
+# Exact hosts also fetched over plain http, for a local stub file server in testing (empty in production)
+attachment_http_hosts = [h.strip().lower() for h in os.getenv("ATTACHMENT_HTTP_HOSTS", "").split(",") if h.strip()]
+
+# Inbound HTML-only emails are converted to text, stopping once this much text has been produced
+html_body_max_chars = int(os.getenv("HTML_BODY_MAX_CHARS", "10000"))
+
+# Inbound dedupe: Maileroo retries slow webhooks, so remember message IDs we've already accepted
+inbound_dedupe_size = int(os.getenv("INBOUND_DEDUPE_SIZE", "10000"))  # Max message IDs remembered
+inbound_dedupe_ttl = float(os.getenv("INBOUND_DEDUPE_TTL", "86400"))  # Seconds a message ID is remembered
+# Optional SQLite file so the index survives restarts and is shared by processes; on by default in the split deployment,
+# where a retry can reach another ingest process after the first copy was delivered and left the queue
+inbound_dedupe_path = os.getenv("INBOUND_DEDUPE_PATH", "" if os.getenv("PROCESS_ROLE", "all") == "all" else "inbound-dedupe.db")
+
+# Snipe store: recent deleted messages per channel
+snipe_history = int(os.getenv("SNIPE_HISTORY", "5"))  # Deleted messages kept per channel
+snipe_max_entries = int(os.getenv("SNIPE_MAX_ENTRIES", "20000"))  # Deleted messages kept across all channels
+snipe_ttl = float(os.getenv("SNIPE_TTL", "86400"))  # Seconds a deleted message can be sniped
+
+# Purge command
+purge_single_delete_delay = float(os.getenv("PURGE_SINGLE_DELETE_DELAY", "1.0"))  # Seconds between deletes of messages too old to bulk delete
+purge_progress_interval = float(os.getenv("PURGE_PROGRESS_INTERVAL", "2.0"))  # Seconds between status message edits
+
+# What /email-webhook does before the bot is ready: "wait" (block up to BOT_READY_TIMEOUT) or "buffer" (accept and replay on ready)
+webhook_not_ready_mode = os.getenv("WEBHOOK_NOT_READY_MODE", "wait")
+bot_ready_timeout = float(os.getenv("BOT_READY_TIMEOUT", "15"))  # Seconds to wait in "wait" mode
+pending_emails_max = int(os.getenv("PENDING_EMAILS_MAX", "100"))  # Max inbound emails held in "buffer" mode
+
+# Multi-worker gunicorn: workers elect one bot leader through a file lock, the others forward inbound emails to it
+bot_leader_lock_path = os.getenv("BOT_LEADER_LOCK_PATH", "bot-leader.lock")
+bot_leader_socket_path = os.getenv("BOT_LEADER_SOCKET_PATH", "bot-leader.sock")  # Unix socket the leader listens on
+bot_leader_retry_interval = float(os.getenv("BOT_LEADER_RETRY_INTERVAL", "1"))  # Seconds between attempts to take over leadership
+
+# Optional split deployment: PROCESS_ROLE "all" (default), "ingest" (HTTP only) or "deliver" (bot only)
+process_role = os.getenv("PROCESS_ROLE", "all")
+# Durable SQLite queue between ingestion and delivery (off by default when both run in one process)
+inbound_queue_path = os.getenv("INBOUND_QUEUE_PATH", "" if process_role == "all" else "inbound-queue.db")
+inbound_queue_concurrency = int(os.getenv("INBOUND_QUEUE_CONCURRENCY", "20"))  # Queued emails delivered at once
+inbound_queue_poll_interval = float(os.getenv("INBOUND_QUEUE_POLL_INTERVAL", "0.1"))  # Seconds between polls of an empty queue
+inbound_queue_lease = float(os.getenv("INBOUND_QUEUE_LEASE", "300"))  # Seconds before a claimed email is offered to another consumer
+inbound_queue_lag_warn = float(os.getenv("INBOUND_QUEUE_LAG_WARN", "60"))  # Warn when the oldest queued email is this many seconds old
+inbound_queue_retry_base = float(os.getenv("INBOUND_QUEUE_RETRY_BASE", "5"))  # Seconds before a failed delivery is retried, doubling each attempt
+inbound_queue_retry_max = float(os.getenv("INBOUND_QUEUE_RETRY_MAX", "300"))  # Longest retry delay in seconds
+inbound_queue_max_attempts = int(os.getenv("INBOUND_QUEUE_MAX_ATTEMPTS", "10"))  # Give up on an email after this many failed deliveries (0 = never)
+
+# Inbound delivery: one ordered lane per Discord channel; lanes deliver side by side up to a global cap
+inbound_dispatch_concurrency = int(os.getenv("INBOUND_DISPATCH_CONCURRENCY", "20"))  # Channels delivering at once
+discord_webhook_rate = float(os.getenv("DISCORD_WEBHOOK_RATE", "2.5"))  # Posts per second per channel (Discord allows a webhook 5 per 2s)
+discord_webhook_burst = int(os.getenv("DISCORD_WEBHOOK_BURST", "5"))
+discord_global_rate = float(os.getenv("DISCORD_GLOBAL_RATE", "45"))  # Posts per second overall, under Discord's global limit of 50 requests/s
+discord_global_burst = int(os.getenv("DISCORD_GLOBAL_BURST", "10"))
+
+# Bot loop watchdog: samples loop lag and captures the bot thread's stack when a callback blocks the loop
+loop_monitor_interval = float(os.getenv("LOOP_MONITOR_INTERVAL", "0.25"))  # Seconds between lag samples
+loop_stall_threshold = float(os.getenv("LOOP_STALL_THRESHOLD", "0.5"))  # Seconds the loop may be blocked before it is reported
+loop_stall_reports = int(os.getenv("LOOP_STALL_REPORTS", "20"))  # Recent stall reports kept for /debug/loop
+loop_debug = os.getenv("LOOP_DEBUG", "false").lower() in ("1", "true", "yes")  # asyncio debug mode: also log each slow callback by name (costly)
+
+# /readyz fails while the bot loop takes longer than this many seconds to run a queued callback
+readyz_max_loop_lag = float(os.getenv("READYZ_MAX_LOOP_LAG", "1.0"))
+
+# Optional per-channel digest mode (coalesce several Discord messages into one email)
+email_digest_enabled = os.getenv("EMAIL_DIGEST_ENABLED", "false").lower() in ("1", "true", "yes")
+email_digest_window = float(os.getenv("EMAIL_DIGEST_WINDOW", "60"))  # Seconds to collect messages before sending
+email_digest_max_messages = int(os.getenv("EMAIL_DIGEST_MAX_MESSAGES", "25"))  # Send early once this many are collected
+
+# Discord channel configuration for receiving emails via Maileroo webhook
+discord_channel_id = os.getenv("DISCORD_CHANNEL_ID")  # Fallback channel ID if subject parsing fails
+discord_guild_id = os.getenv("DISCORD_GUILD_ID", "1405628370301091860")  # Only guild routed (to MAILEROO_TO_EMAIL) when no routing table is configured
+
+# Routing table: a JSON list of routes, each {"guild": id} (every text channel in the guild) or {"channel": id} (overrides its guild's route),
+# with optional "to" (recipient, default MAILEROO_TO_EMAIL), "outbound" (mirror messages to email) and "inbound" (accept email replies), both default true.
+# e.g. [{"guild": 1, "to": "club@example.com"}, {"channel": 2, "to": "board@example.com"}, {"channel": 3, "outbound": false}]
+routes_json = os.getenv("ROUTES", "")  # Inline JSON; takes precedence over ROUTES_PATH
+routes_path = os.getenv("ROUTES_PATH", "routes.json")
+
+def parse_routes(entries):
+    """Split routing table entries into guild ID -> route and channel ID -> route dicts"""
+    guild_routes, channel_routes = {}, {}
+    for entry in entries:
+        route = {
+            "to": entry.get("to") or maileroo_to_email,
+            "outbound": bool(entry.get("outbound", True)),
+            "inbound": bool(entry.get("inbound", True)),
+        }
+        if entry.get("channel"):
+            channel_routes[int(entry["channel"])] = route
+        elif entry.get("guild"):
+            guild_routes[int(entry["guild"])] = route
+        else:
+            raise ValueError(f"Route needs a guild or channel: {entry!r}")
+    return guild_routes, channel_routes
+
+if routes_json:
+    routes_source, route_entries = "ROUTES", json.loads(routes_json)
+elif os.path.exists(routes_path):
+    with open(routes_path) as f:
+        routes_source, route_entries = routes_path, json.load(f)
+else:
+    routes_source, route_entries = "DISCORD_GUILD_ID", [{"guild": discord_guild_id}] if discord_guild_id else []
+guild_routes, channel_routes = parse_routes(route_entries)
+all_routes = list(guild_routes.values()) + list(channel_routes.values())
+
 # Check if Maileroo credentials are configured
-if maileroo_api_key and maileroo_from_email and maileroo_to_email:
+if maileroo_api_key and maileroo_from_email and any(route["outbound"] and route["to"] for route in all_routes):
     email_configured = True
-    print("Maileroo API configured")
+    bot_log.info('Maileroo API configured')
 else:
     email_configured = False
-    print("Warning: Maileroo API credentials not found. Email functionality will be disabled.")
+    bot_log.warning('Maileroo API credentials or recipients not found. Email functionality will be disabled.')
 
-# Discord channel configuration for receiving emails via Maileroo webhook
-discord_channel_id = os.getenv("DISCORD_CHANNEL_ID")  # Fallback channel ID if subject parsing fails
-discord_guild_id = os.getenv("DISCORD_GUILD_ID", "1405628370301091860")  # Guild ID to search channels in
-
-if discord_guild_id:
+if any(route["inbound"] for route in all_routes):
     email_to_discord_configured = True
-    print("Email-to-Discord forwarding configured (via Maileroo webhook, routing by subject)")
+    bot_log.info('Email-to-Discord forwarding configured (via Maileroo webhook, routing by subject)')
 else:
     email_to_discord_configured = False
-    print("Warning: Discord guild ID not found. Email-to-Discord forwarding will be disabled.")
+    bot_log.warning('No inbound routes configured. Email-to-Discord forwarding will be disabled.')
+bot_log.info('Routing table from %s: %s guild route(s), %s channel route(s)', routes_source, len(guild_routes), len(channel_routes))
+
+# Optional Discord endpoint overrides, e.g. the local stubs used by `test_webhook.py load`
+discord_api_base = os.getenv("DISCORD_API_BASE")  # REST base URL, e.g. http://127.0.0.1:9000/api/v10
+discord_gateway_url = os.getenv("DISCORD_GATEWAY_URL")  # Gateway websocket URL, e.g. ws://127.0.0.1:9000/gateway
 
 intents = discord.Intents.default()
 intents.message_content = True  # Required to read message content and process commands
 
 # Configure Discord client
 client = commands.Bot(command_prefix="soph ", intents=intents, case_insensitive=True)
+if discord_api_base:
+    discord.http.Route.BASE = discord_api_base
+if discord_gateway_url:
+    discord.gateway.DiscordWebSocket.DEFAULT_GATEWAY = yarl.URL(discord_gateway_url)
+
+def gateway_latency():
+    latency = client.latency
+    return None if latency != latency or latency == float("inf") else latency  # NaN/inf until the first heartbeat
+
+Gauge("ytt_gateway_latency_seconds", "Discord gateway heartbeat latency", func=gateway_latency)
 
 async def isSophia(ctx):
   return ctx.author.id == 704038199776903209 or ctx.author.id == 701792352301350973
@@ -54,8 +492,75 @@ PRIMARY_SOPHIA_ID = 704038199776903209  # Primary user ID for webhook avatar
 
 # Store bot's event loop for use in Flask routes
 bot_loop = None
+
+# Set by on_ready once the bot can deliver messages; thread-safe so Flask handlers can wait on it
+bot_ready = threading.Event()
+
+# Message ID -> time first seen (oldest first), guarded by a lock since Flask handlers run in threads
+inbound_seen = OrderedDict()
+inbound_seen_lock = threading.Lock()
+inbound_dedupe_db = None
+inbound_dedupe_inserts = 0
+
+# Inbound emails accepted before the bot was ready ("buffer" mode), replayed by on_ready
+pending_emails = []
+pending_emails_lock = threading.Lock()
+
+# Durable inbound queue (see INBOUND_QUEUE_PATH)
+inbound_queue_db = None
+inbound_queue_lock = threading.Lock()  # Web threads share one connection
+inbound_queue_consumer = None
+
+# Bot loop watchdog state
+loop_monitor = None  # Lag sampling task on the bot loop
+loop_monitor_thread_id = None  # Thread running the monitored loop
+loop_heartbeat = None  # time.monotonic() when the monitor last started waiting
+loop_lag_samples = deque(maxlen=240)  # Recent lag samples in seconds
+loop_stalls = deque(maxlen=loop_stall_reports)
+loop_current_stall = None  # Report for a stall still in progress
+loop_watchdog = None
+
+# Leader election state (only used when gunicorn runs several workers)
+bot_leader_election = False  # True once this worker has joined the election
+is_bot_leader = False
+bot_leader_lock_file = None
+bot_leader_server = None
+
+# Shared aiohttp session, owned by the bot loop (created in on_ready, closed on shutdown)
+http_session = None
+
+# Outbound email queue and its sender workers, owned by the bot loop (started in on_ready)
+email_queue = None
+email_workers = []
+OutboundEmail = namedtuple("OutboundEmail", "outbox_id subject body recipient message_id channel_id lane")
+PRIORITY_LANE, NORMAL_LANE = 0, 1
+
+# Outbox database, IDs currently queued or being sent, and results waiting for the next batched commit
+outbox_db = None
+outbox_inflight = set()
+outbox_pending = []
+outbox_retrier = None
+
+# Routing tables expanded from the routing config over the bot's guilds (built in on_ready, kept current by channel events)
+outbound_routes = {}  # Channel ID -> recipient address for mirrored messages
+inbound_routes = {}  # Subject token (channel ID as a string) -> text channel accepting email replies
+channel_index = {}  # Channel name -> inbound text channel, for older subjects without a channel ID
+
+# Subject -> expiry (time.monotonic) for subjects that matched no channel; cleared when channels change
+channel_miss_cache = OrderedDict()
+
+# Inbound email dispatcher, owned by the bot loop (created on first use)
+inbound_dispatcher = None
+
+# Channel ID (str) -> {"id", "token", "url"} of its "sophia" webhook (loaded from webhook_cache_path)
+webhook_cache = {}
+
+# Pending digests by channel ID: {"channel_name", "recipient", "authors", "parts", "reply_target", "priority", "handle"}
+email_digests = {}
  
-client.snipes = {}
+# Channel ID -> deque of SnipeRecord (oldest first); channels ordered by last deletion
+client.snipes = OrderedDict()
+client.snipe_count = 0
 
 @client.event
 async def on_ready():
@@ -63,22 +568,79 @@ async def on_ready():
   # Ensure bot_loop is set (it should already be set in run_bot, but just in case)
   if bot_loop is None:
     bot_loop = asyncio.get_running_loop()
-    print(f'[on_ready] Bot loop was None, setting it now: {bot_loop}')
-  print(f'[on_ready] Bot is ready!')
-  print(f'[on_ready] Bot user: {client.user} (ID: {client.user.id})')
-  print(f'[on_ready] Bot loop stored: {bot_loop is not None}')
-  print(f'[on_ready] Bot loop: {bot_loop}')
-  print(f'[on_ready] Bot loop closed: {bot_loop.is_closed() if bot_loop else "N/A"}')
-  print(f'[on_ready] Connected to {len(client.guilds)} guild(s)')
+    bot_log.debug('Bot loop was None, setting it now: %s', bot_loop)
+  get_http_session()
+  start_email_workers()
+  build_routing_tables()
+  load_webhook_cache()
+  start_inbound_queue_consumer()
+  open_readiness_gate()
+  bot_log.info('Bot is ready as %s (ID: %s), connected to %s guild(s)', client.user, client.user.id, len(client.guilds))
   for guild in client.guilds:
-    print(f'[on_ready]   - {guild.name} (ID: {guild.id})')
+    bot_log.debug('- %s (ID: %s)', guild.name, guild.id)
   await client.change_presence(activity=discord.Activity(type=discord.ActivityType.watching, name=" the AI & Data Science Club!"))
-  print(f'[on_ready] Presence updated successfully')
+  bot_log.debug('Presence updated successfully')
+
+def open_readiness_gate():
+    """Mark the bot ready for inbound emails and hand over the ones buffered until now, in arrival order"""
+    with pending_emails_lock:
+        bot_ready.set()
+        replay = pending_emails[:]
+        pending_emails.clear()
+    for email_kwargs in replay:
+        schedule_discord_send(email_kwargs)
+    if replay:
+        bot_log.info('Replayed %s email(s) received before the bot was ready', len(replay))
+
+def get_http_session():
+    """Return the shared aiohttp session, creating it on the bot loop if needed"""
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=http_pool_size,
+            limit_per_host=http_pool_per_host,
+            keepalive_timeout=http_keepalive_timeout,
+            ttl_dns_cache=300
+        )
+        http_session = aiohttp.ClientSession(connector=connector)
+        mail_log.debug('Created shared HTTP session (pool=%s, per_host=%s)', http_pool_size, http_pool_per_host)
+    return http_session
+
+async def close_http_session():
+    """Close the shared aiohttp session and its pooled connections"""
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+        mail_log.debug('Shared HTTP session closed')
+    http_session = None
+
+class MailerooRateLimited(Exception):
+    """Maileroo answered 429; the send should be retried after retry_after seconds"""
 
-async def send_email(subject, message_content):
-    """Send email notification using Maileroo API"""
+    def __init__(self, retry_after):
+        super().__init__(f"Maileroo rate limit hit, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delay in seconds or an HTTP date, at most MAILEROO_RETRY_AFTER_MAX),
+    else MAILEROO_RETRY_AFTER"""
+    delay = None
+    if value:
+        try:
+            delay = float(value)
+        except ValueError:
+            try:
+                delay = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                pass
+    if delay is None or delay != delay:  # Missing, garbled or NaN
+        return maileroo_retry_after
+    return min(max(0.0, delay), maileroo_retry_after_max)
+
+async def send_email(subject, message_content, recipient=None, message_id=None):
+    """Send email notification using Maileroo API; raises MailerooRateLimited on a 429"""
     if not email_configured:
-        print("Email not configured - skipping email send")
+        mail_log.debug('Email not configured - skipping email send')
         return
     
     try:
@@ -89,220 +651,1048 @@ async def send_email(subject, message_content):
                 "display_name": maileroo_from_name
             },
             "to": {
-                "address": maileroo_to_email
+                "address": recipient or maileroo_to_email
             },
             "subject": subject or "Discord Message Notification",
             "plain": message_content  # Using plain text format
         }
+        if message_id:
+            # Our own Message-ID comes back in the In-Reply-To of replies (see find_reply_target)
+            payload["headers"] = {"Message-ID": message_id}
         
         headers = {
             "Authorization": f"Bearer {maileroo_api_key}",
             "Content-Type": "application/json"
         }
         
-        # Send email via Maileroo API
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                maileroo_api_url,
-                headers=headers,
-                json=payload,
-                timeout=aiohttp.ClientTimeout(total=10)
-            ) as response:
-                response_data = await response.json()
-                
-                if response.status == 200 and response_data.get("success"):
-                    reference_id = response_data.get("data", {}).get("reference_id", "N/A")
-                    print(f"Email sent successfully via Maileroo. Reference ID: {reference_id}")
-                    return True
-                else:
-                    error_msg = response_data.get("message", "Unknown error")
-                    print(f"Maileroo API error: {response.status} - {error_msg}")
-                    return False
+        # Send email via Maileroo API over the shared, pooled session
+        session = get_http_session()
+        started = time.monotonic()
+        async with session.post(
+            maileroo_api_url,
+            headers=headers,
+            json=payload,
+            timeout=aiohttp.ClientTimeout(total=10)
+        ) as response:
+            maileroo_send_seconds.observe(time.monotonic() - started)
+            maileroo_requests_total.inc(status=response.status)
+            if response.status == 429:
+                raise MailerooRateLimited(parse_retry_after(response.headers.get("Retry-After")))
+            response_data = await response.json()
+            
+            if response.status == 200 and response_data.get("success"):
+                reference_id = response_data.get("data", {}).get("reference_id", "N/A")
+                mail_log.info('Email sent successfully via Maileroo. Reference ID: %s', reference_id)
+                return True
+            else:
+                error_msg = response_data.get("message", "Unknown error")
+                mail_log.warning('Maileroo API error: %s - %s', response.status, error_msg)
+                return False
             
+    except MailerooRateLimited:
+        raise
     except aiohttp.ClientError as e:
-        print(f"Network error sending email via Maileroo: {e}")
+        maileroo_requests_total.inc(status="error")
+        mail_log.warning('Network error sending email via Maileroo: %s', e)
         return False
     except Exception as e:
-        print(f"Error sending email via Maileroo: {e}")
-        import traceback
-        traceback.print_exc()
+        maileroo_requests_total.inc(status="error")
+        mail_log.exception('Error sending email via Maileroo: %s', e)
         return False
 
-def find_channel_from_subject(subject):
-    """Parse email subject to find the Discord channel name and return the channel"""
-    print(f'[find_channel_from_subject] Looking for channel from subject: {subject}')
-    # Remove "Re:" or "RE:" prefix if present
-    subject_clean = re.sub(r'^(Re|RE):\s*', '', subject, flags=re.IGNORECASE).strip()
-    print(f'[find_channel_from_subject] Cleaned subject: {subject_clean}')
-    
-    # Look for pattern: [Discord] #channel-name - author-name
-    match = re.search(r'\[Discord\]\s*#([^\s-]+)', subject_clean, re.IGNORECASE)
-    if match:
-        channel_name = match.group(1)
-        print(f'[find_channel_from_subject] Found channel name from pattern: {channel_name}')
-        # Find the channel in the guild
-        guild = client.get_guild(int(discord_guild_id))
-        if guild:
-            print(f'[find_channel_from_subject] Guild found: {guild.name} (ID: {guild.id})')
-            print(f'[find_channel_from_subject] Searching in {len(guild.text_channels)} text channels')
-            channel = discord.utils.get(guild.text_channels, name=channel_name)
-            if channel:
-                print(f'[find_channel_from_subject] Channel found: {channel.name} (ID: {channel.id})')
-                return channel
+def open_outbox():
+    """Open (or create) the SQLite outbox in WAL mode"""
+    global outbox_db
+    if outbox_db is not None:
+        return outbox_db
+    outbox_db = sqlite3.connect(outbox_path, check_same_thread=False)
+    outbox_db.execute("PRAGMA journal_mode=WAL")
+    outbox_db.execute("PRAGMA synchronous=NORMAL")
+    outbox_db.execute(
+        "CREATE TABLE IF NOT EXISTS outbox ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, subject TEXT, body TEXT, "
+        "attempts INTEGER NOT NULL DEFAULT 0, next_attempt REAL NOT NULL, created_at REAL NOT NULL, "
+        "recipient TEXT, message_id TEXT, channel_id INTEGER, lane INTEGER)"
+    )
+    # Older outboxes lack these columns; their rows go to MAILEROO_TO_EMAIL without a Message-ID, in the normal lane
+    columns = {row[1] for row in outbox_db.execute("PRAGMA table_info(outbox)")}
+    for column, column_type in (("recipient", "TEXT"), ("message_id", "TEXT"), ("channel_id", "INTEGER"), ("lane", "INTEGER")):
+        if column not in columns:
+            outbox_db.execute(f"ALTER TABLE outbox ADD COLUMN {column} {column_type}")
+    # Reply index rows are found by the row ID embedded in the Message-ID, so neither lookups nor eviction need another index
+    outbox_db.execute(
+        "CREATE TABLE IF NOT EXISTS reply_index ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, token INTEGER NOT NULL, "
+        "channel_id INTEGER NOT NULL, message_id INTEGER NOT NULL, thread_id INTEGER)"
+    )
+    outbox_db.commit()
+    pending = outbox_db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+    mail_log.info('Outbox opened at %s (%s email(s) pending)', outbox_path, pending)
+    return outbox_db
+
+def outbox_add(subject, message_content, recipient=None, message_id=None, channel_id=None, lane=NORMAL_LANE):
+    """Write an email to the outbox before it is sent; returns its outbox ID"""
+    now = time.time()
+    cursor = outbox_db.execute(
+        "INSERT INTO outbox (subject, body, next_attempt, created_at, recipient, message_id, channel_id, lane) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (subject, message_content, now, now, recipient, message_id, channel_id, lane)
+    )
+    outbox_db.commit()
+    return cursor.lastrowid
+
+def outbox_backoff(attempts):
+    """Jittered exponential backoff delay (seconds) after the given number of failed attempts"""
+    delay = min(outbox_backoff_max, outbox_backoff_base * (2 ** (attempts - 1)))
+    return random.uniform(delay / 2, delay)
+
+def outbox_record_result(outbox_id, sent):
+    """Remember a send result; it is written in the next batched commit"""
+    outbox_inflight.discard(outbox_id)
+    outbox_pending.append((outbox_id, sent))
+    if len(outbox_pending) >= 100:
+        outbox_flush()
+
+def outbox_flush():
+    """Commit all recorded send results in one transaction"""
+    if not outbox_pending or outbox_db is None:
+        return
+    results = outbox_pending[:]
+    outbox_pending.clear()
+    now = time.time()
+    with outbox_db:
+        for outbox_id, sent in results:
+            if sent:
+                outbox_db.execute("DELETE FROM outbox WHERE id = ?", (outbox_id,))
+                continue
+            row = outbox_db.execute("SELECT attempts FROM outbox WHERE id = ?", (outbox_id,)).fetchone()
+            if row is None:
+                continue
+            attempts = row[0] + 1
+            if outbox_max_attempts and attempts >= outbox_max_attempts:
+                mail_log.warning('Giving up on outbox email %s after %s attempt(s)', outbox_id, attempts)
+                outbox_db.execute("DELETE FROM outbox WHERE id = ?", (outbox_id,))
             else:
-                print(f'[find_channel_from_subject] Channel \'{channel_name}\' not found in guild')
-                print(f'[find_channel_from_subject] Available channels: {[c.name for c in guild.text_channels]}')
+                outbox_db.execute(
+                    "UPDATE outbox SET attempts = ?, next_attempt = ? WHERE id = ?",
+                    (attempts, now + outbox_backoff(attempts), outbox_id)
+                )
+
+async def outbox_retry_loop():
+    """Periodically commit send results and re-queue outbox emails whose retry time has come"""
+    while True:
+        try:
+            outbox_flush()
+            due = outbox_db.execute(
+                "SELECT id, subject, body, recipient, message_id, channel_id, COALESCE(lane, ?) FROM outbox "
+                "WHERE next_attempt <= ? ORDER BY next_attempt",
+                (NORMAL_LANE, time.time())
+            ).fetchall()
+            requeued = 0
+            for row in due:
+                if row[0] in outbox_inflight:
+                    continue
+                if email_queue.full():
+                    break
+                queue_email(OutboundEmail(*row))
+                requeued += 1
+            if requeued:
+                mail_log.info('Re-queued %s email(s) from the outbox', requeued)
+        except Exception as e:
+            mail_log.exception('Outbox retry pass failed: %s: %s', type(e).__name__, e)
+        await asyncio.sleep(outbox_retry_interval)
+
+class TokenBucket:
+    """Allows `rate` events per second with bursts of up to `burst`; after a 429 it pauses and slows down"""
+
+    def __init__(self, rate, burst):
+        self.max_rate = rate
+        self.rate = rate  # 0 = unlimited (429 pauses still apply)
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def reserve(self, now=None):
+        """Take a token, borrowing from the future if none are left; returns the seconds until it may be used"""
+        now = time.monotonic() if now is None else now
+        wait = 0.0
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - 1
+            self.updated = now
+            if self.tokens < 0:
+                wait = -self.tokens / self.rate
+        return max(wait, self.paused_until - now)
+
+    def try_take(self, now=None):
+        """Take a token only if one is free now; returns 0 if taken, else the seconds until one will be"""
+        now = time.monotonic() if now is None else now
+        wait = self.paused_until - now
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + max(0.0, now - self.updated) * self.rate)
+            self.updated = max(self.updated, now)
+            if self.tokens < 1:
+                wait = max(wait, (1 - self.tokens) / self.rate)
+        if wait > 0:
+            return wait
+        if self.rate:
+            self.tokens -= 1
+        return 0.0
+
+    async def acquire(self):
+        """Wait for a token, and for any pause that started while waiting"""
+        await asyncio.sleep(self.reserve())
+        while self.paused_until > time.monotonic():
+            await asyncio.sleep(self.paused_until - time.monotonic())
+
+    def throttle(self, retry_after):
+        """Pause for retry_after seconds and halve the rate (down to 1/16 of the configured rate)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+        if self.max_rate:
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+            # Nothing accrues while paused
+            self.tokens = min(self.tokens, 0.0)
+            self.updated = self.paused_until
+
+    def recover(self):
+        """Creep back towards the configured rate after a successful send"""
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+class EmailScheduler:
+    """Outbound email queue: a FIFO lane per priority, each email going once its channel's bucket has a token"""
+
+    def __init__(self, maxsize, channel_rate, channel_burst, max_channels=10000):
+        self.maxsize = maxsize
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.max_channels = max_channels
+        # Emails wait in a FIFO per (lane, channel); the token is only taken when one is handed to a worker,
+        # so emails dropped from the queue never leave their channel in debt
+        self.channels = {}  # (lane, channel ID) -> deque of (seq, email)
+        self.ready = ([], [])  # Heap of (seq of head email, key) per lane, for channels that may have a token
+        self.held = []  # Heap of (time a token is due, seq of head email, key) for channels out of tokens
+        self.retries = (deque(), deque())  # Emails put back after a 429, sent first without another token
+        self.buckets = OrderedDict()  # Channel ID -> TokenBucket, least recently used first
+        self.seq = itertools.count()
+        self.size = 0
+        self.unfinished = 0
+        self.wakeup = asyncio.Event()
+        self.finished = asyncio.Event()
+        self.finished.set()
+
+    def qsize(self):
+        return self.size
+
+    def full(self):
+        return 0 < self.maxsize <= self.size
+
+    def channel_bucket(self, channel_id):
+        bucket = self.buckets.get(channel_id)
+        if bucket is None:
+            bucket = self.buckets[channel_id] = TokenBucket(self.channel_rate, self.channel_burst)
+            if len(self.buckets) > self.max_channels:
+                self.buckets.popitem(last=False)
         else:
-            print(f'[find_channel_from_subject] Guild not found for ID: {discord_guild_id}')
+            self.buckets.move_to_end(channel_id)
+        return bucket
+
+    def put_nowait(self, email, retry=False):
+        """Queue an email behind the others for its channel; retry=True puts it back at the front without taking another token"""
+        if retry:
+            self.retries[email.lane].appendleft(email)
+        else:
+            key = (email.lane, email.channel_id)
+            seq = next(self.seq)
+            emails = self.channels.get(key)
+            if emails is None:
+                emails = self.channels[key] = deque()
+                heapq.heappush(self.ready[email.lane], (seq, key))
+            emails.append((seq, email))
+        self.size += 1
+        self.unfinished += 1
+        self.finished.clear()
+        self.wakeup.set()
+
+    def pop_ready(self):
+        """The next email allowed to go, highest priority lane first, or None"""
+        now = time.monotonic()
+        while self.held and self.held[0][0] <= now:
+            _, seq, key = heapq.heappop(self.held)
+            heapq.heappush(self.ready[key[0]], (seq, key))
+        for lane, ready in enumerate(self.ready):
+            if self.retries[lane]:
+                self.size -= 1
+                return self.retries[lane].popleft()
+            while ready:
+                seq, key = heapq.heappop(ready)
+                emails = self.channels.get(key)
+                if not emails or emails[0][0] != seq:
+                    continue  # Stale: the head email was dropped since
+                wait = self.channel_bucket(key[1]).try_take(now) if self.channel_rate and key[1] is not None else 0
+                if wait > 0:
+                    heapq.heappush(self.held, (now + wait, seq, key))
+                    continue
+                email = emails.popleft()[1]
+                if emails:
+                    heapq.heappush(ready, (emails[0][0], key))
+                else:
+                    del self.channels[key]
+                self.size -= 1
+                return email
+        return None
+
+    async def get(self):
+        while True:
+            email = self.pop_ready()
+            if email is not None:
+                return email
+            self.wakeup.clear()
+            timeout = self.held[0][0] - time.monotonic() if self.held else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def pop_oldest(self):
+        """Remove and return the oldest email in the lowest priority lane that has any (for the drop_oldest policy)"""
+        for lane in reversed(range(len(self.ready))):
+            heads = [(emails[0][0], key) for key, emails in self.channels.items() if key[0] == lane]
+            if heads:
+                key = min(heads)[1]
+                emails = self.channels[key]
+                email = emails.popleft()[1]
+                if emails:
+                    heapq.heappush(self.ready[lane], (emails[0][0], key))
+                else:
+                    del self.channels[key]
+            elif self.retries[lane]:
+                email = self.retries[lane].pop()
+            else:
+                continue
+            self.size -= 1
+            return email
+        return None
+
+    def task_done(self):
+        self.unfinished -= 1
+        if self.unfinished <= 0:
+            self.finished.set()
+
+    async def join(self):
+        await self.finished.wait()
+
+# Global bucket for Maileroo sends, shared by the sender workers
+maileroo_bucket = TokenBucket(maileroo_rate, maileroo_burst)
+
+def start_email_workers():
+    """Open the outbox, create the outbound email queue and start its sender workers and retrier (once)"""
+    global email_queue, outbox_retrier
+    if email_queue is None:
+        email_queue = EmailScheduler(email_queue_size, maileroo_channel_rate, maileroo_channel_burst)
+    if email_workers:
+        return
+    open_outbox()
+    for i in range(max(1, email_queue_workers)):
+        email_workers.append(asyncio.create_task(email_worker(i), name=f"email-worker-{i}"))
+    outbox_retrier = asyncio.create_task(outbox_retry_loop(), name="outbox-retrier")
+    mail_log.info('Started %s email worker(s) (queue size %s, policy %s)', len(email_workers), email_queue_size, email_queue_drop_policy)
+
+async def stop_email_workers(drain_timeout=5):
+    """Give the workers a moment to drain the queue, then cancel them; unsent emails stay in the outbox"""
+    global outbox_retrier, outbox_db
+    if email_queue is not None and email_workers:
+        try:
+            await asyncio.wait_for(email_queue.join(), drain_timeout)
+        except asyncio.TimeoutError:
+            mail_log.warning('Queue not drained after %ss', drain_timeout)
+    tasks = email_workers + ([outbox_retrier] if outbox_retrier else [])
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if outbox_db is not None:
+        outbox_flush()
+        pending = outbox_db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+        mail_log.info('Stopped %s email worker(s), %s email(s) left in the outbox', len(email_workers), pending)
+        outbox_db.close()
+        outbox_db = None
+    email_workers.clear()
+    outbox_retrier = None
+    outbox_inflight.clear()
+
+async def email_worker(worker_id):
+    """Take emails off the queue and send them one at a time, within the global Maileroo rate"""
+    while True:
+        email = await email_queue.get()
+        sent = False
+        retried = False
+        try:
+            await maileroo_bucket.acquire()
+            sent = await send_email(email.subject, email.body, email.recipient, email.message_id)
+            if sent:
+                maileroo_bucket.recover()
+        except MailerooRateLimited as e:
+            # Every worker waits out the pause; this email goes first once it ends
+            maileroo_bucket.throttle(e.retry_after)
+            if maileroo_bucket.rate:
+                mail_log.warning('%s; slowing sends to %.2f/s', e, maileroo_bucket.rate)
+            else:
+                mail_log.warning('%s', e)
+            email_queue.put_nowait(email, retry=True)
+            retried = True
+        except Exception as e:
+            mail_log.exception('Worker %s failed to send email: %s: %s', worker_id, type(e).__name__, e)
+        finally:
+            if not retried:
+                outbox_record_result(email.outbox_id, bool(sent))
+            email_queue.task_done()
+
+def queue_email(email):
+    """Put an outbox email on the send queue, applying the drop policy; returns False if it was not queued"""
+    if email_queue.full():
+        # Priority emails always get in, pushing out the oldest normal one
+        if email_queue_drop_policy == "drop_newest" and email.lane != PRIORITY_LANE:
+            mail_log.warning('Email queue full (%s), deferring new email to the outbox: %s', email_queue.qsize(), email.subject)
+            email_queue_deferred_total.inc(email="newest")
+            return False
+        dropped = email_queue.pop_oldest()
+        email_queue.task_done()
+        # The dropped email is still in the outbox, so the retrier will pick it up again
+        outbox_inflight.discard(dropped.outbox_id)
+        mail_log.warning('Email queue full (%s), deferring oldest email to the outbox: %s', email_queue.qsize() + 1, dropped.subject)
+        email_queue_deferred_total.inc(email="oldest")
+    outbox_inflight.add(email.outbox_id)
+    email_queue.put_nowait(email)
+    return True
+
+def enqueue_email(subject, message_content, recipient=None, reply_target=None, priority=False):
+    """Write an email to the outbox and queue it for the sender workers without waiting"""
+    if not email_configured:
+        return False
+    if email_queue is None or outbox_db is None:
+        mail_log.warning('Email queue not started yet, dropping email: %s', subject)
+        return False
+    message_id = add_reply_target(*reply_target) if reply_target else None
+    channel_id = reply_target[0] if reply_target else None  # The routed channel, whose bucket the email waits on
+    lane = PRIORITY_LANE if priority else NORMAL_LANE
+    outbox_id = outbox_add(subject, message_content, recipient, message_id, channel_id, lane)
+    return queue_email(OutboundEmail(outbox_id, subject, message_content, recipient, message_id, channel_id, lane))
+
+# Outbound Message-IDs: <ytt.{reply_index row ID}.{random token}@{sender domain}>
+OUTBOUND_MESSAGE_ID_PATTERN = re.compile(r'<?ytt\.(\d+)\.([0-9a-f]{8})@')
+
+def add_reply_target(channel_id, message_id, thread_id=None):
+    """Record the Discord message an email mirrors in the reply index (committed with its outbox row); returns its Message-ID"""
+    token = random.getrandbits(32)
+    row_id = outbox_db.execute(
+        "INSERT INTO reply_index (token, channel_id, message_id, thread_id) VALUES (?, ?, ?, ?)",
+        (token, channel_id, message_id, thread_id)
+    ).lastrowid
+    if row_id % 1000 == 0:
+        outbox_db.execute("DELETE FROM reply_index WHERE id <= ?", (row_id - reply_index_size,))
+    domain = maileroo_from_email.rpartition("@")[2] or "localhost"
+    return f"<ytt.{row_id}.{token:08x}@{domain}>"
+
+def find_reply_target(message_ids):
+    """Look up the first of an email's reply headers naming one of our emails; returns (channel, message ID, thread ID) or None"""
+    if outbox_db is None:
+        return None
+    for header_id in message_ids:
+        match = OUTBOUND_MESSAGE_ID_PATTERN.match(header_id)
+        if not match:
+            continue
+        row = outbox_db.execute(
+            "SELECT token, channel_id, message_id, thread_id FROM reply_index WHERE id = ?", (int(match.group(1)),)
+        ).fetchone()
+        # A wrong token means the ID is from an outbox that has since been replaced
+        if row is None or row[0] != int(match.group(2), 16):
+            continue
+        channel = inbound_routes.get(str(row[1]))
+        if channel is not None:
+            return channel, row[2], row[3]
+    return None
+
+def add_to_digest(channel, author_name, email_message, recipient=None, reply_target=None, priority=False):
+    """Collect a message into its channel's digest, sending it when the window or size limit is hit"""
+    digest = email_digests.get(channel.id)
+    if digest is None:
+        digest = {"channel_name": channel.name, "recipient": recipient, "authors": [], "parts": [], "priority": False, "handle": None}
+        digest["handle"] = asyncio.get_running_loop().call_later(email_digest_window, flush_digest, channel.id)
+        email_digests[channel.id] = digest
+    if author_name not in digest["authors"]:
+        digest["authors"].append(author_name)
+    digest["parts"].append(email_message)
+    digest["reply_target"] = reply_target  # Replies to the digest go under its latest message
+    digest["priority"] = digest["priority"] or priority
+    if len(digest["parts"]) >= email_digest_max_messages:
+        flush_digest(channel.id)
+
+def flush_digest(channel_id):
+    """Send a channel's pending digest as one email"""
+    digest = email_digests.pop(channel_id, None)
+    if digest is None:
+        return
+    digest["handle"].cancel()
+    # Keep the usual subject format so find_channel_from_subject can route replies
+    subject = outbound_subject(channel_id, digest["channel_name"], ", ".join(digest["authors"]))
+    enqueue_email(subject, "".join(digest["parts"]), digest["recipient"], digest["reply_target"], digest["priority"])
+
+def flush_all_digests():
+    """Send every pending digest now (used on shutdown)"""
+    for channel_id in list(email_digests):
+        flush_digest(channel_id)
+
+# Precompiled subject patterns: optional "Re:" prefix and "[Discord] #channel-name (channel-id) - author-name";
+# the channel ID is missing from subjects sent before it was added
+SUBJECT_REPLY_PREFIX = re.compile(r'^(Re|RE):\s*', re.IGNORECASE)
+SUBJECT_CHANNEL_PATTERN = re.compile(r'\[Discord\]\s*#(\S+)(?:\s+\((\d+)\))?', re.IGNORECASE)
+
+def outbound_subject(channel_id, channel_name, author_name):
+    """Subject for a mirrored message; the channel ID routes replies without a name lookup"""
+    return f"[Discord] #{channel_name} ({channel_id}) - {author_name}"
+
+def build_routing_tables():
+    """Rebuild the outbound and inbound routing tables over every text channel the bot can see"""
+    outbound_routes.clear()
+    inbound_routes.clear()
+    channel_index.clear()
+    channel_miss_cache.clear()
+    for guild in client.guilds:
+        for channel in guild.text_channels:
+            route_channel(channel)
+    visible = {guild.id for guild in client.guilds}
+    for guild_id in guild_routes:
+        if guild_id not in visible:
+            delivery_log.warning('Guild not found for ID: %s', guild_id)
+    delivery_log.info('Routed %s channel(s) to email and %s channel(s) from email across %s guild(s)',
+                      len(outbound_routes), len(inbound_routes), len(visible & set(guild_routes)))
+
+def find_route(channel):
+    """The channel's own route, else its guild's route, else None"""
+    return channel_routes.get(channel.id) or guild_routes.get(channel.guild.id)
+
+def route_channel(channel):
+    """Add a text channel to the routing tables its route allows"""
+    route = find_route(channel)
+    if route is None:
+        return
+    if route["outbound"] and route["to"]:
+        outbound_routes[channel.id] = route["to"]
+    if route["inbound"]:
+        inbound_routes[str(channel.id)] = channel
+        # text_channels is sorted by position; keep the first channel for duplicate names
+        channel_index.setdefault(channel.name, channel)
+        channel_miss_cache.clear()
+
+def unroute_channel(channel, name):
+    """Remove a text channel from the routing tables, falling back to another inbound channel with the same name"""
+    outbound_routes.pop(channel.id, None)
+    inbound_routes.pop(str(channel.id), None)
+    if channel_index.get(name) is not None and channel_index[name].id == channel.id:
+        del channel_index[name]
+        other = discord.utils.get(
+            (c for c in channel.guild.text_channels if c.id != channel.id and str(c.id) in inbound_routes), name=name
+        )
+        if other:
+            channel_index[name] = other
+
+@client.event
+async def on_guild_channel_create(channel):
+  if isinstance(channel, discord.TextChannel):
+    route_channel(channel)
+
+@client.event
+async def on_guild_channel_update(before, after):
+  if isinstance(after, discord.TextChannel):
+    unroute_channel(before, before.name)
+    route_channel(after)
+
+@client.event
+async def on_guild_channel_delete(channel):
+  if isinstance(channel, discord.TextChannel):
+    unroute_channel(channel, channel.name)
+
+@client.event
+async def on_guild_join(guild):
+  for channel in guild.text_channels:
+    route_channel(channel)
+
+@client.event
+async def on_guild_remove(guild):
+  for channel in guild.text_channels:
+    unroute_channel(channel, channel.name)
+
+def find_channel_from_subject(subject):
+    """Parse email subject to find the Discord channel name and return the channel"""
+    delivery_log.debug('Looking for channel from subject: %s', subject)
+    channel = None
+    miss_expiry = channel_miss_cache.get(subject)
+    if miss_expiry is not None and miss_expiry > time.monotonic():
+        delivery_log.debug('Subject is in the miss cache, skipping channel lookup')
+        channel_resolution_total.inc(outcome="miss_cached")
     else:
-        print(f'[find_channel_from_subject] No channel pattern found in subject')
+        channel = lookup_channel_from_subject(subject)
+        if channel:
+            channel_resolution_total.inc(outcome="hit")
+            return channel
+        channel_resolution_total.inc(outcome="miss")
+        channel_miss_cache[subject] = time.monotonic() + channel_miss_cache_ttl
+        channel_miss_cache.move_to_end(subject)
+        while len(channel_miss_cache) > channel_miss_cache_size:
+            channel_miss_cache.popitem(last=False)
     
     # Fallback: try to find channel by ID if configured
     if discord_channel_id:
-        print(f'[find_channel_from_subject] Trying fallback channel ID: {discord_channel_id}')
+        delivery_log.debug('Trying fallback channel ID: %s', discord_channel_id)
         channel = client.get_channel(int(discord_channel_id))
         if channel:
-            print(f'[find_channel_from_subject] Fallback channel found: {channel.name} (ID: {channel.id})')
+            delivery_log.debug('Fallback channel found: %s (ID: %s)', channel.name, channel.id)
+            channel_resolution_total.inc(outcome="fallback")
             return channel
         else:
-            print(f'[find_channel_from_subject] Fallback channel ID not found')
+            delivery_log.debug('Fallback channel ID not found')
     
-    print(f'[find_channel_from_subject] No channel found for subject: {subject}')
+    delivery_log.warning('No channel found for subject: %s', subject)
+    channel_resolution_total.inc(outcome="unresolved")
+    return None
+
+def lookup_channel_from_subject(subject):
+    """Look up the channel ID in the subject in the inbound routes (or, for older subjects, the channel name)"""
+    # Remove "Re:" or "RE:" prefix if present
+    subject_clean = SUBJECT_REPLY_PREFIX.sub('', subject).strip()
+    match = SUBJECT_CHANNEL_PATTERN.search(subject_clean)
+    if not match:
+        delivery_log.debug('No channel pattern found in subject')
+        return None
+    channel_name, token = match.groups()
+    if token:
+        channel = inbound_routes.get(token)
+        if channel:
+            delivery_log.debug('Channel found by ID: %s (ID: %s)', channel.name, channel.id)
+        else:
+            delivery_log.debug('Channel ID %s is not routed for inbound email', token)
+        return channel
+    delivery_log.debug('Found channel name from pattern: %s', channel_name)
+    channel = channel_index.get(channel_name)
+    if channel:
+        delivery_log.debug('Channel found: %s (ID: %s)', channel.name, channel.id)
+        return channel
+    delivery_log.debug("Channel '%s' not found in index (%s channels)", channel_name, len(channel_index))
     return None
 
+def load_webhook_cache():
+    """Load the persisted channel -> webhook cache from disk"""
+    global webhook_cache
+    try:
+        with open(webhook_cache_path) as f:
+            webhook_cache = json.load(f)
+        delivery_log.info('Loaded %s cached webhook(s) from %s', len(webhook_cache), webhook_cache_path)
+    except FileNotFoundError:
+        webhook_cache = {}
+    except Exception as e:
+        delivery_log.error('Error reading %s, starting empty: %s: %s', webhook_cache_path, type(e).__name__, e)
+        webhook_cache = {}
+
+def save_webhook_cache():
+    """Write the channel -> webhook cache to disk (atomically)"""
+    try:
+        tmp_path = f"{webhook_cache_path}.tmp"
+        # Webhook tokens are credentials: owner-only, whatever the umask (gunicorn runs with umask 0)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)  # A leftover temp file keeps its old mode
+        with os.fdopen(fd, "w") as f:
+            json.dump(webhook_cache, f)
+        os.replace(tmp_path, webhook_cache_path)
+    except Exception as e:
+        delivery_log.error('Error writing %s: %s: %s', webhook_cache_path, type(e).__name__, e)
+
+def cache_webhook(channel_id, webhook):
+    if not webhook.token:
+        return
+    webhook_cache[str(channel_id)] = {"id": webhook.id, "token": webhook.token, "url": webhook.url}
+    save_webhook_cache()
+
+def invalidate_webhook(channel_id):
+    if webhook_cache.pop(str(channel_id), None) is not None:
+        delivery_log.debug('Dropped cached webhook for channel %s', channel_id)
+        save_webhook_cache()
+
+@client.event
+async def on_webhooks_update(channel):
+  invalidate_webhook(channel.id)
+
 async def get_or_create_sophia_webhook(channel):
     """Get or create a webhook named 'sophia' in the channel"""
-    print(f'[get_or_create_sophia_webhook] Starting for channel: {channel.name} (ID: {channel.id})')
+    delivery_log.debug('Starting for channel: %s (ID: %s)', channel.name, channel.id)
+    cached = webhook_cache.get(str(channel.id))
+    if cached:
+        delivery_log.debug('Using cached "sophia" webhook: %s', cached["id"])
+        return discord.Webhook.partial(cached["id"], cached["token"], client=client)
     try:
         # Try to find existing webhook named "sophia"
-        print(f'[get_or_create_sophia_webhook] Fetching webhooks from channel...')
+        delivery_log.debug('Fetching webhooks from channel...')
         webhooks = await channel.webhooks()
-        print(f'[get_or_create_sophia_webhook] Found {len(webhooks)} webhook(s) in channel')
-        for webhook in webhooks:
-            print(f'[get_or_create_sophia_webhook]   - Webhook: {webhook.name} (ID: {webhook.id})')
+        delivery_log.debug('Found %s webhook(s) in channel', len(webhooks))
         
         sophia_webhook = discord.utils.get(webhooks, name="sophia")
         
         if sophia_webhook:
-            print(f'[get_or_create_sophia_webhook] Found existing "sophia" webhook: {sophia_webhook.id}')
+            delivery_log.debug('Found existing "sophia" webhook: %s', sophia_webhook.id)
+            cache_webhook(channel.id, sophia_webhook)
             return sophia_webhook
         
-        print(f'[get_or_create_sophia_webhook] "sophia" webhook not found, creating new one...')
+        delivery_log.debug('"sophia" webhook not found, creating new one...')
         # Webhook doesn't exist, create one with Sophia's name and avatar
-        guild = channel.guild
-        print(f'[get_or_create_sophia_webhook] Guild: {guild.name} (ID: {guild.id})')
-
-        print(f'[get_or_create_sophia_webhook] Creating webhook...')
+        delivery_log.debug('Creating webhook...')
         webhook = await channel.create_webhook(
             name="sophia",
             reason="Created for email-to-Discord forwarding"
         )
-        print(f'[get_or_create_sophia_webhook] Webhook created successfully: {webhook.id}')
+        delivery_log.info('Webhook created in #%s: %s', channel.name, webhook.id)
+        cache_webhook(channel.id, webhook)
         return webhook
         
     except discord.errors.Forbidden:
-        print(f'[get_or_create_sophia_webhook] ERROR: Bot doesn\'t have permission to manage webhooks in channel {channel.name}')
-        import traceback
-        traceback.print_exc()
+        delivery_log.exception("Bot doesn't have permission to manage webhooks in channel %s", channel.name)
+        return None
+    except Exception as e:
+        delivery_log.exception('Error getting webhook for channel %s: %s', channel.name, e)
+        return None
+
+DISCORD_MESSAGE_LIMIT = 2000
+
+CODE_FENCE = "```"
+CODE_LANGUAGE_PATTERN = re.compile(r"[\w+#.-]{1,20}")  # Language tags we carry over when re-opening a code block
+
+def code_fence_opener(line):
+    """What re-opens the code block a line leaves open: the fence, plus the block's language if it has a short one"""
+    language = line[line.rindex(CODE_FENCE) + len(CODE_FENCE):].strip()
+    return CODE_FENCE + language if CODE_LANGUAGE_PATTERN.fullmatch(language) else CODE_FENCE
+
+def split_message(text, limit=DISCORD_MESSAGE_LIMIT):
+    """Split text into Discord-sized chunks in one pass, breaking at line ends and re-opening code blocks"""
+    chunks = []
+    lines = []
+    length = 0  # len("\n".join(lines))
+    fence = None  # What re-opens the code block we are inside, if any
+
+    def close_chunk():
+        nonlocal lines, length
+        if fence:
+            lines.append(CODE_FENCE)
+        chunks.append("\n".join(lines))
+        # The next chunk re-opens the code block we were inside
+        lines = [fence] if fence else []
+        length = len(fence) if fence else 0
+
+    for line in text.split("\n"):
+        # A line with an even number of fences (like ```pip install foo```) opens and closes its own block
+        toggles_fence = line.count(CODE_FENCE) % 2 == 1
+        # A chunk that ends inside a code block needs room for "\n```" to close it
+        reserve = 4 if (fence is None) == toggles_fence else 0
+        start = 0  # Where the rest of the line starts, once it has been hard-split
+        while True:
+            sep = 1 if lines else 0
+            if length + sep + len(line) - start + reserve <= limit:
+                lines.append(line[start:] if start else line)
+                length += sep + len(line) - start
+                break
+            if len(lines) > (1 if fence else 0):
+                close_chunk()
+                continue
+            # The line alone is longer than a chunk: hard-split it, preferring whitespace
+            room = limit - length - sep - (4 if fence else 0)
+            cut = line.rfind(" ", start, start + room)
+            if cut <= start:
+                cut = start + room
+            lines.append(line[start:cut])
+            length += sep + cut - start
+            start = cut
+            while start < len(line) and line[start] == " ":
+                start += 1
+            close_chunk()
+        if toggles_fence:
+            fence = None if fence else code_fence_opener(line)
+    if len(lines) > (1 if fence else 0):
+        close_chunk()
+    return [chunk for chunk in chunks if chunk.strip()]
+
+def attachment_url_allowed(url):
+    """True if the URL is https on one of ATTACHMENT_URL_HOSTS (or http on one of ATTACHMENT_HTTP_HOSTS),
+    so a forged payload cannot make us fetch internal services"""
+    try:
+        url = yarl.URL(url)
+    except (TypeError, ValueError):
+        return False
+    host = (url.host or "").lower().rstrip(".")
+    if url.user is not None:
+        return False
+    if url.scheme == "http":
+        return host in attachment_http_hosts
+    return url.scheme == "https" and any(host == allowed or host.endswith("." + allowed) for allowed in attachment_url_hosts)
+
+async def download_attachment(session, attachment, budget):
+    """Stream one Maileroo attachment into a spooled temp file; returns (filename, file) or None if skipped"""
+    filename = attachment.get("filename") or attachment.get("name") or "attachment"
+    url = attachment.get("url")
+    if not url:
+        delivery_log.warning('Attachment %s has no URL, skipping', filename)
         return None
+    if not attachment_url_allowed(url):
+        delivery_log.warning('Attachment %s URL is not an allowed https URL on %s, skipping', filename, ", ".join(attachment_url_hosts))
+        return None
+    try:
+        declared_size = int(attachment.get("size") or 0)
+    except (TypeError, ValueError):
+        declared_size = 0  # The payload is untrusted: treat a bad size as unknown; the streamed size is still capped
+    if declared_size > attachment_max_bytes or declared_size > attachment_max_total_bytes - budget["used"]:
+        delivery_log.warning('Attachment %s is too large (%s bytes), skipping', filename, declared_size)
+        return None
+
+    spool = tempfile.SpooledTemporaryFile(max_size=attachment_spool_bytes)
+    size = 0
+    try:
+        timeout = aiohttp.ClientTimeout(total=attachment_download_timeout)
+        # Follow redirects by hand so every hop is checked against the allowed hosts
+        for _ in range(5):
+            response = await session.get(url, timeout=timeout, allow_redirects=False)
+            location = response.headers.get("Location") if response.status in (301, 302, 303, 307, 308) else None
+            if location is None:
+                break
+            response.release()
+            url = response.url.join(yarl.URL(location))
+            if not attachment_url_allowed(url):
+                delivery_log.warning('Attachment %s redirected to %s, skipping', filename, url.host)
+                spool.close()
+                return None
+        async with response:
+            if response.status != 200:
+                delivery_log.warning('Attachment %s download failed: HTTP %s', filename, response.status)
+                spool.close()
+                return None
+            async for block in response.content.iter_chunked(64 * 1024):
+                size += len(block)
+                budget["used"] += len(block)
+                if size > attachment_max_bytes or budget["used"] > attachment_max_total_bytes:
+                    delivery_log.warning('Attachment %s exceeded the size limit while downloading, skipping', filename)
+                    budget["used"] -= size
+                    spool.close()
+                    return None
+                spool.write(block)
     except Exception as e:
-        print(f'[get_or_create_sophia_webhook] ERROR: {e}')
-        import traceback
-        traceback.print_exc()
+        delivery_log.warning('Attachment %s download failed: %s: %s', filename, type(e).__name__, e)
+        budget["used"] -= size
+        spool.close()
         return None
+    spool.seek(0)
+    delivery_log.debug('Downloaded attachment %s (%s bytes)', filename, size)
+    return filename, spool
+
+async def download_attachments(attachments):
+    """Download all attachments concurrently over the shared HTTP session; returns a list of (filename, file)"""
+    if not attachments:
+        return []
+    session = get_http_session()
+    budget = {"used": 0}  # Bytes downloaded so far across all files, for the per-email cap
+    results = await asyncio.gather(*(download_attachment(session, a, budget) for a in attachments))
+    return [result for result in results if result is not None]
+
+async def send_sophia_webhook_message(webhook, content, files=None, thread=None):
+    kwargs = {"files": files} if files else {}
+    if thread is not None:
+        kwargs["thread"] = thread
+    await webhook.send(
+        content=content or None,
+        username="sophia",
+        avatar_url="https://cdn.discordapp.com/avatars/704038199776903209/58cc604300dfcd8348b09a26f37a1a1e.png",
+        **kwargs
+    )
+
+async def get_reply_thread(channel, message_id, thread_id):
+    """The thread an email reply goes in: the mirrored message's own thread, or one started under it (None to post in the channel)"""
+    thread_id = thread_id or message_id  # A thread started from a message shares the message's ID
+    thread = channel.guild.get_thread(thread_id)
+    if thread is None and thread_id == message_id:
+        try:
+            return await channel.get_partial_message(message_id).create_thread(name="Email replies")
+        except discord.NotFound:
+            delivery_log.info('Message %s was deleted, posting the reply in #%s', message_id, channel.name)
+            return None
+        except discord.HTTPException as e:
+            if e.code != 160004:  # "A thread has already been created for this message": it is archived, so not cached
+                delivery_log.warning('Could not start a thread under message %s, posting the reply in #%s: %s %s',
+                                     message_id, channel.name, e.status, e.text)
+                return None
+    if thread is None:
+        try:
+            thread = await client.fetch_channel(thread_id)
+        except discord.NotFound:
+            delivery_log.info('Thread %s was deleted, posting the reply in #%s', thread_id, channel.name)
+            return None
+        except discord.HTTPException as e:
+            delivery_log.warning('Could not fetch thread %s, posting the reply in #%s: %s %s',
+                                 thread_id, channel.name, e.status, e.text)
+            return None
+    if getattr(thread, "locked", False):
+        delivery_log.info('Thread %s is locked, posting the reply in #%s', thread_id, channel.name)
+        return None
+    return thread
+
+def resolve_inbound_target(subject, reply_to):
+    """(channel, reply message ID, reply thread ID) for an inbound email; channel is None if nothing matched"""
+    # Replies to one of our emails go under the mirrored message; anything else is routed by subject
+    target = find_reply_target(reply_to) if reply_to else None
+    if target is not None:
+        channel_resolution_total.inc(outcome="reply_index")
+        return target
+    return find_channel_from_subject(subject), None, None
+
+# Per-channel webhook buckets and the global bucket for Discord posts; discord.py only reacts once a bucket is exhausted
+discord_webhook_buckets = OrderedDict()  # Channel ID -> TokenBucket, least recently used first
+discord_global_bucket = TokenBucket(discord_global_rate, discord_global_burst)
+
+async def pace_discord_post(channel_id):
+    """Wait for room in the channel's webhook bucket, then in the global bucket"""
+    bucket = discord_webhook_buckets.get(channel_id)
+    if bucket is None:
+        bucket = discord_webhook_buckets[channel_id] = TokenBucket(discord_webhook_rate, discord_webhook_burst)
+        if len(discord_webhook_buckets) > 10000:
+            discord_webhook_buckets.popitem(last=False)
+    else:
+        discord_webhook_buckets.move_to_end(channel_id)
+    await bucket.acquire()
+    await discord_global_bucket.acquire()
 
 async def send_email_to_discord(from_email, subject, body, date=None, attachments=None, 
-                                 envelope_sender=None, recipients=None, domain=None, is_spam=False):
-    """Send email content to Discord channel based on subject line"""
-    print(f'[send_email_to_discord] ===== FUNCTION CALLED =====')
-    print(f'[send_email_to_discord] Called with subject: {subject}')
-    print(f'[send_email_to_discord] From: {from_email}')
-    print(f'[send_email_to_discord] Body length: {len(body) if body else 0} chars')
-    print(f'[send_email_to_discord] Date: {date}')
-    print(f'[send_email_to_discord] Attachments: {len(attachments) if attachments else 0}')
-    print(f'[send_email_to_discord] Is spam: {is_spam}')
-    print(f'[send_email_to_discord] Email-to-Discord configured: {email_to_discord_configured}')
-    print(f'[send_email_to_discord] Client ready: {client.is_ready()}')
+                                 envelope_sender=None, recipients=None, domain=None, is_spam=False,
+                                 received_at=None, reply_to=None, target=None):
+    """Send email content to Discord channel based on subject line (or the already resolved target)"""
+    delivery_log.debug('Forwarding email from %s, subject %r, %s chars, %s attachment(s)',
+                       from_email, subject, len(body) if body else 0, len(attachments) if attachments else 0)
     
     if not email_to_discord_configured:
-        print(f'[send_email_to_discord] ERROR: Email-to-Discord not configured')
+        delivery_log.error('Email-to-Discord not configured')
         return
     
+    downloads = []
     try:
-        # Find channel from subject line
-        print(f'[send_email_to_discord] Looking for channel from subject: {subject}')
-        channel = find_channel_from_subject(subject)
+        channel, reply_message_id, reply_thread_id = target or resolve_inbound_target(subject, reply_to)
         
         if channel is None:
-            print(f'[send_email_to_discord] ERROR: Could not find Discord channel from subject \'{subject}\'')
+            delivery_log.error("Could not find Discord channel from subject '%s'", subject)
+            inbound_emails_total.inc(result="no_channel")
             return
         
-        print(f'[send_email_to_discord] Found channel: {channel.name} (ID: {channel.id})')
+        delivery_log.debug('Found channel: %s (ID: %s)', channel.name, channel.id)
         
         # Build plain text message
         message_parts = [body, "\n\n> sent from my email"]
         full_message = "".join(message_parts)
-        print(f'[send_email_to_discord] Full message length: {len(full_message)} chars')
+        delivery_log.debug('Full message length: %s chars', len(full_message))
+        
+        chunks = split_message(full_message)
+        delivery_log.debug('Split into %s chunk(s)', len(chunks))
         
-        # Get or create the "sophia" webhook
-        print(f'[send_email_to_discord] Getting/creating webhook for channel {channel.name}')
-        webhook = await get_or_create_sophia_webhook(channel)
+        # Webhooks cannot send Discord replies, so "reply" mode posts as the bot
+        reference = None
+        thread = None
+        if reply_message_id and reply_mode == "reply":
+            reference = discord.MessageReference(message_id=reply_message_id, channel_id=reply_thread_id or channel.id,
+                                                 fail_if_not_exists=False)
+            if reply_thread_id:
+                thread = await get_reply_thread(channel, reply_message_id, reply_thread_id)
+        elif reply_message_id:
+            thread = await get_reply_thread(channel, reply_message_id, reply_thread_id)
+        
+        # Get or create the "sophia" webhook while the attachments download
+        webhook_cached = str(channel.id) in webhook_cache
+        webhook, downloads = await asyncio.gather(
+            get_or_create_sophia_webhook(channel) if reference is None else asyncio.sleep(0),
+            download_attachments(attachments)
+        )
+        
+        # Files ride along with the last text chunk (Discord allows 10 per message); any extra go in follow-ups
+        files = [discord.File(fp, filename=filename) for filename, fp in downloads]
+        file_batches = [files[i:i + 10] for i in range(0, len(files), 10)] or [[]]
+        messages = [(chunk, []) for chunk in chunks[:-1]]
+        messages.append((chunks[-1] if chunks else None, file_batches[0]))
+        messages.extend((None, batch) for batch in file_batches[1:])
         
         if webhook:
-            print(f'[send_email_to_discord] Using webhook: {webhook.name} (ID: {webhook.id})')
-            print(f'[send_email_to_discord] Sending single message...')
-            # Override username and avatar for this message
-            await webhook.send(
-                content=full_message,
-                username="sophia",
-                avatar_url="https://cdn.discordapp.com/avatars/704038199776903209/58cc604300dfcd8348b09a26f37a1a1e.png"
-            )
-            print(f'[send_email_to_discord] Message sent successfully via webhook')
+            discord_sends_total.inc(path="webhook_cache" if webhook_cached else "webhook_lookup")
+            delivery_log.debug('Using webhook ID: %s', webhook.id)
+
+            async def post(chunk, batch):
+                nonlocal webhook
+                try:
+                    await send_sophia_webhook_message(webhook, chunk, batch, thread)
+                except discord.errors.NotFound:
+                    # Cached webhook was deleted; look it up (or recreate it) once and retry
+                    delivery_log.info('Webhook %s no longer exists, refreshing...', webhook.id)
+                    invalidate_webhook(channel.id)
+                    webhook = await get_or_create_sophia_webhook(channel)
+                    if webhook is None:
+                        raise
+                    for f in batch:
+                        f.reset()
+                    await send_sophia_webhook_message(webhook, chunk, batch, thread)
         else:
-            print(f'[send_email_to_discord] WARNING: Could not use webhook, sending as bot instead')
-            if len(full_message) > 2000:
-                print(f'[send_email_to_discord] Message too long, splitting into chunks (bot fallback)...')
-                chunks = []
-                current_chunk = ""
-                for line in full_message.split('\n'):
-                    if len(current_chunk) + len(line) + 1 <= 1900:
-                        current_chunk += line + '\n'
-                    else:
-                        if current_chunk:
-                            chunks.append(current_chunk.strip())
-                        current_chunk = line + '\n'
-                if current_chunk:
-                    chunks.append(current_chunk.strip())
-                print(f'[send_email_to_discord] Split into {len(chunks)} chunk(s)')
-                
-                print(f'[send_email_to_discord] Sending first chunk as bot ({len(chunks[0])} chars)...')
-                await channel.send(content=chunks[0])
-                for i, chunk in enumerate(chunks[1:], 1):
-                    print(f'[send_email_to_discord] Sending chunk {i+1}/{len(chunks)} as bot ({len(chunk)} chars)...')
-                    await channel.send(content=chunk)
-            else:
-                print(f'[send_email_to_discord] Sending single message as bot...')
-                await channel.send(content=full_message)
-            print(f'[send_email_to_discord] Message sent successfully as bot')
+            if reference is None:
+                delivery_log.warning('Could not use webhook, sending as bot instead')
+            discord_sends_total.inc(path="bot_fallback" if reference is None else "bot_reply")
+
+            async def post(chunk, batch):
+                nonlocal reference
+                kwargs = {"files": batch} if batch else {}
+                if reference is not None:
+                    kwargs["reference"] = reference
+                await (thread or channel).send(content=chunk, **kwargs)
+                reference = None  # Only the first message is the reply
         
-        print(f'[send_email_to_discord] Email from {from_email} forwarded to Discord channel {channel.name} (ID: {channel.id})')
+        # The dispatcher runs one email per channel at a time, so chunks go out back to back and emails never interleave
+        for chunk, batch in messages:
+            await pace_discord_post(channel.id)
+            try:
+                await post(chunk, batch)
+            except discord.HTTPException as e:
+                if not batch or isinstance(e, discord.NotFound):
+                    raise
+                # Usually a 413 (over the channel's upload limit) or a missing Attach Files permission: keep the text
+                delivery_log.warning('Could not upload %s file(s) to #%s, skipping them: %s %s',
+                                     len(batch), channel.name, e.status, e.text)
+                if chunk:
+                    await pace_discord_post(channel.id)
+                    await post(chunk, [])
+        
+        if reply_message_id:
+            delivery_log.info('Email reply from %s forwarded to Discord channel %s (ID: %s) under message %s',
+                              from_email, channel.name, channel.id, reply_message_id)
+        else:
+            delivery_log.info('Email from %s forwarded to Discord channel %s (ID: %s)', from_email, channel.name, channel.id)
+        inbound_emails_total.inc(result="delivered")
+        if received_at is not None:
+            inbound_delivery_seconds.observe(time.monotonic() - received_at)
     except Exception as e:
-        print(f'[send_email_to_discord] ERROR sending email to Discord: {type(e).__name__}: {e}')
-        import traceback
-        traceback.print_exc()
+        inbound_emails_total.inc(result="error")
+        delivery_log.exception('Error sending email to Discord: %s: %s', type(e).__name__, e)
         raise  # Re-raise so the future callback can catch it
+    finally:
+        for _, fp in downloads:
+            fp.close()
 
 @client.event
 async def on_message(message):
   if message.author.bot:
     return
-  # Check if message is in the specific guild
-  if message.guild and message.guild.id == 1405628370301091860:
-    print(message.content, message.channel.name, message.author.name)
+  # Threads are mirrored under their parent channel's route, so replies go back to the parent
+  channel = message.channel.parent if isinstance(message.channel, discord.Thread) else message.channel
+  recipient = outbound_routes.get(channel.id) if message.guild and channel else None
+  if recipient:
+    bot_log.debug('Message in #%s from %s: %s', message.channel.name, message.author.name, message.content)
 
     # Build a nicely formatted email
     timestamp = message.created_at.strftime("%Y-%m-%d %H:%M:%S UTC")
-    subject = f"[Discord] #{message.channel.name} - {message.author.name}"
+    subject = outbound_subject(channel.id, channel.name, message.author.name)
     email_message = (
       f"{message.content}\n"
       "-------------------\n"
@@ -312,13 +1702,18 @@ async def on_message(message):
       f"Link   : {message.jump_url}\n"
       "\n"
     )
-    await send_email(subject, email_message)
+    thread_id = message.channel.id if message.channel is not channel else None
+    reply_target = (channel.id, message.id, thread_id)
+    priority = channel.id in priority_channel_ids or any(role.id in priority_role_ids for role in getattr(message.author, "roles", ()))
+    if email_digest_enabled:
+      add_to_digest(channel, message.author.name, email_message, recipient, reply_target, priority)
+    else:
+      enqueue_email(subject, email_message, recipient, reply_target, priority)
   await client.process_commands(message)
 
 @client.event
 async def on_command_error(ctx, error):
-    print("ERROR:")
-    print(error)
+    bot_log.warning('Command error: %s', error)
     if isinstance(error, discord.ext.commands.UnexpectedQuoteError) or isinstance(error, discord.ext.commands.InvalidEndOfQuotedStringError):
         return await ctx.send("Sorry, it appears that your quotation marks are misaligned, and I can't read your query.")
     if isinstance(error, discord.ext.commands.ExpectedClosingQuoteError):
@@ -371,9 +1766,42 @@ async def on_command_error(ctx, error):
         return await ctx.send("Oops, there was a command error. Try again.")
     return
 
+class SnipeRecord:
+    """The parts of a deleted message that snipe displays"""
+    __slots__ = ("content", "author", "deleted_at")
+
+    def __init__(self, content, author, deleted_at):
+        self.content = content
+        self.author = author
+        self.deleted_at = deleted_at
+
+def prune_snipes(now):
+    """Drop channels whose newest snipe has expired, then the oldest snipes beyond the global cap"""
+    while client.snipes:
+        channel_id, history = next(iter(client.snipes.items()))
+        if history[-1].deleted_at > now - snipe_ttl:
+            break
+        client.snipe_count -= len(history)
+        del client.snipes[channel_id]
+    while client.snipe_count > snipe_max_entries:
+        channel_id, history = next(iter(client.snipes.items()))
+        history.popleft()
+        client.snipe_count -= 1
+        if not history:
+            del client.snipes[channel_id]
+
 @client.event
 async def on_message_delete(message):
-   client.snipes[message.channel.id] = message
+   now = time.monotonic()
+   history = client.snipes.get(message.channel.id)
+   if history is None:
+     history = client.snipes[message.channel.id] = deque(maxlen=snipe_history)
+   elif len(history) == history.maxlen:
+     client.snipe_count -= 1  # The deque drops its oldest entry
+   history.append(SnipeRecord(message.content, str(message.author), now))
+   client.snipe_count += 1
+   client.snipes.move_to_end(message.channel.id)
+   prune_snipes(now)
    return
 
 @client.command()
@@ -395,12 +1823,121 @@ async def nick(ctx, member: discord.Member, *, nick):
         colour=0x224B8B)
     await ctx.send(embed=embed) 
 
-@client.command()   
-async def purge(ctx, amount = 10000):
+# Channel ID -> asyncio.Event that cancels the purge running there
+client.purges = {}
+
+def parse_purge_time(argument):
+    """Parse a purge time bound (YYYY-MM-DD or ISO 8601, UTC unless given)"""
+    try:
+        moment = datetime.fromisoformat(argument)
+    except ValueError:
+        raise commands.BadArgument(f"Couldn't read the date {argument!r}, use YYYY-MM-DD or YYYY-MM-DDTHH:MM")
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+class PurgeFlags(commands.FlagConverter):
+    user: Optional[discord.User] = None
+    match: Optional[str] = None
+    after: Optional[parse_purge_time] = None
+    before: Optional[parse_purge_time] = None
+
+async def purge_messages(channel, amount, check, before=None, after=None, cancelled=None, progress=None):
+    """Delete up to amount messages matching check, newest first; returns (deleted, scanned)
+
+    Messages younger than 14 days go in bulk deletes of up to 100; older ones are deleted one at a
+    time. Only the current batch (plus discord.py's current page of history) is held in memory.
+    """
+    bulk_cutoff = discord.utils.utcnow() - timedelta(days=14) + timedelta(minutes=1)
+    batch = []
+    deleted = scanned = 0
+    if amount < 1:
+        return deleted, scanned
+
+    async def flush_batch():
+        nonlocal batch, deleted
+        if batch:
+            await channel.delete_messages(batch)
+            deleted += len(batch)
+            batch = []
+
+    async for message in channel.history(limit=None, before=before, after=after, oldest_first=False):
+        if cancelled is not None and cancelled.is_set():
+            break
+        scanned += 1
+        if not check(message):
+            continue
+        if message.created_at > bulk_cutoff:
+            batch.append(message)
+            if len(batch) == 100:
+                await flush_batch()
+        else:
+            await flush_batch()
+            try:
+                await message.delete()
+                deleted += 1
+            except discord.NotFound:
+                pass
+            await asyncio.sleep(purge_single_delete_delay)
+        if progress is not None:
+            await progress(deleted + len(batch), scanned)
+        if deleted + len(batch) >= amount:
+            break
+    await flush_batch()
+    return deleted, scanned
+
+@client.group(invoke_without_command=True)
+@commands.has_permissions(manage_messages=True)
+@commands.bot_has_permissions(manage_messages=True, read_message_history=True)
+async def purge(ctx, amount: Optional[int] = 10000, *, flags: PurgeFlags):
     await ctx.message.delete()
-    authorperms = ctx.author.permissions_in(ctx.channel)
-    if authorperms.manage_messages:
-      await ctx.channel.purge(limit=amount)
+    if ctx.channel.id in client.purges:
+      return await ctx.send("A purge is already running here. Use `soph purge cancel` to stop it.", delete_after=10)
+    if amount is not None and amount < 1:
+      raise commands.BadArgument("The amount must be at least 1")
+    pattern = None
+    if flags.match:
+      try:
+        pattern = re.compile(flags.match)
+      except re.error as e:
+        raise commands.BadArgument(f"Invalid match pattern: {e}")
+
+    status = await ctx.send(f"Purging up to {amount} message(s)...")
+    cancelled = client.purges[ctx.channel.id] = asyncio.Event()
+    last_update = time.monotonic()
+
+    def check(message):
+      if message.id == status.id:
+        return False
+      if flags.user and message.author.id != flags.user.id:
+        return False
+      if pattern and not pattern.search(message.content):
+        return False
+      return True
+
+    async def progress(deleted, scanned):
+      nonlocal last_update
+      if time.monotonic() - last_update >= purge_progress_interval:
+        last_update = time.monotonic()
+        await status.edit(content=f"Purging... deleted {deleted}, scanned {scanned}")
+
+    try:
+      deleted, scanned = await purge_messages(
+        ctx.channel, amount, check, before=flags.before, after=flags.after,
+        cancelled=cancelled, progress=progress
+      )
+    finally:
+      client.purges.pop(ctx.channel.id, None)
+    outcome = "Purge cancelled" if cancelled.is_set() else "Purge done"
+    bot_log.info('%s in #%s by %s: deleted %s, scanned %s', outcome, ctx.channel, ctx.author, deleted, scanned)
+    await status.edit(content=f":white_check_mark: | {outcome}: deleted {deleted} message(s), scanned {scanned}.", delete_after=10)
+
+@purge.command(name="cancel")
+@commands.has_permissions(manage_messages=True)
+async def purge_cancel(ctx):
+    cancelled = client.purges.get(ctx.channel.id)
+    if cancelled is None:
+      return await ctx.send("There's no purge running here.", delete_after=10)
+    cancelled.set()
+    await ctx.message.add_reaction("\N{OCTAGONAL SIGN}")
 
 @client.group(invoke_without_command=True)
 @commands.has_permissions(manage_messages=True)
@@ -411,15 +1948,21 @@ async def embed(ctx, *, text):
     await ctx.send(embed=embed)
 
 @client.command()
-async def snipe(ctx):
+async def snipe(ctx, index: int = 1):
     channel_id = ctx.channel.id
-    match = client.snipes.get(channel_id)
+    history = client.snipes.get(channel_id)
+    match = None
+    if history and 1 <= index <= len(history):
+      match = history[-index]
+      if match.deleted_at <= time.monotonic() - snipe_ttl:
+        match = None
     if match is None:
       await ctx.send(f"{ctx.author.name}, there's nothing to snipe!")
     else:
+      label = "Last Deleted Message" if index == 1 else f"Deleted Message #{index}"
       embed = discord.Embed(
         title=f'Snipe:',
-        description=f'**Last Deleted Message:** \n{match.content} \n - {match.author}', 
+        description=f'**{label}:** \n{match.content} \n - {match.author}', 
         color = discord.Color.purple()
       )
       embed.set_footer(text= f"Snipe requested by {ctx.author.name}")
@@ -432,198 +1975,937 @@ app = Flask(__name__)
 def home():
     return "Bot is running!"
 
-@app.route('/health', methods=['GET', 'HEAD'])
-def health():
-    return {"status": "ok", "bot": "online"}, 200
+@app.route('/livez', methods=['GET', 'HEAD'])
+def livez():
+    return {"status": "ok", "pid": os.getpid(), "uptime_seconds": round(time.monotonic() - process_started_at, 3)}, 200
+
+# Kept for existing uptime checks; same as /livez
+app.add_url_rule('/health', 'health', livez, methods=['GET', 'HEAD'])
+
+def probe_loop_lag(timeout):
+    """Seconds the bot loop takes to run a callback scheduled from another thread (None if it isn't running)"""
+    loop = bot_loop
+    if loop is None or not loop.is_running():
+        return None
+    done = threading.Event()
+    started = time.monotonic()
+    try:
+        loop.call_soon_threadsafe(done.set)
+    except RuntimeError:
+        return None  # Closed in the meantime
+    done.wait(timeout)
+    return time.monotonic() - started
+
+def probe_bot_leader(timeout=1.0):
+    """True if a leader answers on its socket (a killed leader leaves the socket file behind)"""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(bot_leader_socket_path)
+            sock.sendall(b"\n")
+            return sock.makefile("rb").readline().strip() == b"ok"
+    except OSError:
+        return False
+
+def readiness(loop_lag):
+    """Readiness report for /readyz given the measured bot loop lag; returns a (body, status) pair"""
+    report = {}
+    ready = True
+    if process_role == "ingest":
+        report["bot"] = "separate process"
+    elif bot_leader_election and not is_bot_leader:
+        # The bot runs in the leader worker; we only need to be able to reach it
+        ready = probe_bot_leader()
+        report["bot"] = "leader worker" if ready else "no leader"
+    else:
+        ws = client.ws
+        connected = bot_ready.is_set() and not client.is_closed() and ws is not None and ws.open
+        report["gateway"] = {"connected": connected, "latency_seconds": gateway_latency()}
+        report["loop_lag_seconds"] = None if loop_lag is None else round(loop_lag, 4)
+        ready = connected and loop_lag is not None and loop_lag < readyz_max_loop_lag
+    queues = {
+        "outbound_emails": email_queue.qsize() if email_queue is not None else 0,
+        "inbound_waiting_for_ready": len(pending_emails),
+        "inflight_discord_sends": inflight_discord_sends.value,
+    }
+    if inbound_queue_path:
+        try:
+            queues["inbound_queue"], lag = inbound_queue_stats()
+            queues["inbound_queue_lag_seconds"] = round(lag, 3)
+        except sqlite3.Error as e:
+            queues["inbound_queue"] = f"unavailable: {e}"
+            ready = False
+    report["queues"] = queues
+    report["status"] = "ready" if ready else "not ready"
+    return report, 200 if ready else 503
+
+@app.route('/debug/loop', methods=['GET'])
+def debug_loop():
+    return loop_report(), 200
+
+@app.route('/readyz', methods=['GET', 'HEAD'])
+def readyz():
+    return readiness(probe_loop_lag(readyz_max_loop_lag))
 
 @app.route('/test', methods=['GET', 'HEAD'])
 def test():
     return {"message": "Flask is working!", "app": "main"}, 200
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return render_metrics(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+def inbound_message_id(data):
+    """Maileroo's message_id, or the email's Message-Id header"""
+    message_id = data.get('message_id')
+    if not message_id:
+        header = (data.get('headers') or {}).get('Message-Id')
+        message_id = header[0] if isinstance(header, list) and header else header
+    return str(message_id).strip("<> ") if message_id else None
+
+def open_inbound_dedupe_db():
+    """Open the optional SQLite store behind the inbound dedupe index"""
+    global inbound_dedupe_db
+    if not inbound_dedupe_path or inbound_dedupe_db is not None:
+        return
+    inbound_dedupe_db = sqlite3.connect(inbound_dedupe_path, check_same_thread=False)
+    inbound_dedupe_db.execute("PRAGMA journal_mode=WAL")
+    inbound_dedupe_db.execute("PRAGMA synchronous=NORMAL")
+    inbound_dedupe_db.execute("CREATE TABLE IF NOT EXISTS inbound_seen (message_id TEXT PRIMARY KEY, seen_at REAL NOT NULL)")
+    inbound_dedupe_db.execute("CREATE INDEX IF NOT EXISTS inbound_seen_at ON inbound_seen (seen_at)")
+    inbound_dedupe_db.commit()
+
+def prune_inbound_dedupe_db(now):
+    """Drop expired rows and keep the table within inbound_dedupe_size rows"""
+    inbound_dedupe_db.execute("DELETE FROM inbound_seen WHERE seen_at < ?", (now - inbound_dedupe_ttl,))
+    inbound_dedupe_db.execute(
+        "DELETE FROM inbound_seen WHERE message_id IN ("
+        "SELECT message_id FROM inbound_seen ORDER BY seen_at DESC LIMIT -1 OFFSET ?)",
+        (inbound_dedupe_size,)
+    )
+
+def claim_inbound_message(message_id):
+    """Record message_id as seen; returns False if it was already seen within the TTL"""
+    global inbound_dedupe_inserts
+    now = time.time()
+    with inbound_seen_lock:
+        seen_at = inbound_seen.get(message_id)
+        if seen_at is not None and seen_at > now - inbound_dedupe_ttl:
+            return False
+        open_inbound_dedupe_db()
+        if inbound_dedupe_db is not None:
+            # One statement, so two processes claiming the same message cannot both win
+            with inbound_dedupe_db:
+                claimed = inbound_dedupe_db.execute(
+                    "INSERT INTO inbound_seen (message_id, seen_at) VALUES (?, ?) "
+                    "ON CONFLICT (message_id) DO UPDATE SET seen_at = excluded.seen_at WHERE seen_at <= ?",
+                    (message_id, now, now - inbound_dedupe_ttl)
+                ).rowcount
+                if not claimed:
+                    return False
+                inbound_dedupe_inserts += 1
+                if inbound_dedupe_inserts % 1000 == 0:
+                    prune_inbound_dedupe_db(now)
+        inbound_seen[message_id] = now
+        inbound_seen.move_to_end(message_id)
+        # Evict expired entries from the old end, and the oldest ones beyond the size cap
+        while inbound_seen:
+            oldest_id, oldest_at = next(iter(inbound_seen.items()))
+            if len(inbound_seen) <= inbound_dedupe_size and oldest_at > now - inbound_dedupe_ttl:
+                break
+            del inbound_seen[oldest_id]
+        return True
+
+def release_inbound_message(message_id):
+    """Forget message_id so a retry of an email we failed to accept is processed"""
+    with inbound_seen_lock:
+        inbound_seen.pop(message_id, None)
+        if inbound_dedupe_db is not None:
+            with inbound_dedupe_db:
+                inbound_dedupe_db.execute("DELETE FROM inbound_seen WHERE message_id = ?", (message_id,))
+
+# One token per match: comment, tag, doctype/processing instruction, text run, or a stray "<".
+# Tag bodies stop at the next "<" so unterminated tags cannot make the scan quadratic.
+HTML_TOKEN_PATTERN = re.compile(r'<!--.*?(?:-->|$)|<(/?)([a-zA-Z][a-zA-Z0-9]*)([^<>]*)>?|<[!?/][^<>]*>|[^<]+|<', re.S)
+HTML_HREF_PATTERN = re.compile(r'href\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'>]+))', re.I)
+HTML_RAW_END_PATTERNS = {tag: re.compile(rf'</{tag}\s*>', re.I) for tag in ("script", "style")}
+HTML_HIDDEN_TAGS = {"head", "title", "noscript", "template"}
+HTML_BLOCK_TAGS = {"p", "div", "table", "blockquote", "pre", "ul", "ol", "section", "article",
+                   "header", "footer", "h1", "h2", "h3", "h4", "h5", "h6", "hr"}
+HTML_LINE_TAGS = {"br", "li", "tr"}
+
+def html_to_text(html_body, max_chars=None):
+    """Convert an HTML email body to plain text in one pass, stopping once max_chars have been produced"""
+    if max_chars is None:
+        max_chars = html_body_max_chars
+    parts = []
+    length = 0
+    pending_breaks = 0  # Newlines owed before the next text
+    pending_space = False
+    hidden_depth = 0
+    pre_depth = 0
+    link_href = None
+    link_start = 0  # Index in parts where the current link's text starts
+
+    def emit(text):
+        nonlocal length, pending_breaks, pending_space
+        if length:
+            if pending_breaks:
+                text = "\n" * pending_breaks + text
+            elif pending_space and not parts[-1][-1:].isspace():
+                text = " " + text
+        pending_breaks = 0
+        pending_space = False
+        parts.append(text)
+        length += len(text)
+
+    pos = 0
+    end = len(html_body)
+    while pos < end and length < max_chars:
+        match = HTML_TOKEN_PATTERN.match(html_body, pos)
+        pos = match.end()
+        tag = match.group(2)
+        if tag:
+            tag = tag.lower()
+            closing = match.group(1)
+            if tag in HTML_RAW_END_PATTERNS:
+                if not closing:
+                    # Jump straight past the script/style body, whatever it contains
+                    raw_end = HTML_RAW_END_PATTERNS[tag].search(html_body, pos)
+                    pos = raw_end.end() if raw_end else end
+            elif tag in HTML_HIDDEN_TAGS:
+                hidden_depth = max(hidden_depth + (-1 if closing else 1), 0)
+            elif hidden_depth:
+                continue
+            elif tag in HTML_BLOCK_TAGS:
+                pending_breaks = max(pending_breaks, 2)
+                if tag == "pre":
+                    pre_depth = max(pre_depth + (-1 if closing else 1), 0)
+            elif tag in HTML_LINE_TAGS:
+                pending_breaks = max(pending_breaks, 1)
+                if tag == "li" and not closing:
+                    emit("• ")
+            elif tag == "a" and not closing:
+                href = HTML_HREF_PATTERN.search(match.group(3))
+                link_href = html.unescape(next(g for g in href.groups() if g is not None)) if href else None
+                link_start = len(parts)
+            elif tag == "a" and link_href:
+                link_text = "".join(parts[link_start:])
+                # Skip in-page anchors and links whose text already shows the target
+                if not link_href.startswith(("#", "javascript:")) and link_href not in link_text:
+                    pending_space = True
+                    emit(f"({link_href})")
+                link_href = None
+        elif match.group(0)[0] != "<" or match.group(0) == "<":
+            if hidden_depth:
+                continue
+            data = html.unescape(match.group(0))
+            if pre_depth:
+                emit(data)
+                continue
+            if data[:1].isspace():
+                pending_space = True
+            words = data.split()
+            if words:
+                emit(" ".join(words))
+                pending_space = data[-1:].isspace()
+
+    text = "".join(parts).strip()
+    if length >= max_chars and pos < end:
+        return text[:max_chars].rstrip() + "\n…"
+    return text
+
+def parse_email_webhook(data):
+    """Turn a Maileroo inbound webhook payload into send_email_to_discord arguments"""
+    received_at = time.monotonic()
+    # Parse Maileroo webhook payload
+    headers = data.get('headers', {})
+    
+    def get_header_value(header_name, default='Unknown'):
+        header_values = headers.get(header_name, [])
+        if isinstance(header_values, list) and len(header_values) > 0:
+            return header_values[0]
+        elif isinstance(header_values, str):
+            return header_values
+        return default
+    
+    from_header = get_header_value('From', 'Unknown')
+    subject_header = get_header_value('Subject', 'No Subject')
+    # Message-IDs this email replies to, nearest first: In-Reply-To, then References from newest to oldest
+    reply_to = get_header_value('In-Reply-To', '').split() + get_header_value('References', '').split()[::-1]
+    
+    # Extract email body
+    body_data = data.get('body', {})
+    body = body_data.get('stripped_plaintext') or body_data.get('plaintext', '')
+    
+    # If no plaintext, try HTML stripped version
+    if not body:
+        html_body = body_data.get('stripped_html') or body_data.get('html', '')
+        if html_body:
+            body = html_to_text(html_body)
+    
+    # Get date from processed_at timestamp
+    processed_at = data.get('processed_at')
+    date = processed_at if processed_at else None
+    
+    # Get attachments (ensure it's always a list, even if None)
+    attachments = data.get('attachments') or []
+    
+    # Get additional info
+    envelope_sender = data.get('envelope_sender', 'Unknown')
+    recipients = data.get('recipients', [])
+    domain = data.get('domain', 'Unknown')
+    is_spam = data.get('is_spam', False)
+    inbound_log.info('Processing email webhook: from=%s, subject=%s, %s chars, %s attachment(s), spam=%s',
+                     from_header, subject_header, len(body), len(attachments), is_spam)
+    
+    return dict(
+        from_email=from_header,
+        subject=subject_header,
+        body=body,
+        date=date,
+        attachments=attachments,
+        envelope_sender=envelope_sender,
+        recipients=recipients,
+        domain=domain,
+        is_spam=is_spam,
+        received_at=received_at,
+        reply_to=reply_to
+    )
+
+def open_inbound_queue():
+    """Open (or create) the SQLite inbound queue shared by ingestion and delivery processes"""
+    global inbound_queue_db
+    if inbound_queue_db is not None:
+        return inbound_queue_db
+    db = sqlite3.connect(inbound_queue_path, check_same_thread=False, timeout=10)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS inbound_queue ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, message_id TEXT UNIQUE, email TEXT NOT NULL, "
+        "enqueued_at REAL NOT NULL, claimed_by TEXT, claimed_at REAL, attempts INTEGER NOT NULL DEFAULT 0)"
+    )
+    # Older queues lack the attempts column
+    if "attempts" not in {row[1] for row in db.execute("PRAGMA table_info(inbound_queue)")}:
+        db.execute("ALTER TABLE inbound_queue ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+    db.commit()
+    inbound_queue_db = db
+    return db
+
+def enqueue_inbound_email(message_id, email_kwargs):
+    """Append a parsed inbound email to the durable queue; returns a (response, status) pair"""
+    email_kwargs = dict(email_kwargs)
+    email_kwargs.pop("received_at", None)  # Monotonic, so meaningless in another process; enqueued_at replaces it
+    with inbound_queue_lock:
+        db = open_inbound_queue()
+        with db:
+            cursor = db.execute(
+                "INSERT OR IGNORE INTO inbound_queue (message_id, email, enqueued_at) VALUES (?, ?, ?)",
+                (message_id, json.dumps(email_kwargs), time.time())
+            )
+    if not cursor.rowcount:
+        # Another ingestion process already queued it
+        inbound_log.info('Duplicate email %s already queued', message_id)
+        inbound_emails_total.inc(result="duplicate")
+        return {"status": "success", "message": "Duplicate email ignored"}, 200
+    inbound_emails_total.inc(result="queued")
+    return {"status": "accepted", "message": "Email queued for delivery"}, 202
+
+def inbound_queue_stats():
+    """Depth of the inbound queue and the age in seconds of its oldest email"""
+    with inbound_queue_lock:
+        depth, oldest = open_inbound_queue().execute(
+            "SELECT COUNT(*), MIN(enqueued_at) FROM inbound_queue"
+        ).fetchone()
+    return depth, (time.time() - oldest if oldest is not None else 0.0)
+
+Gauge("ytt_inbound_queue_depth", "Inbound emails waiting in the durable queue",
+      func=lambda: inbound_queue_stats()[0] if inbound_queue_path else None)
+Gauge("ytt_inbound_queue_lag_seconds", "Age of the oldest email in the durable inbound queue",
+      func=lambda: inbound_queue_stats()[1] if inbound_queue_path else None)
+
+def inbound_queue_owner():
+    """Lease holder name for rows this process claims"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def claim_inbound_emails(limit):
+    """Lease up to limit queued emails to this process, oldest first; expired leases are taken over"""
+    now = time.time()
+    with inbound_queue_lock:
+        db = open_inbound_queue()
+        # Check with a read first: the UPDATE takes the write lock even when nothing matches
+        if db.execute("SELECT 1 FROM inbound_queue WHERE claimed_at IS NULL OR claimed_at < ? LIMIT 1",
+                      (now - inbound_queue_lease,)).fetchone() is None:
+            return []
+        with db:
+            rows = db.execute(
+                "UPDATE inbound_queue SET claimed_by = ?, claimed_at = ? WHERE id IN ("
+                "SELECT id FROM inbound_queue WHERE claimed_at IS NULL OR claimed_at < ? ORDER BY id LIMIT ?"
+                ") RETURNING id, email, enqueued_at, attempts",
+                (inbound_queue_owner(), now, now - inbound_queue_lease, limit)
+            ).fetchall()
+    return sorted(rows)
+
+def finish_inbound_email(queue_id):
+    """Remove a delivered (or undeliverable) email from the queue"""
+    with inbound_queue_lock:
+        with inbound_queue_db:
+            inbound_queue_db.execute("DELETE FROM inbound_queue WHERE id = ?", (queue_id,))
+
+def retry_inbound_email(queue_id, attempts):
+    """Keep a failed email queued, leased until its retry is due so no consumer takes it sooner"""
+    delay = min(inbound_queue_retry_max, inbound_queue_retry_base * (2 ** (attempts - 1)))
+    delay = random.uniform(delay / 2, delay)
+    with inbound_queue_lock:
+        with inbound_queue_db:
+            inbound_queue_db.execute(
+                "UPDATE inbound_queue SET claimed_by = NULL, claimed_at = ?, attempts = ? WHERE id = ?",
+                (time.time() + delay - inbound_queue_lease, attempts, queue_id)
+            )
+    return delay
+
+async def deliver_queued_email(queue_id, email, enqueued_at, attempts=0):
+    """Send one queued email to Discord, then drop it from the queue; failed deliveries stay queued and are retried"""
+    email_kwargs = json.loads(email)
+    # Count the time spent queued in the delivery latency metric
+    email_kwargs["received_at"] = time.monotonic() - (time.time() - enqueued_at)
+    inflight_discord_sends.inc()
+    try:
+        await dispatch_inbound_email(email_kwargs)
+    except Exception as e:
+        attempts += 1
+        if inbound_queue_max_attempts and attempts >= inbound_queue_max_attempts:
+            inbound_log.exception('Giving up on queued email %s after %s attempt(s): %s: %s', queue_id, attempts, type(e).__name__, e)
+        else:
+            delay = await asyncio.to_thread(retry_inbound_email, queue_id, attempts)
+            inbound_log.warning('Error delivering queued email %s (attempt %s), retrying in %.0fs: %s: %s',
+                                queue_id, attempts, delay, type(e).__name__, e)
+            return
+    finally:
+        inflight_discord_sends.dec()
+    await asyncio.to_thread(finish_inbound_email, queue_id)
+
+async def consume_inbound_queue():
+    """Deliver emails from the durable queue to Discord, up to INBOUND_QUEUE_CONCURRENCY at a time"""
+    inbound_log.info('Consuming inbound queue at %s', inbound_queue_path)
+    inflight = set()
+    lag_warned_at = 0.0
+    while True:
+        # SQLite calls run in a thread: a write lock held by an ingest process must not stall the bot loop
+        free = inbound_queue_concurrency - len(inflight)
+        rows = await asyncio.to_thread(claim_inbound_emails, free) if free > 0 else []
+        for row in rows:
+            task = asyncio.create_task(deliver_queued_email(*row))
+            inflight.add(task)
+            task.add_done_callback(inflight.discard)
+        if rows:
+            _, lag = await asyncio.to_thread(inbound_queue_stats)
+            if lag > inbound_queue_lag_warn and time.monotonic() - lag_warned_at > 60:
+                lag_warned_at = time.monotonic()
+                inbound_log.warning('Inbound queue is behind: oldest email queued %.0fs ago', lag)
+            await asyncio.sleep(0)
+        elif inflight:
+            await asyncio.wait(inflight, timeout=inbound_queue_poll_interval, return_when=asyncio.FIRST_COMPLETED)
+        else:
+            await asyncio.sleep(inbound_queue_poll_interval)
+
+def start_inbound_queue_consumer():
+    """Start delivering from the durable queue on the bot loop (once; on_ready also runs on reconnects)"""
+    global inbound_queue_consumer
+    if not inbound_queue_path or process_role == "ingest":
+        return
+    if inbound_queue_consumer is None or inbound_queue_consumer.done():
+        open_inbound_queue()
+        inbound_queue_consumer = asyncio.create_task(consume_inbound_queue())
+
+async def stop_inbound_queue_consumer():
+    """Stop consuming and hand this process's unfinished leases back to the queue"""
+    global inbound_queue_consumer
+    if inbound_queue_consumer is None:
+        return
+    inbound_queue_consumer.cancel()
+    try:
+        await inbound_queue_consumer
+    except asyncio.CancelledError:
+        pass
+    inbound_queue_consumer = None
+    with inbound_queue_lock:
+        with inbound_queue_db:
+            released = inbound_queue_db.execute(
+                "UPDATE inbound_queue SET claimed_by = NULL, claimed_at = NULL WHERE claimed_by = ?", (inbound_queue_owner(),)
+            ).rowcount
+    if released:
+        inbound_log.info('Returned %s unfinished email(s) to the inbound queue', released)
+
+class InboundDispatcher:
+    """Delivers inbound emails in arrival order per Discord channel, with up to `concurrency` channels delivering at once"""
+
+    def __init__(self, concurrency):
+        self.slots = asyncio.Semaphore(max(1, concurrency))
+        self.lanes = {}  # Channel ID -> deque of (email_kwargs, target, future), the head being delivered
+        self.runners = set()
+
+    def submit(self, email_kwargs):
+        """Queue an email behind earlier ones for its channel; returns a future for its delivery"""
+        target = resolve_inbound_target(email_kwargs.get("subject"), email_kwargs.get("reply_to"))
+        key = target[0].id if target[0] is not None else None  # Unroutable emails share one lane; they fail fast
+        future = asyncio.get_running_loop().create_future()
+        lane = self.lanes.get(key)
+        if lane is None:
+            lane = self.lanes[key] = deque()
+            runner = asyncio.create_task(self.run_lane(key, lane))
+            self.runners.add(runner)
+            runner.add_done_callback(self.runners.discard)
+        lane.append((email_kwargs, target, future))
+        return future
+
+    async def run_lane(self, key, lane):
+        """Deliver a channel's emails one at a time, taking a slot for each so busy channels share fairly"""
+        try:
+            while lane:
+                email_kwargs, target, future = lane[0]
+                try:
+                    async with self.slots:
+                        result = await send_email_to_discord(**email_kwargs, target=target)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+                lane.popleft()
+        finally:
+            del self.lanes[key]
+            for _, _, future in lane:
+                future.cancel()
+
+    async def stop(self, drain_timeout=5):
+        """Give queued emails a moment to go out, then cancel the rest"""
+        if self.runners:
+            _, pending = await asyncio.wait(set(self.runners), timeout=drain_timeout)
+            if pending:
+                delivery_log.warning('%s channel(s) still had inbound emails after %ss; cancelling',
+                                     len(pending), drain_timeout)
+            for runner in pending:
+                runner.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+def get_inbound_dispatcher():
+    """Return the inbound dispatcher, creating it on the bot loop if needed"""
+    global inbound_dispatcher
+    if inbound_dispatcher is None:
+        inbound_dispatcher = InboundDispatcher(inbound_dispatch_concurrency)
+    return inbound_dispatcher
+
+async def dispatch_inbound_email(email_kwargs):
+    """Queue an inbound email on its channel's lane and wait until it has been delivered"""
+    return await get_inbound_dispatcher().submit(email_kwargs)
+
+async def stop_inbound_dispatcher():
+    global inbound_dispatcher
+    if inbound_dispatcher is not None:
+        await inbound_dispatcher.stop()
+        inbound_dispatcher = None
+
+def handle_discord_send_result(future):
+    """Done callback for a scheduled dispatch_inbound_email"""
+    inflight_discord_sends.dec()
+    try:
+        if future.exception():
+            raise future.exception()
+        result = future.result()
+        inbound_log.debug('Discord send completed, result: %s', result)
+    except Exception as e:
+        inbound_log.exception('Error in Discord send callback: %s: %s', type(e).__name__, e)
+
+def schedule_discord_send(email_kwargs):
+    """Queue an email on the bot loop's dispatcher (directly when already running on it)"""
+    # Tasks and threadsafe callbacks start in the order they were scheduled, so lanes see emails in arrival order
+    coro = dispatch_inbound_email(email_kwargs)
+    inflight_discord_sends.inc()
+    try:
+        running_loop = asyncio.get_running_loop()
+    except RuntimeError:
+        running_loop = None
+    if running_loop is not None and running_loop is bot_loop:
+        task = bot_loop.create_task(coro)
+        task.add_done_callback(handle_discord_send_result)
+        return task
+    try:
+        future = asyncio.run_coroutine_threadsafe(coro, bot_loop)
+    except Exception:
+        coro.close()
+        inflight_discord_sends.dec()
+        raise
+    future.add_done_callback(handle_discord_send_result)
+    return future
+
+def buffer_until_ready(email_kwargs):
+    """Hold an inbound email until on_ready if the bot is not ready; returns a response, or None when ready"""
+    with pending_emails_lock:
+        if bot_ready.is_set():
+            return None
+        if len(pending_emails) >= pending_emails_max:
+            inbound_log.error('Bot not ready and buffer full (%s)', len(pending_emails))
+            return {"status": "error", "message": "Bot not ready yet"}, 503
+        pending_emails.append(email_kwargs)
+        inbound_log.info('Bot not ready, buffered email (%s pending)', len(pending_emails))
+        return {"status": "accepted", "message": "Email queued until the bot is ready"}, 202
+
+def dedupe_and_forward(message_id, forward):
+    """Run forward() unless message_id was already accepted, releasing the claim if it fails; returns a (response, status) pair"""
+    # Maileroo retries slow deliveries; answer repeats before doing any work
+    if message_id and not claim_inbound_message(message_id):
+        inbound_log.info('Duplicate email %s ignored', message_id)
+        inbound_emails_total.inc(result="duplicate")
+        return {"status": "success", "message": "Duplicate email ignored"}, 200
+    try:
+        response = forward()
+    except Exception:
+        if message_id:
+            release_inbound_message(message_id)
+        raise
+    if message_id and response[1] >= 400:
+        release_inbound_message(message_id)  # Let Maileroo's retry through
+    return response
+
 @app.route('/email-webhook', methods=['POST'])
 def email_webhook():
     """Webhook endpoint for receiving emails from Maileroo Inbound Routing"""
-    print(f'[email_webhook] Received webhook request')
-    print(f'[email_webhook] Request method: {request.method}')
-    print(f'[email_webhook] Request headers: {dict(request.headers)}')
-    print(f'[email_webhook] Content-Type: {request.content_type}')
-    print(f'[email_webhook] Content-Length: {request.content_length}')
-    print(f'[email_webhook] Process ID: {os.getpid()}')
-    print(f'[email_webhook] Thread ID: {threading.get_ident()}')
+    inbound_log.debug('Received webhook request (%s, %s bytes)', request.content_type, request.content_length)
     
     try:
-        print(f'[email_webhook] Parsing JSON data...')
         data = request.get_json()
         
         if not data:
-            print(f'[email_webhook] ERROR: No data received')
+            inbound_log.error('No data received')
             return {"status": "error", "message": "No data received"}, 400
         
-        print(f'[email_webhook] Data keys: {list(data.keys())}')
-        
-        # Parse Maileroo webhook payload
-        headers = data.get('headers', {})
-        print(f'[email_webhook] Headers received: {list(headers.keys())}')
-        
-        def get_header_value(header_name, default='Unknown'):
-            header_values = headers.get(header_name, [])
-            if isinstance(header_values, list) and len(header_values) > 0:
-                return header_values[0]
-            elif isinstance(header_values, str):
-                return header_values
-            return default
-        
-        from_header = get_header_value('From', 'Unknown')
-        subject_header = get_header_value('Subject', 'No Subject')
-        print(f'[email_webhook] Extracted subject from webhook: \'{subject_header}\'')
-        print(f'[email_webhook] Extracted from: \'{from_header}\'')
-        
-        # Extract email body
-        body_data = data.get('body', {})
-        print(f'[email_webhook] Body data keys: {list(body_data.keys()) if isinstance(body_data, dict) else "Not a dict"}')
-        body = body_data.get('stripped_plaintext') or body_data.get('plaintext', '')
-        print(f'[email_webhook] Plaintext body length: {len(body)} chars')
-        
-        # If no plaintext, try HTML stripped version
-        if not body:
-            print(f'[email_webhook] No plaintext found, trying HTML...')
-            html_body = body_data.get('stripped_html') or body_data.get('html', '')
-            if html_body:
-                print(f'[email_webhook] Found HTML body ({len(html_body)} chars), stripping HTML...')
-                body = re.sub('<[^<]+?>', '', html_body)
-                print(f'[email_webhook] Stripped HTML body length: {len(body)} chars')
+        message_id = inbound_message_id(data)
+        if inbound_queue_path:
+            # Durable hand-off: the delivery side, possibly another process, picks it up
+            return dedupe_and_forward(message_id, lambda: enqueue_inbound_email(message_id, parse_email_webhook(data)))
+        if bot_leader_election and not is_bot_leader:
+            # Another worker runs the bot: parse here, deliver there
+            return forward_to_bot_leader(message_id, parse_email_webhook(data))
+        return dedupe_and_forward(message_id, lambda: forward_email_webhook(data))
+            
+    except Exception as e:
+        inbound_log.exception('Error processing email webhook: %s', e)
+        return {"status": "error", "message": str(e)}, 500
+
+def forward_email_webhook(data):
+    """Parse a webhook payload and hand it to the bot loop; returns a (response, status) pair"""
+    return hand_off_email(parse_email_webhook(data))
+
+def hand_off_email(email_kwargs):
+    """Hand a parsed inbound email to the bot loop; returns a (response, status) pair"""
+    # Forward to Discord asynchronously
+    if email_to_discord_configured:
+        if webhook_not_ready_mode == "buffer":
+            response = buffer_until_ready(email_kwargs)
+            if response:
+                return response
+        else:
+            # Wait for bot to be ready (wakes as soon as on_ready fires)
+            inbound_log.debug('Waiting for bot to be ready (max %ss)...', bot_ready_timeout)
+            if not bot_ready.wait(bot_ready_timeout):
+                inbound_log.error('Bot not ready after %ss', bot_ready_timeout)
+                return {"status": "error", "message": "Bot not ready yet"}, 503
         
-        # Get date from processed_at timestamp
-        processed_at = data.get('processed_at')
-        date = processed_at if processed_at else None
-        print(f'[email_webhook] Date: {date}')
+        try:
+            schedule_discord_send(email_kwargs)
+        except Exception as e:
+            inbound_log.exception('Error scheduling coroutine: %s: %s', type(e).__name__, e)
+            return {"status": "error", "message": f"Failed to schedule coroutine: {e}"}, 500
         
-        # Get attachments (ensure it's always a list, even if None)
-        attachments = data.get('attachments') or []
-        print(f'[email_webhook] Attachments: {len(attachments)}')
+        return {"status": "success", "message": "Email forwarded to Discord"}, 200
+    else:
+        inbound_log.error('Email-to-Discord not configured')
+        return {"status": "error", "message": "Email-to-Discord not configured"}, 400
+
+def forward_to_bot_leader(message_id, email_kwargs):
+    """Hand a parsed inbound email to the leader worker over its Unix socket; returns a (response, status) pair"""
+    payload = json.dumps({"message_id": message_id, "email": email_kwargs}).encode() + b"\n"
+    deadline = time.monotonic() + bot_ready_timeout
+    while True:
+        if is_bot_leader:
+            # We took over while waiting for a leader
+            return dedupe_and_forward(message_id, lambda: hand_off_email(email_kwargs))
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(bot_ready_timeout + 10)
+                sock.connect(bot_leader_socket_path)
+                sock.sendall(payload)
+                reply = json.loads(sock.makefile("rb").readline())
+                return reply["response"], reply["status"]
+        except (FileNotFoundError, ConnectionRefusedError):
+            # No leader yet, or leadership is changing hands
+            if time.monotonic() >= deadline:
+                inbound_log.error('No bot leader reachable after %ss', bot_ready_timeout)
+                return {"status": "error", "message": "Bot not ready yet"}, 503
+            time.sleep(0.2)
+
+class BotLeaderRequestHandler(socketserver.StreamRequestHandler):
+    """Accept one parsed inbound email from a follower worker and reply with the (response, status) pair"""
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line.strip():
+            self.wfile.write(b"ok\n")  # Readiness probe from a follower
+            return
+        try:
+            forwarded = json.loads(line)
+            response, status = dedupe_and_forward(forwarded["message_id"], lambda: hand_off_email(forwarded["email"]))
+        except Exception as e:
+            inbound_log.exception('Error handling email forwarded by a follower worker: %s', e)
+            response, status = {"status": "error", "message": str(e)}, 500
+        self.wfile.write(json.dumps({"response": response, "status": status}).encode() + b"\n")
+
+@app.errorhandler(404)
+def not_found(e):
+    return {"error": "Not Found", "message": "Route not found. Available routes: /, /livez, /readyz, /health, /test, /metrics, /debug/loop, /email-webhook"}, 404
+
+async def monitor_loop_lag():
+    """Sample how late a timer fires on this loop; a stall is reported when it ends"""
+    global loop_heartbeat, loop_current_stall
+    while True:
+        started = time.monotonic()
+        loop_heartbeat = started
+        await asyncio.sleep(loop_monitor_interval)
+        lag = max(time.monotonic() - started - loop_monitor_interval, 0.0)
+        loop_lag_samples.append(lag)
+        bot_loop_lag_seconds.observe(lag)
+        stall = loop_current_stall
+        if stall is not None:
+            loop_current_stall = None
+            stall["blocked_seconds"] = round(lag, 3)
+            bot_log.warning('Bot loop was blocked for %.2fs', lag)
+
+def watch_loop():
+    """Watchdog thread: while the monitored loop is blocked, capture what its thread is running"""
+    global loop_current_stall
+    reported = None  # Heartbeat of the stall already reported
+    while True:
+        time.sleep(min(loop_monitor_interval, loop_stall_threshold / 2))
+        heartbeat = loop_heartbeat
+        if heartbeat is None or loop_monitor is None or loop_monitor.done():
+            continue
+        blocked = time.monotonic() - heartbeat - loop_monitor_interval
+        if blocked < loop_stall_threshold or heartbeat == reported:
+            continue
+        reported = heartbeat
+        frame = sys._current_frames().get(loop_monitor_thread_id)
+        stack = "".join(traceback.format_stack(frame)) if frame is not None else "(thread not found)"
+        report = {
+            "at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "blocked_seconds": round(blocked, 3),  # So far; updated when the loop runs again
+            "stack": stack,
+        }
+        loop_stalls.append(report)
+        loop_current_stall = report
+        bot_loop_stalls_total.inc()
+        bot_log.warning('Bot loop blocked for %.2fs so far; bot thread is at:\n%s', blocked, stack)
+
+def start_loop_monitor():
+    """Start lag sampling on the running loop, and the watchdog thread (once per process)"""
+    global loop_monitor, loop_monitor_thread_id, loop_heartbeat, loop_watchdog
+    loop = asyncio.get_running_loop()
+    if loop_debug:
+        loop.set_debug(True)
+        loop.slow_callback_duration = loop_stall_threshold
+        logging.getLogger("asyncio").addHandler(logging.getLogger("ytt").handlers[0])
+    loop_monitor_thread_id = threading.get_ident()
+    loop_heartbeat = None
+    loop_monitor = loop.create_task(monitor_loop_lag())
+    if loop_watchdog is None:
+        loop_watchdog = threading.Thread(target=watch_loop, daemon=True, name="LoopWatchdog")
+        loop_watchdog.start()
+
+async def stop_loop_monitor():
+    """Cancel lag sampling; the watchdog thread idles until a monitor starts again"""
+    global loop_monitor
+    if loop_monitor is None:
+        return
+    loop_monitor.cancel()
+    try:
+        await loop_monitor
+    except asyncio.CancelledError:
+        pass
+    loop_monitor = None
+
+def loop_report():
+    """Recent bot loop lag and stall reports, for /debug/loop"""
+    samples = sorted(loop_lag_samples)
+    lag = None
+    if samples:
+        lag = {
+            "last": round(loop_lag_samples[-1], 4),
+            "p50": round(samples[len(samples) // 2], 4),
+            "p99": round(samples[min(len(samples) - 1, int(len(samples) * 0.99))], 4),
+            "max": round(samples[-1], 4),
+            "samples": len(samples),
+        }
+    return {
+        "monitoring": loop_monitor is not None and not loop_monitor.done(),
+        "interval_seconds": loop_monitor_interval,
+        "stall_threshold_seconds": loop_stall_threshold,
+        "lag_seconds": lag,
+        "stalls_total": bot_loop_stalls_total.values.get((), 0),
+        "recent_stalls": list(loop_stalls),
+    }
+
+async def start_client():
+    """Run the Discord client until it closes, then release everything the bot loop owns"""
+    start_loop_monitor()
+    try:
+        bot_log.info('Starting Discord client...')
+        await client.start(token)
+        bot_log.info('Discord client stopped')
+    except Exception as e:
+        bot_log.exception('Error in client.start(): %s: %s', type(e).__name__, e)
+        # Don't raise - we want the loop to keep running
+    finally:
+        bot_ready.clear()
+        await stop_inbound_queue_consumer()
+        await stop_inbound_dispatcher()
+        flush_all_digests()
+        await stop_email_workers()
+        await close_http_session()
+        await stop_loop_monitor()
+
+# Async web server mode: serve the same routes with aiohttp on the bot's own event loop
+def aio_view(view):
+    """Wrap a Flask-style view (str or (dict, status) result) as an aiohttp handler"""
+    async def handler(request):
+        result = view()
+        body, status, headers = (result + ({},))[:3] if isinstance(result, tuple) else (result, 200, {})
+        if isinstance(body, dict):
+            return web.json_response(body, status=status, headers=headers)
+        return web.Response(body=body.encode(), status=status, headers={"Content-Type": "text/plain; charset=utf-8", **headers})
+    return handler
+
+async def aio_not_found(request, handler):
+    try:
+        return await handler(request)
+    except web.HTTPNotFound:
+        body, status = not_found(None)
+        return web.json_response(body, status=status)
+
+async def aio_readyz(request):
+    """Async version of readyz: we are on the bot loop, so time how long a yield takes to come back"""
+    started = time.monotonic()
+    await asyncio.sleep(0)
+    body, status = readiness(time.monotonic() - started)
+    return web.json_response(body, status=status)
+
+async def aio_email_webhook(request):
+    """Async version of email_webhook: no thread hop, the send is a task on this loop"""
+    inbound_log.debug('Received webhook request (%s, %s bytes)', request.content_type, request.content_length)
+    message_id = None
+    try:
+        try:
+            data = await request.json()
+        except ValueError:
+            data = None
         
-        # Get additional info
-        envelope_sender = data.get('envelope_sender', 'Unknown')
-        recipients = data.get('recipients', [])
-        domain = data.get('domain', 'Unknown')
-        is_spam = data.get('is_spam', False)
-        print(f'[email_webhook] Envelope sender: {envelope_sender}')
-        print(f'[email_webhook] Recipients: {recipients}')
-        print(f'[email_webhook] Domain: {domain}')
-        print(f'[email_webhook] Is spam: {is_spam}')
+        if not data:
+            inbound_log.error('No data received')
+            return web.json_response({"status": "error", "message": "No data received"}, status=400)
         
-        print(f'[email_webhook] Processing email webhook: from={from_header}, subject={subject_header}')
+        message_id = inbound_message_id(data)
+        if message_id and not await aio_dedupe(claim_inbound_message, message_id):
+            inbound_log.info('Duplicate email %s ignored', message_id)
+            inbound_emails_total.inc(result="duplicate")
+            return web.json_response({"status": "success", "message": "Duplicate email ignored"}, status=200)
         
-        # Forward to Discord asynchronously
-        if email_to_discord_configured:
-            print(f'[email_webhook] Email-to-Discord is configured, forwarding...')
-            # Wait for bot to be ready
-            import time
-            max_wait = 15
-            waited = 0
-            print(f'[email_webhook] Waiting for bot to be ready (max {max_wait}s)...')
-            print(f'[email_webhook] Initial state: is_ready={client.is_ready()}, bot_loop={bot_loop}, loop_closed={bot_loop.is_closed() if bot_loop else "N/A"}')
-            
-            while waited < max_wait:
-                if client.is_ready() and bot_loop and not bot_loop.is_closed():
-                    print(f'[email_webhook] Bot is ready! (waited {waited}s)')
-                    break
-                time.sleep(0.5)
-                waited += 0.5
-                if waited % 2 == 0:  # Log every 2 seconds
-                    print(f'[email_webhook] Still waiting... ({waited}s) is_ready={client.is_ready()}, bot_loop={bot_loop is not None}, loop_closed={bot_loop.is_closed() if bot_loop else "N/A"}')
-            
-            if not client.is_ready() or not bot_loop or bot_loop.is_closed():
-                print(f'[email_webhook] ERROR: Bot not ready after {waited}s')
-                print(f'[email_webhook] DEBUG: is_ready={client.is_ready()}, bot_loop={bot_loop}, closed={bot_loop.is_closed() if bot_loop else "N/A"}')
-                return {"status": "error", "message": "Bot not ready yet"}, 503
-            
-            print(f'[email_webhook] Scheduling Discord send coroutine...')
-            print(f'[email_webhook] Creating coroutine function...')
-            
-            # Create the coroutine first to ensure it's valid
-            coro = send_email_to_discord(
-                from_email=from_header,
-                subject=subject_header,
-                body=body,
-                date=date,
-                attachments=attachments,
-                envelope_sender=envelope_sender,
-                recipients=recipients,
-                domain=domain,
-                is_spam=is_spam
-            )
-            print(f'[email_webhook] Coroutine created: {coro}')
-            print(f'[email_webhook] Scheduling coroutine with bot_loop: {bot_loop}')
-            print(f'[email_webhook] Bot loop running: {bot_loop.is_running() if bot_loop else "N/A"}')
-            print(f'[email_webhook] Bot loop closed: {bot_loop.is_closed() if bot_loop else "N/A"}')
-
-            # DEBUG: Test if the loop handles a simple print immediately
-            def debug_print():
-                print(f'[email_webhook] DEBUG: Loop is processing events! Time: {datetime.now()}')
-            
-            try:
-                bot_loop.call_soon_threadsafe(debug_print)
-                print(f'[email_webhook] DEBUG: Scheduled simple debug print')
-            except Exception as e:
-                print(f'[email_webhook] DEBUG: Failed to schedule debug print: {e}')
-            
-            # Schedule the coroutine using the bot's event loop
-            def handle_result(future):
-                print(f'[email_webhook] handle_result callback called')
-                print(f'[email_webhook] Future done: {future.done()}')
-                print(f'[email_webhook] Future cancelled: {future.cancelled()}')
-                try:
-                    if future.exception():
-                        print(f'[email_webhook] Future has exception: {future.exception()}')
-                        raise future.exception()
-                    result = future.result()
-                    print(f'[email_webhook] Discord send completed successfully, result: {result}')
-                except Exception as e:
-                    print(f'[email_webhook] ERROR in Discord send callback: {type(e).__name__}: {e}')
-                    import traceback
-                    traceback.print_exc()
-            
-            try:
-                future = asyncio.run_coroutine_threadsafe(coro, bot_loop)
-                print(f'[email_webhook] Coroutine scheduled, future: {future}')
-                print(f'[email_webhook] Future done: {future.done()}')
-                print(f'[email_webhook] Future cancelled: {future.cancelled()}')
-                future.add_done_callback(handle_result)
-                print(f'[email_webhook] Done callback added to future')
-            except Exception as e:
-                print(f'[email_webhook] ERROR scheduling coroutine: {type(e).__name__}: {e}')
-                import traceback
-                traceback.print_exc()
-                return {"status": "error", "message": f"Failed to schedule coroutine: {e}"}, 500
-            
-            print(f'[email_webhook] Email processing queued, returning success response')
-            return {"status": "success", "message": "Email forwarded to Discord"}, 200
+        if inbound_queue_path:
+            # SQLite write (and the lock the queue consumer's threads share): keep it off the bot loop
+            body, status = await asyncio.to_thread(enqueue_inbound_email, message_id, parse_email_webhook(data))
         else:
-            print(f'[email_webhook] ERROR: Email-to-Discord not configured')
-            return {"status": "error", "message": "Email-to-Discord not configured"}, 400
-            
+            body, status = await aio_forward_email_webhook(data)
+        if message_id and status >= 400:
+            await aio_dedupe(release_inbound_message, message_id)
+        return web.json_response(body, status=status)
     except Exception as e:
-        print(f'[email_webhook] ERROR processing email webhook: {e}')
-        import traceback
-        traceback.print_exc()
-        return {"status": "error", "message": str(e)}, 500
+        inbound_log.exception('Error processing email webhook: %s', e)
+        if message_id:
+            await aio_dedupe(release_inbound_message, message_id)
+        return web.json_response({"status": "error", "message": str(e)}, status=500)
 
-@app.errorhandler(404)
-def not_found(e):
-    return {"error": "Not Found", "message": "Route not found. Available routes: /, /health, /test, /email-webhook"}, 404
+async def aio_dedupe(func, message_id):
+    """Run a dedupe claim or release, in a worker thread when it writes to the shared SQLite store"""
+    if inbound_dedupe_path:
+        return await asyncio.to_thread(func, message_id)
+    return func(message_id)
+
+async def aio_forward_email_webhook(data):
+    """Async version of forward_email_webhook"""
+    email_kwargs = parse_email_webhook(data)
+    
+    if not email_to_discord_configured:
+        inbound_log.error('Email-to-Discord not configured')
+        return {"status": "error", "message": "Email-to-Discord not configured"}, 400
+    
+    if webhook_not_ready_mode == "buffer":
+        response = buffer_until_ready(email_kwargs)
+        if response:
+            return response
+    elif not bot_ready.is_set():
+        # Only during startup: wait for on_ready without blocking the loop
+        inbound_log.debug('Waiting for bot to be ready (max %ss)...', bot_ready_timeout)
+        ready = await asyncio.get_running_loop().run_in_executor(None, bot_ready.wait, bot_ready_timeout)
+        if not ready:
+            inbound_log.error('Bot not ready after %ss', bot_ready_timeout)
+            return {"status": "error", "message": "Bot not ready yet"}, 503
+    
+    schedule_discord_send(email_kwargs)
+    return {"status": "success", "message": "Email forwarded to Discord"}, 200
+
+async def aio_start_bot(aio_app):
+    """aiohttp startup hook: run the Discord client on the server's loop"""
+    global bot_loop
+    bot_loop = asyncio.get_running_loop()
+    if process_role == "ingest":
+        bot_log.info('Ingest-only process: the bot runs in a separate deliver process')
+    elif token:
+        aio_app["bot_task"] = bot_loop.create_task(start_client())
+    else:
+        bot_log.warning('No Discord token found, bot will not start')
+
+async def aio_stop_bot(aio_app):
+    """aiohttp cleanup hook: close the Discord client and wait for its cleanup"""
+    task = aio_app.get("bot_task")
+    if task is not None:
+        if not client.is_closed():
+            await client.close()
+        await task
+
+async def create_async_app():
+    """Build the aiohttp app (also usable as a gunicorn aiohttp.GunicornWebWorker app factory)"""
+    aio_app = web.Application(middlewares=[web.middleware(aio_not_found)])
+    aio_app.router.add_get('/', aio_view(home))
+    aio_app.router.add_get('/livez', aio_view(livez))
+    aio_app.router.add_get('/readyz', aio_readyz)
+    aio_app.router.add_get('/health', aio_view(livez))
+    aio_app.router.add_get('/test', aio_view(test))
+    aio_app.router.add_get('/metrics', aio_view(metrics))
+    aio_app.router.add_get('/debug/loop', aio_view(debug_loop))
+    aio_app.router.add_post('/email-webhook', aio_email_webhook)
+    aio_app.on_startup.append(aio_start_bot)
+    aio_app.on_cleanup.append(aio_stop_bot)
+    return aio_app
 
 def run_bot():
     """Run Discord bot in background thread"""
     global bot_loop
-    print(f'[run_bot] Starting Discord bot...')
-    print(f'[run_bot] Thread: {threading.current_thread().name}')
-    print(f'[run_bot] Token present: {bool(token)}')
+    bot_log.debug('Starting Discord bot in thread %s', threading.current_thread().name)
     
     loop = None
     try:
         if not token:
-            print("[run_bot] ERROR: Discord token not found, bot will not start")
+            bot_log.error('Discord token not found, bot will not start')
             return
         
         # Create a new event loop for this thread
@@ -631,65 +2913,135 @@ def run_bot():
         asyncio.set_event_loop(loop)
         bot_loop = loop
         
-        print(f'[run_bot] Event loop created: {loop}')
-        print(f'[run_bot] Bot loop stored globally: {bot_loop is not None}')
-        
-        # Create an async function to start the bot and handle errors
-        async def start_bot():
-            try:
-                print(f'[run_bot] Inside start_bot() coroutine')
-                print(f'[run_bot] Starting client.start(token)...')
-                await client.start(token)
-                print(f'[run_bot] client.start() completed (unexpected)')
-            except Exception as e:
-                print(f'[run_bot] ERROR in client.start(): {type(e).__name__}: {e}')
-                import traceback
-                traceback.print_exc()
-                # Don't raise - we want the loop to keep running
-
-
-        
         # Schedule client.start() as a task, then run the loop forever
         # This allows run_coroutine_threadsafe to work
-        print(f'[run_bot] Creating client.start() task...')
-        task = loop.create_task(start_bot())
-        print(f'[run_bot] client.start() task created: {task}')
-        print(f'[run_bot] Task done: {task.done()}, cancelled: {task.cancelled()}')
-        print(f'[run_bot] Running loop forever...')
+        loop.create_task(start_client())
+        bot_log.debug('Running bot loop forever...')
         loop.run_forever()
         
     except Exception as e:
-        print(f"[run_bot] ERROR starting Discord bot: {type(e).__name__}: {e}")
-        import traceback
-        traceback.print_exc()
+        bot_log.exception('Error starting Discord bot: %s: %s', type(e).__name__, e)
     finally:
         if loop and not loop.is_closed():
-            print(f'[run_bot] Closing event loop...')
+            bot_log.debug('Closing event loop...')
             loop.close()
 
+def run_deliver_process():
+    """Run only the bot and the inbound queue consumer in the foreground until SIGINT/SIGTERM"""
+    async def deliver():
+        global bot_loop
+        bot_loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            # Close cleanly so unfinished leases go back to the queue
+            bot_loop.add_signal_handler(signum, lambda: asyncio.ensure_future(client.close()))
+        await start_client()
+
+    if not token:
+        bot_log.error('Discord token not found, bot will not start')
+        return
+    asyncio.run(deliver())
+
 def start_bot_thread():
-    print(f'[start_bot_thread] Starting bot thread...')
-    print(f'[start_bot_thread] Process ID: {os.getpid()}')
-    print(f'[start_bot_thread] Thread ID: {threading.get_ident()}')
-    print(f'[start_bot_thread] Token present: {bool(token)}')
+    bot_log.debug('Starting bot thread (PID %s)...', os.getpid())
     if token:
         bot_thread = threading.Thread(target=run_bot, daemon=True, name="DiscordBot")
-        print(f'[start_bot_thread] Created thread: {bot_thread.name}')
         bot_thread.start()
-        print(f'[start_bot_thread] Thread started: {bot_thread.is_alive()}')
-        print(f'[start_bot_thread] Thread ID: {bot_thread.ident}')
+        bot_log.info('Bot thread started: %s (ID: %s)', bot_thread.name, bot_thread.ident)
     else:
-        print("[start_bot_thread] WARNING: No Discord token found, bot will not start")
+        bot_log.warning('No Discord token found, bot will not start')
+
+def stop_bot(timeout=10):
+    """Close the Discord client (and the shared HTTP session) from another thread"""
+    bot_log.info('Stopping Discord bot...')
+    if bot_loop is None or bot_loop.is_closed() or not bot_loop.is_running():
+        bot_log.debug('Bot loop not running, nothing to stop')
+        return
+    try:
+        future = asyncio.run_coroutine_threadsafe(client.close(), bot_loop)
+        future.result(timeout)
+        bot_log.info('Discord bot stopped')
+    except Exception as e:
+        bot_log.error('Error stopping Discord bot: %s: %s', type(e).__name__, e)
+
+def try_become_bot_leader():
+    """Take the leader lock without blocking; True if this worker now holds it"""
+    global bot_leader_lock_file
+    lock_file = open(bot_leader_lock_path, "a+")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    # The kernel drops the lock when this process exits, however it exits
+    lock_file.seek(0)
+    lock_file.truncate()
+    lock_file.write(str(os.getpid()))
+    lock_file.flush()
+    bot_leader_lock_file = lock_file
+    return True
+
+def start_bot_leader_server():
+    """Listen for inbound emails forwarded by follower workers"""
+    global bot_leader_server
+    try:
+        os.unlink(bot_leader_socket_path)  # Left behind by a previous leader; we hold the lock now
+    except FileNotFoundError:
+        pass
+    bot_leader_server = socketserver.ThreadingUnixStreamServer(bot_leader_socket_path, BotLeaderRequestHandler)
+    bot_leader_server.daemon_threads = True
+    threading.Thread(target=bot_leader_server.serve_forever, daemon=True, name="BotLeaderIPC").start()
+
+def run_bot_leader_election():
+    """Wait for the leader lock, then serve followers and run the bot in this worker"""
+    global is_bot_leader
+    while not try_become_bot_leader():
+        time.sleep(bot_leader_retry_interval)
+    bot_log.info('Worker %s is now the bot leader', os.getpid())
+    is_bot_leader = True
+    start_bot_leader_server()
+    start_bot_thread()
+
+def start_bot_leader_election():
+    """Run the bot in whichever gunicorn worker holds the leader lock; the rest forward inbound emails to it"""
+    global bot_leader_election
+    bot_leader_election = True
+    threading.Thread(target=run_bot_leader_election, daemon=True, name="BotLeaderElection").start()
+
+def stop_bot_leader():
+    """Stop the bot and give up leadership so another worker can take over"""
+    global is_bot_leader, bot_leader_lock_file
+    if not is_bot_leader:
+        return
+    stop_bot()
+    if bot_leader_server is not None:
+        bot_leader_server.shutdown()
+        bot_leader_server.server_close()
+    is_bot_leader = False
+    fcntl.flock(bot_leader_lock_file, fcntl.LOCK_UN)
+    bot_leader_lock_file.close()
+    bot_leader_lock_file = None
+    bot_log.info('Worker %s gave up bot leadership', os.getpid())
 
 # Start bot thread when module loads (but after Flask routes are registered)
 # MOVED: Now called by Gunicorn hook or __main__
 # start_bot_thread()
 
+# Everything is imported: hand PORT over to gunicorn's listeners or the server started below
+stop_early_livez()
+
 # For local development
 # Note: Deta automatically runs the app, so this is only for local testing
 if __name__ == "__main__":
     port = int(os.getenv('PORT', 8080))  # Deta uses 8080 by default
-    print(f"Starting Flask server on port {port}...")
-    # Start bot for local dev since Gunicorn hook won't run
-    start_bot_thread()
-    app.run(host='0.0.0.0', port=port, debug=False)
+    if process_role == "deliver":
+        bot_log.info('Starting deliver-only process (inbound queue at %s)...', inbound_queue_path)
+        run_deliver_process()
+    elif web_server_mode == "async":
+        bot_log.info('Starting async web server on port %s...', port)
+        web.run_app(create_async_app(), host='0.0.0.0', port=port)
+    else:
+        bot_log.info('Starting Flask server on port %s...', port)
+        # Start bot for local dev since Gunicorn hook won't run
+        if process_role != "ingest":
+            start_bot_thread()
+        app.run(host='0.0.0.0', port=port, debug=False)
@@ -1,131 +1,2000 @@
-#!/usr/bin/env python3
-"""
-Test script to simulate Maileroo webhook payload locally
-Run this while your bot is running to test the email webhook endpoint
-"""
-
-import requests
-import json
-import sys
-from datetime import datetime
-
-# Configuration
-WEBHOOK_URL = "http://localhost:8081/email-webhook"  # Change port if needed
-
-def test_email(channel_name="general"):
-    """Test sending an email reply to a Discord channel"""
-    
-    # Format subject like the bot sends: [Discord] #channel-name - author-name
-    subject = f"Re: [Discord] #{channel_name} - sophi_a"
-    
-    # Sample Maileroo webhook payload
-    payload = {
-        "_id": "677730adac1b7a32de362ccd",
-        "message_id": "test123@example.com",
-        "domain": "mail.maileroo.com",
-        "envelope_sender": "test@example.com",
-        "recipients": [
-            "bot@9b6d05a69dadf0d2.maileroo.org"
-        ],
-        "headers": {
-            "Content-Type": [
-                "text/plain; charset=UTF-8"
-            ],
-            "Date": [
-                datetime.now().strftime("%a, %d %b %Y %H:%M:%S %z")
-            ],
-            "From": [
-                "Sophia Wang <swang@student.fsaps.org>"
-            ],
-            "Message-Id": [
-                "<test123@example.com>"
-            ],
-            "Mime-Version": [
-                "1.0"
-            ],
-            "Subject": [
-                subject
-            ],
-            "To": [
-                "bot@9b6d05a69dadf0d2.maileroo.org"
-            ]
-        },
-        "body": {
-            "plaintext": "This is a test email reply! It should appear in the #{} channel with the 'sophia' webhook.\n\nTesting the email-to-Discord forwarding feature.".format(channel_name),
-            "stripped_plaintext": "This is a test email reply! It should appear in the #{} channel with the 'sophia' webhook.\n\nTesting the email-to-Discord forwarding feature.".format(channel_name),
-            "html": "<p>This is a test email reply!</p>",
-            "stripped_html": "<p>This is a test email reply!</p>",
-            "other_parts": None,
-            "raw_mime": {
-                "url": "https://example.com/raw.mime",
-                "size": 1024
-            }
-        },
-        "attachments": [],
-        "spf_result": "pass",
-        "dkim_result": True,
-        "is_dmarc_aligned": True,
-        "is_spam": False,
-        "deletion_url": "https://inbound-api.maileroo.net/email/test123/delete",
-        "validation_url": "https://inbound-api.maileroo.net/validate-callback/test123/validation",
-        "processed_at": int(datetime.now().timestamp())
-    }
-    
-    print(f"🧪 Testing email webhook...")
-    print(f"   URL: {WEBHOOK_URL}")
-    print(f"   Subject: {subject}")
-    print(f"   Expected Channel: #{channel_name}")
-    print()
-    
-    try:
-        response = requests.post(
-            WEBHOOK_URL,
-            json=payload,
-            headers={"Content-Type": "application/json"},
-            timeout=15
-        )
-        
-        print(f"📊 Response Status: {response.status_code}")
-        try:
-            response_data = response.json()
-            print(f"📊 Response Body: {json.dumps(response_data, indent=2)}")
-        except:
-            print(f"📊 Response Body: {response.text}")
-        
-        if response.status_code == 200:
-            print(f"\n✅ SUCCESS! Check your Discord #{channel_name} channel.")
-            print(f"   The message should appear from the 'sophia' webhook with '*sent from my email'")
-        elif response.status_code == 503:
-            print(f"\n⚠️  Bot not ready yet. Wait a few seconds and try again.")
-        else:
-            print(f"\n❌ ERROR: Received status code {response.status_code}")
-            
-    except requests.exceptions.ConnectionError:
-        print(f"\n❌ ERROR: Could not connect to {WEBHOOK_URL}")
-        print("   Make sure your bot is running: python main.py")
-    except requests.exceptions.Timeout:
-        print(f"\n⏱️  Timeout: Request took too long")
-    except Exception as e:
-        print(f"\n❌ ERROR: {e}")
-        import traceback
-        traceback.print_exc()
-
-if __name__ == "__main__":
-    # Get channel name from command line or use default
-    channel = "test"
-    
-    print("=" * 60)
-    print("Email Webhook Test Script")
-    print("=" * 60)
-    print()
-    print("This script simulates a Maileroo webhook for testing.")
-    print()
-    
-    test_email(channel)
-    
-    print()
-    print("=" * 60)
-    if len(sys.argv) == 1:
-        print("Usage: python test_webhook.py [channel-name]")
-        print("Example: python test_webhook.py general")
-        print("=" * 60)
+#!/usr/bin/env python3
+"""
+Test script to simulate Maileroo webhook payload locally
+Run this while your bot is running to test the email webhook endpoint
+
+`python test_webhook.py load` instead runs an offline load test: it starts local
+stand-ins for Discord (REST + gateway) and Maileroo, launches main.py against them,
+fires webhook payloads at a target rate and writes latency/throughput results as JSON.
+
+`python test_webhook.py bench <name>` runs one focused benchmark against local stubs or fixtures:
+  maileroo-session   per-send latency to a Maileroo stub, pooled session vs one session per send
+  channels           inbound channel lookup over a large guild: linear scan vs the name index and miss cache
+  split              a 50 KB email: old bot-fallback split loop vs split_message, then chunked delivery to several channels
+  web-modes          the load test under gunicorn with one worker, Flask (sync) vs WEB_SERVER_MODE=async
+  logging            per-request cost of the webhook's logging at LOG_LEVEL=WARNING, INFO and DEBUG
+  snipes             memory held by the snipe store after deletions across many channels
+  html               a ~2.7 MB newsletter body: the old tag-stripping regex vs html_to_text, capped and uncapped
+  startup            import time of main.py and its heavy dependencies, and process spawn to the first /livez
+Digest mode is measured by the load test: `load -n 0 --outbound 1000 --mail-rate 0 --mail-channel-rate 0`,
+once as is and once with `--digest-window 1`, reports Maileroo calls per 1,000 chat messages.
+"""
+
+import requests
+import json
+import sys
+import argparse
+import asyncio
+import os
+import re
+import signal
+import socket
+import subprocess
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+import aiohttp
+from aiohttp import web
+
+# Configuration
+WEBHOOK_URL = "http://localhost:8081/email-webhook"  # Change port if needed
+
+def build_payload(channel_name, message_id="test123@example.com", body=None, channel_id=None):
+    """Build a Maileroo inbound webhook payload replying to a Discord channel"""
+    # Format subject like the bot sends: [Discord] #channel-name (channel-id) - author-name
+    if channel_id is None:
+        subject = f"Re: [Discord] #{channel_name} - sophi_a"
+    else:
+        subject = f"Re: [Discord] #{channel_name} ({channel_id}) - sophi_a"
+    if body is None:
+        body = "This is a test email reply! It should appear in the #{} channel with the 'sophia' webhook.\n\nTesting the email-to-Discord forwarding feature.".format(channel_name)
+
+    # Sample Maileroo webhook payload
+    return {
+        "_id": "677730adac1b7a32de362ccd",
+        "message_id": message_id,
+        "domain": "mail.maileroo.com",
+        "envelope_sender": "test@example.com",
+        "recipients": [
+            "bot@9b6d05a69dadf0d2.maileroo.org"
+        ],
+        "headers": {
+            "Content-Type": [
+                "text/plain; charset=UTF-8"
+            ],
+            "Date": [
+                datetime.now().strftime("%a, %d %b %Y %H:%M:%S %z")
+            ],
+            "From": [
+                "Sophia Wang <swang@student.fsaps.org>"
+            ],
+            "Message-Id": [
+                f"<{message_id}>"
+            ],
+            "Mime-Version": [
+                "1.0"
+            ],
+            "Subject": [
+                subject
+            ],
+            "To": [
+                "bot@9b6d05a69dadf0d2.maileroo.org"
+            ]
+        },
+        "body": {
+            "plaintext": body,
+            "stripped_plaintext": body,
+            "html": "<p>This is a test email reply!</p>",
+            "stripped_html": "<p>This is a test email reply!</p>",
+            "other_parts": None,
+            "raw_mime": {
+                "url": "https://example.com/raw.mime",
+                "size": 1024
+            }
+        },
+        "attachments": [],
+        "spf_result": "pass",
+        "dkim_result": True,
+        "is_dmarc_aligned": True,
+        "is_spam": False,
+        "deletion_url": "https://inbound-api.maileroo.net/email/test123/delete",
+        "validation_url": "https://inbound-api.maileroo.net/validate-callback/test123/validation",
+        "processed_at": int(datetime.now().timestamp())
+    }
+
+def test_email(channel_name="general"):
+    """Test sending an email reply to a Discord channel"""
+
+    payload = build_payload(channel_name)
+    subject = payload["headers"]["Subject"][0]
+
+    print(f"🧪 Testing email webhook...")
+    print(f"   URL: {WEBHOOK_URL}")
+    print(f"   Subject: {subject}")
+    print(f"   Expected Channel: #{channel_name}")
+    print()
+
+    try:
+        response = requests.post(
+            WEBHOOK_URL,
+            json=payload,
+            headers={"Content-Type": "application/json"},
+            timeout=15
+        )
+
+        print(f"📊 Response Status: {response.status_code}")
+        try:
+            response_data = response.json()
+            print(f"📊 Response Body: {json.dumps(response_data, indent=2)}")
+        except:
+            print(f"📊 Response Body: {response.text}")
+
+        if response.status_code == 200:
+            print(f"\n✅ SUCCESS! Check your Discord #{channel_name} channel.")
+            print(f"   The message should appear from the 'sophia' webhook with '*sent from my email'")
+        elif response.status_code == 503:
+            print(f"\n⚠️  Bot not ready yet. Wait a few seconds and try again.")
+        else:
+            print(f"\n❌ ERROR: Received status code {response.status_code}")
+
+    except requests.exceptions.ConnectionError:
+        print(f"\n❌ ERROR: Could not connect to {WEBHOOK_URL}")
+        print("   Make sure your bot is running: python main.py")
+    except requests.exceptions.Timeout:
+        print(f"\n⏱️  Timeout: Request took too long")
+    except Exception as e:
+        print(f"\n❌ ERROR: {e}")
+        import traceback
+        traceback.print_exc()
+
+def test_webhook_waits_for_the_bot_or_buffers(monkeypatch):
+    """Before on_ready, "wait" mode answers 503 after BOT_READY_TIMEOUT; "buffer" mode accepts and replays on ready"""
+    import main
+    import threading
+
+    monkeypatch.setattr(main, "bot_ready", threading.Event())
+    monkeypatch.setattr(main, "bot_ready_timeout", 0.2)
+    monkeypatch.setattr(main, "email_to_discord_configured", True)
+    monkeypatch.setattr(main, "inbound_queue_path", "")
+    monkeypatch.setattr(main, "bot_leader_election", False)
+    monkeypatch.setattr(main, "inbound_seen", main.OrderedDict())
+    monkeypatch.setattr(main, "inbound_dedupe_path", "")
+    monkeypatch.setattr(main, "pending_emails", [])
+    monkeypatch.setattr(main, "pending_emails_max", 2)
+    scheduled = []
+    monkeypatch.setattr(main, "schedule_discord_send", lambda email_kwargs: scheduled.append(email_kwargs["body"]))
+    client = main.app.test_client()
+    post = lambda tag: client.post("/email-webhook", json=build_payload("general", message_id=f"{tag}@example.com", body=tag))
+
+    monkeypatch.setattr(main, "webhook_not_ready_mode", "wait")
+    started = time.monotonic()
+    response = post("waited")
+    assert response.status_code == 503 and time.monotonic() - started >= 0.2 and scheduled == []
+
+    monkeypatch.setattr(main, "webhook_not_ready_mode", "buffer")
+    assert [post(tag).status_code for tag in ("first", "second", "third")] == [202, 202, 503]  # PENDING_EMAILS_MAX
+    assert scheduled == []
+    main.open_readiness_gate()  # What on_ready does once the gateway is up
+    assert scheduled == ["first", "second"] and main.pending_emails == []
+    assert post("waited").status_code == 200 and scheduled[-1] == "waited"  # The 503 released its message ID for the retry
+
+def test_webhook_cache_is_private(monkeypatch, tmp_path):
+    """The webhook cache holds tokens, so it is written owner-only even under umask 0"""
+    import stat
+    import main
+
+    path = tmp_path / "webhooks.json"
+    monkeypatch.setattr(main, "webhook_cache_path", str(path))
+    monkeypatch.setattr(main, "webhook_cache", {"11": {"id": 1, "token": "secret", "url": "https://example.invalid"}})
+    old_umask = os.umask(0)
+    try:
+        main.save_webhook_cache()
+    finally:
+        os.umask(old_umask)
+    assert stat.S_IMODE(path.stat().st_mode) == 0o600
+    main.load_webhook_cache()
+    assert main.webhook_cache["11"]["token"] == "secret"
+
+def test_webhook_cache_skips_lookups_and_recovers_from_deleted_webhooks(monkeypatch, tmp_path):
+    """A cached webhook is used without listing the channel's webhooks; a 404 refreshes it and retries once,
+    and a webhooks update event drops the channel's entry"""
+    from types import SimpleNamespace
+    import discord
+    import main
+
+    monkeypatch.setattr(main, "webhook_cache_path", str(tmp_path / "webhooks.json"))
+    monkeypatch.setattr(main, "webhook_cache", {"11": {"id": 2, "token": "live", "url": "https://example.invalid/2"}})
+    monkeypatch.setattr(main, "email_to_discord_configured", True)
+    monkeypatch.setattr(main.client.http, "_HTTPClient__session", object())  # Set at login; Webhook.partial needs one
+    posts = []
+
+    async def send(webhook, content, files=None, thread=None):
+        if webhook.id == 1:
+            raise discord.NotFound(SimpleNamespace(status=404, reason="Not Found"), {"code": 10015, "message": "Unknown Webhook"})
+        posts.append((webhook.id, content))
+
+    monkeypatch.setattr(main, "send_sophia_webhook_message", send)
+
+    class FakeChannel:
+        id = 11
+        name = "general"
+        lookups = 0
+
+        async def webhooks(self):
+            self.lookups += 1
+            return [SimpleNamespace(id=2, name="sophia", token="live", url="https://example.invalid/2")]
+
+        async def create_webhook(self, **kwargs):
+            raise AssertionError("the existing webhook should be found")
+
+    channel = FakeChannel()
+    deliver = lambda: asyncio.run(main.send_email_to_discord("a@example.com", "subject", "hello", target=(channel, None, None)))
+    deliver()
+    assert channel.lookups == 0 and posts == [(2, "hello\n\n> sent from my email")]
+
+    main.webhook_cache["11"] = {"id": 1, "token": "deleted", "url": "https://example.invalid/1"}
+    deliver()
+    assert channel.lookups == 1 and posts[-1][0] == 2 and len(posts) == 2  # Looked up once, sent once more
+    assert main.webhook_cache["11"]["id"] == 2
+    with open(main.webhook_cache_path) as f:
+        assert json.load(f)["11"]["id"] == 2
+
+    asyncio.run(main.on_webhooks_update(channel))
+    assert "11" not in main.webhook_cache
+
+def test_split_message_keeps_chunks_and_code_blocks_intact():
+    """Chunks fit Discord's limit, split at line ends, and only code blocks left open are carried over"""
+    import main
+
+    prose = "\n".join(f"line {i} " + "word " * 20 for i in range(60))
+    assert main.split_message("short") == ["short"]
+    chunks = main.split_message(prose)
+    assert len(chunks) > 1 and all(len(chunk) <= main.DISCORD_MESSAGE_LIMIT for chunk in chunks)
+    assert "\n".join(chunks) == prose
+
+    # A block left open is closed at the end of each chunk and re-opened with its language
+    code = "```python\n" + "\n".join(f"x = {i}" for i in range(1000)) + "\n```\nafter"
+    chunks = main.split_message(code)
+    assert len(chunks) > 1 and all(len(chunk) <= main.DISCORD_MESSAGE_LIMIT for chunk in chunks)
+    assert all(chunk.count("```") % 2 == 0 for chunk in chunks)
+    assert all(chunk.startswith("```python\n") for chunk in chunks)
+    assert chunks[-1].endswith("```\nafter")
+
+    # A one-line block opens and closes on the same line, so later chunks are plain text
+    chunks = main.split_message("```pip install foo```\n" + prose)
+    assert not any("```" in chunk for chunk in chunks[1:])
+
+    # An over-long opening fence is re-opened as a bare fence rather than repeated in every chunk
+    chunks = main.split_message("```" + "x" * 1900 + "\n" + prose)
+    assert len(chunks) <= 6
+    assert all(chunk.startswith("```\n") for chunk in chunks[1:])
+
+    # A line longer than a chunk is hard-split, at spaces when it has any
+    line = "y" * 5_000_000
+    chunks = main.split_message(line)
+    assert len(chunks) == 2500 and "".join(chunks) == line
+    chunks = main.split_message("word " * 1000)
+    assert all(len(chunk) <= main.DISCORD_MESSAGE_LIMIT and not chunk.startswith(" ") for chunk in chunks)
+    assert " ".join(chunks).split() == ["word"] * 1000
+
+def test_send_email_reuses_one_pooled_session(monkeypatch):
+    """Sends share one keep-alive session until it is closed on shutdown"""
+    import main
+
+    async def scenario():
+        stub = MailerooStub()
+        runner, port = await start_site(stub.app())
+        monkeypatch.setattr(main, "maileroo_api_url", f"http://127.0.0.1:{port}/api/v2/emails")
+        monkeypatch.setattr(main, "email_configured", True)
+        try:
+            assert await main.send_email("first", "hello")
+            session = main.http_session
+            assert await main.send_email("second", "hello")
+            assert main.http_session is session and stub.requests == 2
+            assert len(session.connector._conns) == 1  # The connection went back to the pool for reuse
+        finally:
+            await main.close_http_session()
+            await runner.cleanup()
+        assert session.closed and main.http_session is None
+
+    asyncio.run(scenario())
+
+def test_email_queue_drop_policy_and_workers(monkeypatch, tmp_path):
+    """A full send queue defers the oldest (or newest) email to the outbox; EMAIL_QUEUE_WORKERS senders drain it"""
+    import main
+
+    monkeypatch.setattr(main, "outbox_path", str(tmp_path / "outbox.db"))
+    monkeypatch.setattr(main, "outbox_db", None)
+    monkeypatch.setattr(main, "outbox_pending", [])
+    monkeypatch.setattr(main, "outbox_inflight", set())
+    monkeypatch.setattr(main, "email_queue", None)
+    monkeypatch.setattr(main, "email_workers", [])
+    monkeypatch.setattr(main, "outbox_retrier", None)
+    monkeypatch.setattr(main, "email_configured", True)
+    monkeypatch.setattr(main, "email_queue_size", 2)
+    monkeypatch.setattr(main, "email_queue_workers", 3)
+    monkeypatch.setattr(main.email_queue_deferred_total, "values", {})
+    sent = []
+
+    async def send_email(subject, message_content, recipient=None, message_id=None):
+        sent.append(subject)
+        return True
+
+    monkeypatch.setattr(main, "send_email", send_email)
+
+    async def scenario():
+        main.open_outbox()
+        main.email_queue = main.EmailScheduler(main.email_queue_size, 0, 1)
+        monkeypatch.setattr(main, "email_queue_drop_policy", "drop_oldest")
+        assert all(main.enqueue_email(subject, "body") for subject in ("a", "b", "c"))
+        monkeypatch.setattr(main, "email_queue_drop_policy", "drop_newest")
+        assert not main.enqueue_email("d", "body")
+        assert main.email_queue.qsize() == 2
+        assert main.email_queue_deferred_total.values == {("oldest",): 1, ("newest",): 1}
+        deferred = {row[0] for row in main.outbox_db.execute("SELECT subject FROM outbox")} - {"b", "c"}
+        assert deferred == {"a", "d"} and len(main.outbox_inflight) == 2  # Still in the outbox for the retrier
+        main.start_email_workers()
+        assert len(main.email_workers) == 3
+        deadline = time.monotonic() + 5
+        while len(sent) < 4 and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        await main.stop_email_workers()
+
+    asyncio.run(scenario())
+    assert sent[:2] == ["b", "c"] and sorted(sent[2:]) == ["a", "d"]  # The deferred ones come back through the retrier
+
+def test_digest_coalesces_messages_per_channel(monkeypatch):
+    """Messages in a channel become one email when the size limit or the window is reached, under the usual subject"""
+    from types import SimpleNamespace
+    import main
+
+    sent = []
+    monkeypatch.setattr(main, "enqueue_email", lambda subject, body, *args: sent.append((subject, body)))
+    monkeypatch.setattr(main, "email_digest_window", 0.05)
+    monkeypatch.setattr(main, "email_digest_max_messages", 3)
+    monkeypatch.setattr(main, "email_digests", {})
+    general, random_channel = SimpleNamespace(id=11, name="general"), SimpleNamespace(id=12, name="random")
+
+    async def scenario():
+        for n, author in enumerate(("ann", "bob", "ann", "cy")):
+            main.add_to_digest(general, author, f"<{n}>")
+        main.add_to_digest(random_channel, "dee", "<r>")
+        assert sent == [(main.outbound_subject(11, "general", "ann, bob"), "<0><1><2>")]
+        await asyncio.sleep(0.1)  # The window closes the rest
+
+    asyncio.run(scenario())
+    assert sorted(sent[1:]) == [(main.outbound_subject(11, "general", "cy"), "<3>"), (main.outbound_subject(12, "random", "dee"), "<r>")]
+    assert main.SUBJECT_CHANNEL_PATTERN.search(sent[0][0]).groups() == ("general", "11")
+
+def test_outbox_keeps_failed_sends_with_backoff(monkeypatch, tmp_path):
+    """Sent emails leave the outbox; failed ones stay with a growing retry delay until OUTBOX_MAX_ATTEMPTS"""
+    import main
+
+    monkeypatch.setattr(main, "outbox_path", str(tmp_path / "outbox.db"))
+    monkeypatch.setattr(main, "outbox_db", None)
+    monkeypatch.setattr(main, "outbox_pending", [])
+    monkeypatch.setattr(main, "outbox_max_attempts", 3)
+    db = main.open_outbox()
+    try:
+        sent, failed = main.outbox_add("sent", "body"), main.outbox_add("failed", "body")
+        main.outbox_record_result(sent, True)
+        main.outbox_record_result(failed, False)
+        main.outbox_flush()
+        attempts, next_attempt = db.execute("SELECT attempts, next_attempt FROM outbox WHERE id = ?", (failed,)).fetchone()
+        assert db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0] == 1
+        assert attempts == 1 and 0 < next_attempt - time.time() <= main.outbox_backoff_base
+        for _ in range(2):
+            main.outbox_record_result(failed, False)
+        main.outbox_flush()
+        assert db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0] == 0  # Gave up on the third failure
+    finally:
+        db.close()
+    delays = [main.outbox_backoff(attempts) for attempts in (1, 2, 3, 30)]
+    assert delays[0] <= main.outbox_backoff_base < delays[2] and delays[3] <= main.outbox_backoff_max
+
+def test_attachment_downloads_only_from_maileroo():
+    """Attachment URLs from the unauthenticated webhook are only fetched over https from Maileroo's hosts"""
+    import main
+
+    assert main.attachment_url_allowed("https://inbound-api.maileroo.net/attachments/1/report.pdf")
+    assert main.attachment_url_allowed("https://maileroo.com/a.png")
+    for url in ("http://inbound-api.maileroo.net/a.pdf", "https://169.254.169.254/latest/meta-data/",
+                "https://maileroo.net.evil.example/a.pdf", "https://evilmaileroo.com/a.pdf",
+                "https://user@inbound-api.maileroo.net/a.pdf", "file:///etc/passwd", "not a url"):
+        assert not main.attachment_url_allowed(url), url
+
+    class NoSession:
+        def get(self, *args, **kwargs):
+            raise AssertionError("refused URLs must not be fetched")
+
+    attachment = {"filename": "creds.txt", "url": "http://127.0.0.1:8080/admin"}
+    assert asyncio.run(main.download_attachment(NoSession(), attachment, {"used": 0})) is None
+
+def test_attachment_downloads_stream_within_the_size_caps(monkeypatch):
+    """Against a local file server: over-cap files are skipped, the per-email budget holds across concurrent
+    downloads, and files past ATTACHMENT_SPOOL_BYTES spill to disk"""
+    import main
+
+    monkeypatch.setattr(main, "attachment_http_hosts", ["127.0.0.1"])
+    monkeypatch.setattr(main, "attachment_max_bytes", 300_000)
+    monkeypatch.setattr(main, "attachment_max_total_bytes", 500_000)
+    monkeypatch.setattr(main, "attachment_spool_bytes", 100_000)
+    assert not main.attachment_url_allowed("http://inbound-api.maileroo.net/a.pdf")  # http only for the listed hosts
+    requested = Counter()
+
+    async def serve_file(request):
+        name = request.match_info["name"]
+        requested[name] = requested[name] + 1
+        response = web.StreamResponse()  # No Content-Length: the cap has to hold while streaming
+        await response.prepare(request)
+        for _ in range(int(request.query["kb"]) // 20):
+            await response.write(b"x" * 20_000)
+            await asyncio.sleep(0)  # Let concurrent downloads interleave
+        return response
+
+    async def scenario():
+        file_server = web.Application()
+        file_server.router.add_get("/files/{name}", serve_file)
+        runner, port = await start_site(file_server)
+        url = lambda name, kb: f"http://127.0.0.1:{port}/files/{name}?kb={kb}"
+        try:
+            async with aiohttp.ClientSession() as session:
+                budget = {"used": 0}
+                small = await main.download_attachment(session, {"filename": "small.txt", "url": url("small", 40)}, budget)
+                large = await main.download_attachment(session, {"filename": "large.bin", "url": url("large", 200)}, budget)
+                declared = {"filename": "declared.bin", "url": url("declared", 400), "size": 400_000}
+                assert await main.download_attachment(session, declared, {"used": 0}) is None
+                assert await main.download_attachment(session, {"filename": "huge.bin", "url": url("huge", 400)}, {"used": 0}) is None
+                garbled = {"filename": "garbled.txt", "url": url("garbled", 20), "size": {"bytes": "lots"}}
+                assert (await main.download_attachment(session, garbled, {"used": 0}))[1].read() == b"x" * 20_000
+                budget = {"used": 0}
+                shared = await asyncio.gather(*(main.download_attachment(session, {"filename": f"{i}.bin", "url": url(f"part{i}", 200)}, budget)
+                                                 for i in range(3)))
+        finally:
+            await runner.cleanup()
+        return small, large, shared, budget
+
+    small, large, shared, budget = asyncio.run(scenario())
+    try:
+        assert small[0] == "small.txt" and len(small[1].read()) == 40_000 and not small[1]._rolled
+        assert len(large[1].read()) == 200_000 and large[1]._rolled  # Spilled to a temp file
+        assert "declared" not in requested  # Skipped on its declared size, before any request
+        assert requested["huge"] == 1  # Fetched, then dropped once it passed ATTACHMENT_MAX_BYTES
+        assert sum(result is not None for result in shared) == 2 and budget["used"] == 400_000
+    finally:
+        for result in [small, large, *shared]:
+            if result is not None:
+                result[1].close()
+
+def test_failed_upload_still_posts_the_text(monkeypatch):
+    """When Discord rejects the files (413), the email text is posted without them"""
+    import io
+    from types import SimpleNamespace
+    import discord
+    import main
+
+    posts = []
+
+    class FakeWebhook:
+        id = 1
+
+        async def send(self, content=None, files=None, **kwargs):
+            if files:
+                raise discord.HTTPException(SimpleNamespace(status=413, reason="Payload Too Large"),
+                                            {"code": 40005, "message": "Request entity too large"})
+            posts.append(content)
+
+    async def fake_webhook(channel):
+        return FakeWebhook()
+
+    async def fake_downloads(attachments):
+        return [("big.bin", io.BytesIO(b"x"))]
+
+    monkeypatch.setattr(main, "email_to_discord_configured", True)
+    monkeypatch.setattr(main, "get_or_create_sophia_webhook", fake_webhook)
+    monkeypatch.setattr(main, "download_attachments", fake_downloads)
+    channel = SimpleNamespace(id=11, name="general")
+    asyncio.run(main.send_email_to_discord("a@example.com", "subject", "hello", attachments=[{}],
+                                           target=(channel, None, None)))
+    assert posts == ["hello\n\n> sent from my email"]
+
+def test_metrics_render_prometheus_text(monkeypatch):
+    """Counters, gauges and histograms render in Prometheus text format on /metrics, label values escaped"""
+    import main
+
+    monkeypatch.setattr(main, "METRICS", [])
+    requests_total = main.Counter("t_requests_total", "Requests", ("status",))
+    inflight = main.Gauge("t_inflight", "In flight")
+    latency = main.Histogram("t_seconds", "Latency", buckets=(0.1, 1))
+    requests_total.inc(status="200")
+    requests_total.inc(2, status='4"9')
+    inflight.inc()
+    for seconds in (0.05, 0.5, 5):
+        latency.observe(seconds)
+    response = main.app.test_client().get("/metrics")
+    assert response.status_code == 200 and response.content_type.startswith("text/plain; version=0.0.4")
+    lines = response.get_data(as_text=True).splitlines()
+    assert lines[:4] == ["# HELP t_requests_total Requests", "# TYPE t_requests_total counter",
+                         't_requests_total{status="200"} 1', 't_requests_total{status="4\\"9"} 2']
+    assert "t_inflight 1" in lines
+    assert lines[-5:] == ['t_seconds_bucket{le="0.1"} 1', 't_seconds_bucket{le="1"} 2', 't_seconds_bucket{le="+Inf"} 3',
+                          "t_seconds_sum 5.55", "t_seconds_count 3"]
+
+def test_inbound_dedupe_expires_and_caps_message_ids(monkeypatch, tmp_path):
+    """Repeats within the TTL are refused; memory keeps the newest INBOUND_DEDUPE_SIZE IDs, the shared store the rest"""
+    import main
+    from collections import OrderedDict
+
+    monkeypatch.setattr(main, "inbound_seen", OrderedDict())
+    monkeypatch.setattr(main, "inbound_dedupe_size", 3)
+    monkeypatch.setattr(main, "inbound_dedupe_ttl", 60)
+    monkeypatch.setattr(main, "inbound_dedupe_path", str(tmp_path / "dedupe.db"))
+    monkeypatch.setattr(main, "inbound_dedupe_db", None)
+    try:
+        assert main.claim_inbound_message("a") and not main.claim_inbound_message("a")
+        main.release_inbound_message("a")
+        assert main.claim_inbound_message("a")  # A released ID (failed hand-off) can be retried
+        assert all(main.claim_inbound_message(message_id) for message_id in "bcd")
+        assert list(main.inbound_seen) == ["b", "c", "d"]  # "a" was evicted from memory...
+        assert not main.claim_inbound_message("a")  # ...but another process would still see it in SQLite
+        expired = time.time() - 61
+        main.inbound_seen["b"] = expired
+        with main.inbound_dedupe_db:
+            main.inbound_dedupe_db.execute("UPDATE inbound_seen SET seen_at = ? WHERE message_id = 'b'", (expired,))
+        assert main.claim_inbound_message("b") and not main.claim_inbound_message("c")
+    finally:
+        main.inbound_dedupe_db.close()
+
+def test_snipe_history_is_bounded_per_channel_and_overall(monkeypatch):
+    """Each channel keeps its last SNIPE_HISTORY deletions; expired channels and the oldest beyond the cap are pruned"""
+    import main
+    from collections import OrderedDict
+    from types import SimpleNamespace
+
+    monkeypatch.setattr(main.client, "snipes", OrderedDict())
+    monkeypatch.setattr(main.client, "snipe_count", 0)
+    monkeypatch.setattr(main, "snipe_history", 2)
+    monkeypatch.setattr(main, "snipe_max_entries", 5)
+    monkeypatch.setattr(main, "snipe_ttl", 60)
+
+    def delete(channel_id, content):
+        asyncio.run(main.on_message_delete(SimpleNamespace(channel=SimpleNamespace(id=channel_id), content=content, author="user#0001")))
+
+    for i in range(3):
+        delete(1, f"one-{i}")
+    assert [record.content for record in main.client.snipes[1]] == ["one-1", "one-2"] and main.client.snipe_count == 2
+    for channel_id in (2, 3):
+        delete(channel_id, f"{channel_id}-a")
+        delete(channel_id, f"{channel_id}-b")
+    assert main.client.snipe_count == 5 and [record.content for record in main.client.snipes[1]] == ["one-2"]
+    assert list(main.client.snipes) == [1, 2, 3]  # Least recently active channel first
+    for record in main.client.snipes[1]:
+        record.deleted_at -= 61
+    main.prune_snipes(time.monotonic())
+    assert list(main.client.snipes) == [2, 3] and main.client.snipe_count == 4
+    assert sum(len(history) for history in main.client.snipes.values()) == main.client.snipe_count
+
+def test_purge_bulk_deletes_recent_messages_and_singles_old_ones(monkeypatch):
+    """Recent matches go in bulk deletes of at most 100, older ones one by one; amount and cancel stop the scan"""
+    import main
+    from datetime import timedelta
+    from types import SimpleNamespace
+
+    monkeypatch.setattr(main, "purge_single_delete_delay", 0)
+    now = main.discord.utils.utcnow()
+
+    class FakeChannel:
+        def __init__(self, recent, old):
+            self.singles = []
+            self.bulk = []
+            self.messages = [self.message(i, now - timedelta(minutes=i)) for i in range(recent)]
+            self.messages += [self.message(recent + i, now - timedelta(days=20 + i)) for i in range(old)]
+
+        def message(self, i, created_at):
+            async def delete():
+                self.singles.append(i)
+            return SimpleNamespace(id=i, author_id=i % 2, created_at=created_at, delete=delete)
+
+        async def history(self, limit=None, before=None, after=None, oldest_first=False):
+            for message in self.messages:
+                yield message
+
+        async def delete_messages(self, messages):
+            assert len(messages) <= 100
+            self.bulk.append([message.id for message in messages])
+
+    channel = FakeChannel(recent=300, old=6)
+    deleted, scanned = asyncio.run(main.purge_messages(channel, 1000, lambda message: message.author_id == 0))
+    assert (deleted, scanned) == (153, 306)
+    assert [len(batch) for batch in channel.bulk] == [100, 50] and channel.singles == [300, 302, 304]
+
+    channel = FakeChannel(recent=300, old=0)
+    assert asyncio.run(main.purge_messages(channel, 0, lambda message: True)) == (0, 0) and channel.bulk == []
+    assert asyncio.run(main.purge_messages(channel, 120, lambda message: True)) == (120, 120)
+    assert [len(batch) for batch in channel.bulk] == [100, 20]
+
+    async def cancelled_purge():
+        cancelled = asyncio.Event()
+
+        async def progress(deleted, scanned):
+            if scanned == 10:
+                cancelled.set()  # What "soph purge cancel" does
+
+        return await main.purge_messages(channel, 1000, lambda message: True, cancelled=cancelled, progress=progress)
+
+    channel = FakeChannel(recent=300, old=0)
+    assert asyncio.run(cancelled_purge()) == (10, 10) and channel.bulk == [list(range(10))]
+
+def test_html_to_text_keeps_structure_and_drops_scripts():
+    """Entities decoded, script/style/head dropped, paragraph and list breaks and link targets kept, long bodies cut"""
+    import main
+
+    html_body = """<html><head><title>T</title><style>p{color:red}</style></head><body>
+<p>Hello &amp; welcome,<br>second   line</p><script>alert('<b>x</b>')</script>
+<ul><li>One</li><li> Two <a href="https://x.com/a">link</a></li></ul>
+<div>See <a href="https://e.com">https://e.com</a> &lt;tag&gt;</div><pre>a  b
+  c</pre>tail</body></html>"""
+    assert main.html_to_text(html_body) == ("Hello & welcome,\nsecond line\n\n• One\n• Two link (https://x.com/a)\n\n"
+                                            "See https://e.com <tag>\n\na  b\n  c\n\ntail")
+    assert main.html_to_text(html_body, max_chars=20) == "Hello & welcome,\nsec\n…"
+    assert main.html_to_text("<p>unterminated <a" * 5000).startswith("unterminated")
+
+def test_loop_watchdog_reports_blocking_call():
+    """Block a monitored loop on purpose and check the watchdog reports it with the blocking frame"""
+    import threading
+    import main
+
+    def block_the_loop():
+        time.sleep(main.loop_stall_threshold * 3)
+
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        asyncio.run_coroutine_threadsafe(asyncio.sleep(0), loop).result(5)
+        loop.call_soon_threadsafe(main.start_loop_monitor)
+        time.sleep(main.loop_monitor_interval * 2)
+        stalls_before = len(main.loop_stalls)
+        loop.call_soon_threadsafe(block_the_loop)
+        deadline = time.monotonic() + main.loop_stall_threshold * 6
+        while len(main.loop_stalls) == stalls_before and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert len(main.loop_stalls) > stalls_before, "watchdog did not report the blocked loop"
+        stall = main.loop_stalls[-1]
+        assert "block_the_loop" in stall["stack"]
+        # Once the loop runs again the report gets the full stall length
+        time.sleep(main.loop_stall_threshold * 3)
+        assert stall["blocked_seconds"] >= main.loop_stall_threshold * 2
+        assert main.loop_report()["stalls_total"] >= 1
+    finally:
+        asyncio.run_coroutine_threadsafe(main.stop_loop_monitor(), loop).result(5)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(5)
+        loop.close()
+
+def test_livez_uptime_restarts_in_forked_workers(monkeypatch):
+    """With preload_app, workers fork from the master: /livez reports each worker's own uptime"""
+    import main
+
+    monkeypatch.setattr(main, "process_started_at", main.process_started_at - 60)  # As if the master imported main.py a minute ago
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.write(write_end, json.dumps(main.livez()[0]).encode())
+        os._exit(0)
+    os.close(write_end)
+    os.waitpid(pid, 0)
+    with os.fdopen(read_end) as f:
+        child = json.load(f)
+    assert child["pid"] == pid and child["uptime_seconds"] < 5
+    assert main.livez()[0]["uptime_seconds"] >= 60
+
+def test_early_livez_answers_while_main_is_importing():
+    """The bare socket server that holds PORT during the heavy imports: alive on /livez, 503 elsewhere"""
+    import main
+
+    port = free_port()
+    server = main.start_early_livez(port)
+    try:
+        assert main.start_early_livez(port) is None  # Port taken (a gunicorn worker without preload_app)
+        response = requests.get(f"http://127.0.0.1:{port}/livez?verbose=1", timeout=5)
+        assert response.status_code == 200 and response.json()["pid"] == os.getpid()
+        assert requests.get(f"http://127.0.0.1:{port}/readyz", timeout=5).status_code == 503
+        head = requests.head(f"http://127.0.0.1:{port}/health", timeout=5)
+        assert head.status_code == 200 and head.content == b""
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_follower_readiness_probes_the_leader(monkeypatch):
+    """Followers are ready only while a leader answers on the socket, not just while its file exists"""
+    import shutil
+    import socketserver
+    import threading
+    import main
+
+    workdir = tempfile.mkdtemp()  # Short path: Unix socket paths are limited to ~100 bytes
+    path = os.path.join(workdir, "bot-leader.sock")
+    monkeypatch.setattr(main, "bot_leader_socket_path", path)
+    monkeypatch.setattr(main, "bot_leader_election", True)
+    monkeypatch.setattr(main, "is_bot_leader", False)
+    try:
+        # A SIGKILLed leader leaves its socket file behind
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(path)
+        stale.close()
+        assert os.path.exists(path) and not main.probe_bot_leader()
+        assert main.readiness(None)[1] == 503
+
+        os.unlink(path)
+        server = socketserver.ThreadingUnixStreamServer(path, main.BotLeaderRequestHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            assert main.probe_bot_leader()
+            assert main.readiness(None)[1] == 200
+        finally:
+            server.shutdown()
+            server.server_close()
+    finally:
+        shutil.rmtree(workdir)
+
+def test_routing_table_maps_both_directions(monkeypatch):
+    """Expand guild and channel routes over fake channels and check both lookup directions"""
+    from types import SimpleNamespace
+    import main
+
+    guild_routes, channel_routes = main.parse_routes([
+        {"guild": 1, "to": "club@example.com"},
+        {"channel": 12, "to": "board@example.com"},
+        {"channel": 13, "outbound": False},
+        {"guild": 2, "inbound": False, "to": "other@example.com"},
+    ])
+    monkeypatch.setattr(main, "guild_routes", guild_routes)
+    monkeypatch.setattr(main, "channel_routes", channel_routes)
+    for table in ("outbound_routes", "inbound_routes", "channel_index"):
+        monkeypatch.setattr(main, table, {})
+    club, other, unrouted = SimpleNamespace(id=1), SimpleNamespace(id=2), SimpleNamespace(id=3)
+    channels = [SimpleNamespace(id=channel_id, name=f"chat-{channel_id}", guild=guild)
+                for channel_id, guild in ((11, club), (12, club), (13, club), (21, other), (31, unrouted))]
+    for channel in channels:
+        main.route_channel(channel)
+
+    assert main.outbound_routes == {11: "club@example.com", 12: "board@example.com", 21: "other@example.com"}
+    assert set(main.inbound_routes) == {"11", "12", "13"}
+    reply = "Re: " + main.outbound_subject(12, "chat-12", "sophi_a")
+    assert main.lookup_channel_from_subject(reply) is channels[1]
+    # The channel ID wins over the name, and unrouted IDs are not looked up by name
+    assert main.lookup_channel_from_subject("Re: [Discord] #chat-11 (12) - sophi_a") is channels[1]
+    assert main.lookup_channel_from_subject("Re: [Discord] #chat-21 (21) - sophi_a") is None
+    # Subjects sent before channel IDs were added still route by name
+    assert main.lookup_channel_from_subject("Re: [Discord] #chat-13 - sophi_a") is channels[2]
+
+def test_channel_lookup_caches_misses_until_channels_change(monkeypatch):
+    """A subject that matched nothing is answered from the miss cache until a channel is created or renamed"""
+    from types import SimpleNamespace
+    import main
+
+    monkeypatch.setattr(main, "guild_routes", {1: {"to": None, "outbound": False, "inbound": True}})
+    monkeypatch.setattr(main, "channel_routes", {})
+    monkeypatch.setattr(main, "discord_channel_id", None)
+    for table in ("outbound_routes", "inbound_routes", "channel_index"):
+        monkeypatch.setattr(main, table, {})
+    monkeypatch.setattr(main, "channel_miss_cache", main.OrderedDict())
+    cached_misses = lambda: main.channel_resolution_total.values.get(("miss_cached",), 0)
+    subject = "Re: [Discord] #ai-news - sophi_a"
+
+    assert main.find_channel_from_subject(subject) is None
+    before = cached_misses()
+    assert main.find_channel_from_subject(subject) is None
+    assert cached_misses() == before + 1
+    news = SimpleNamespace(id=5, name="ai-news", guild=SimpleNamespace(id=1))
+    main.route_channel(news)  # What on_guild_channel_create does; it clears the miss cache
+    assert main.find_channel_from_subject(subject) is news
+    assert cached_misses() == before + 1
+
+def test_reply_index_routes_replies_by_message_id(monkeypatch, tmp_path):
+    """Record outbound emails in the reply index and route replies back through their reply headers"""
+    from types import SimpleNamespace
+    import main
+
+    monkeypatch.setattr(main, "outbox_path", str(tmp_path / "outbox.db"))
+    monkeypatch.setattr(main, "outbox_db", None)
+    monkeypatch.setattr(main, "maileroo_from_email", "bot@example.com")
+    monkeypatch.setattr(main, "reply_index_size", 1000)
+    channel = SimpleNamespace(id=11, name="general")
+    monkeypatch.setattr(main, "inbound_routes", {"11": channel})
+    db = main.open_outbox()
+    try:
+        first = main.add_reply_target(11, 501)
+        for message_id in range(502, 2501):  # Reply index rows 2-2000
+            last = main.add_reply_target(11, message_id, 77)
+        db.commit()
+        assert last.endswith("@example.com>")
+        assert main.find_reply_target([last]) == (channel, 2500, 77)
+        # Every 1000th row evicts everything reply_index_size rows older than it
+        assert db.execute("SELECT COUNT(*) FROM reply_index").fetchone()[0] == 1000
+        assert main.find_reply_target([first]) is None
+        # Unknown, forged and unrouted IDs fall through to the next header
+        forged = last.replace(last.split(".")[2][:8], "00000000")
+        assert main.find_reply_target(["<someone@else.com>", forged, last]) == (channel, 2500, 77)
+        monkeypatch.setattr(main, "inbound_routes", {})
+        assert main.find_reply_target([last]) is None
+    finally:
+        db.close()
+
+    payload = build_payload("general")
+    payload["headers"]["In-Reply-To"] = [last]
+    payload["headers"]["References"] = [f"{first} <other@example.com> {last}"]
+    assert main.parse_email_webhook(payload)["reply_to"] == [last, last, "<other@example.com>", first]
+
+def test_reply_thread_falls_back_to_the_channel():
+    """Replies go in the channel when the bot cannot start a thread or the thread is locked"""
+    from types import SimpleNamespace
+    import discord
+    import main
+
+    async def forbidden(name):
+        raise discord.Forbidden(SimpleNamespace(status=403, reason="Forbidden"), {"code": 50001, "message": "Missing Access"})
+
+    threads = {}
+    guild = SimpleNamespace(get_thread=threads.get)
+    channel = SimpleNamespace(id=11, name="general", guild=guild,
+                              get_partial_message=lambda message_id: SimpleNamespace(create_thread=forbidden))
+    assert asyncio.run(main.get_reply_thread(channel, 500, None)) is None
+    threads[500] = SimpleNamespace(id=500, locked=True)
+    assert asyncio.run(main.get_reply_thread(channel, 500, None)) is None
+    threads[500] = open_thread = SimpleNamespace(id=500, locked=False)
+    assert asyncio.run(main.get_reply_thread(channel, 500, None)) is open_thread
+
+def test_email_scheduler_lanes_and_buckets(monkeypatch):
+    """A burst in one channel waits on that channel's bucket without holding up others; the priority lane goes first"""
+    import main
+
+    def email(outbox_id, channel_id, lane=main.NORMAL_LANE):
+        return main.OutboundEmail(outbox_id, f"subject {outbox_id}", "", None, None, channel_id, lane)
+
+    async def get_both(scheduler):
+        return [(await asyncio.wait_for(scheduler.get(), 5)).outbox_id for _ in range(2)]
+
+    # get() sleeps until a held channel's token is due (real time, so before the clock below is swapped in)
+    scheduler = main.EmailScheduler(100, channel_rate=20, channel_burst=1)
+    scheduler.put_nowait(email(0, 1))
+    scheduler.put_nowait(email(1, 1))
+    assert asyncio.run(get_both(scheduler)) == [0, 1]
+
+    clock = [1024.0]  # Steps below are exact binary fractions, so token arithmetic has no rounding surprises
+    monkeypatch.setattr(main.time, "monotonic", lambda: clock[0])
+
+    def release(scheduler, seconds, step=0.125):
+        """Advance the clock in steps, returning (outbox ID, seconds elapsed) for each email as it becomes ready"""
+        released = []
+        for i in range(1, int(seconds / step) + 1):
+            clock[0] += step
+            while (ready := scheduler.pop_ready()) is not None:
+                released.append((ready.outbox_id, i * step))
+        return released
+
+    scheduler = main.EmailScheduler(100, channel_rate=4, channel_burst=2)
+    for outbox_id in range(6):
+        scheduler.put_nowait(email(outbox_id, 1))  # 2 at once, then one every 0.25s
+    scheduler.put_nowait(email(10, 2))
+    scheduler.put_nowait(email(20, 3, main.PRIORITY_LANE))
+    assert [scheduler.pop_ready().outbox_id for _ in range(4)] == [20, 0, 1, 10]
+    assert scheduler.pop_ready() is None and scheduler.qsize() == 4
+    assert release(scheduler, 1.0) == [(2, 0.25), (3, 0.5), (4, 0.75), (5, 1.0)]
+
+    # A retried email goes back to the front of its lane without waiting on its channel again
+    scheduler.put_nowait(email(30, 4))
+    scheduler.put_nowait(email(31, 1, main.PRIORITY_LANE))  # Held: channel 1 has no tokens left
+    scheduler.put_nowait(email(5, 1), retry=True)
+    assert scheduler.pop_ready().outbox_id == 5
+    # drop_oldest takes from the normal lane before the priority lane
+    assert scheduler.pop_oldest().outbox_id == 30
+    assert scheduler.pop_oldest().outbox_id == 31
+    assert scheduler.qsize() == 0
+
+    # A raid that overflows the queue drops emails without spending their channel's tokens
+    raided = main.EmailScheduler(10, channel_rate=1, channel_burst=10)
+    monkeypatch.setattr(main, "email_queue", raided)
+    monkeypatch.setattr(main, "email_queue_drop_policy", "drop_oldest")
+    monkeypatch.setattr(main, "outbox_inflight", set())
+    for outbox_id in range(200):
+        main.queue_email(email(outbox_id, 1))
+    assert [raided.pop_ready().outbox_id for _ in range(10)] == list(range(190, 200))
+    main.queue_email(email(200, 1))
+    assert release(raided, 2) == [(200, 1.0)]  # One token's wait at 1/s, not a debt of 190
+
+    bucket = main.TokenBucket(100, 1)
+    assert bucket.reserve() == 0
+    bucket.throttle(0.25)
+    assert bucket.rate == 50
+    assert bucket.reserve() == 0.25 + 1 / 50  # The pause, then one token at the lowered rate
+    for _ in range(20):
+        bucket.recover()
+    assert bucket.rate == 100
+
+def test_parse_retry_after_reads_seconds_and_http_dates(monkeypatch):
+    """Retry-After as a delay or an HTTP date, within 0..MAILEROO_RETRY_AFTER_MAX; missing or garbled falls back to MAILEROO_RETRY_AFTER"""
+    import main
+    from datetime import timedelta
+    from email.utils import format_datetime
+
+    monkeypatch.setattr(main, "maileroo_retry_after", 7.0)
+    assert main.parse_retry_after("120") == 120 and main.parse_retry_after("1.5") == 1.5
+    assert main.parse_retry_after("-3") == 0
+    in_30s = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert 28 <= main.parse_retry_after(in_30s) <= 30
+    assert main.parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert main.parse_retry_after(None) == main.parse_retry_after("") == main.parse_retry_after("soon") == 7.0
+    assert main.parse_retry_after("nan") == 7.0
+    monkeypatch.setattr(main, "maileroo_retry_after_max", 600.0)
+    assert main.parse_retry_after("1e12") == main.parse_retry_after("inf") == main.parse_retry_after("Fri, 31 Dec 9999 23:59:59 GMT") == 600
+
+def test_inbound_queue_keeps_failed_emails(monkeypatch, tmp_path):
+    """A failed delivery stays queued until its backoff is due, and the shared dedupe store outlives the queue row"""
+    import main
+
+    monkeypatch.setattr(main, "inbound_queue_path", str(tmp_path / "inbound-queue.db"))
+    monkeypatch.setattr(main, "inbound_queue_db", None)
+    monkeypatch.setattr(main, "inbound_queue_retry_base", 0.2)
+    monkeypatch.setattr(main, "inbound_queue_max_attempts", 3)
+    failures = Counter()
+
+    async def flaky_dispatch(email_kwargs):
+        failures[email_kwargs["subject"]] += 1
+        if email_kwargs["subject"] == "down" or failures[email_kwargs["subject"]] == 1:
+            raise RuntimeError("Discord returned 503")
+
+    monkeypatch.setattr(main, "dispatch_inbound_email", flaky_dispatch)
+
+    async def deliver_due():
+        for row in main.claim_inbound_emails(10):
+            await main.deliver_queued_email(*row)
+
+    try:
+        assert main.enqueue_inbound_email("m1", {"subject": "flaky"})[1] == 202
+        assert main.enqueue_inbound_email("m2", {"subject": "down"})[1] == 202
+        asyncio.run(deliver_due())
+        assert main.inbound_queue_stats()[0] == 2 and main.claim_inbound_emails(10) == []
+        time.sleep(0.25)
+        asyncio.run(deliver_due())  # "flaky" goes through, "down" fails again
+        assert main.inbound_queue_stats()[0] == 1
+        time.sleep(0.45)
+        asyncio.run(deliver_due())  # Third failure: dropped
+        assert main.inbound_queue_stats()[0] == 0
+        assert failures == {"flaky": 2, "down": 3}
+    finally:
+        main.inbound_queue_db.close()
+
+    # Two processes sharing INBOUND_DEDUPE_PATH: the second claim loses even after the row left the queue
+    monkeypatch.setattr(main, "inbound_dedupe_path", str(tmp_path / "inbound-dedupe.db"))
+    monkeypatch.setattr(main, "inbound_dedupe_db", None)
+    monkeypatch.setattr(main, "inbound_seen", main.OrderedDict())
+    try:
+        assert main.claim_inbound_message("m1")
+        main.inbound_seen.clear()  # What another process sees
+        assert not main.claim_inbound_message("m1")
+        main.release_inbound_message("m1")
+        assert main.claim_inbound_message("m1")
+    finally:
+        main.inbound_dedupe_db.close()
+
+def test_async_webhook_queues_emails_off_the_loop(monkeypatch, tmp_path):
+    """In WEB_SERVER_MODE=async the queue and dedupe SQLite writes run in worker threads, not on the bot loop"""
+    import main
+    import threading
+
+    monkeypatch.setattr(main, "inbound_queue_path", str(tmp_path / "inbound-queue.db"))
+    monkeypatch.setattr(main, "inbound_queue_db", None)
+    monkeypatch.setattr(main, "inbound_dedupe_path", str(tmp_path / "inbound-dedupe.db"))
+    monkeypatch.setattr(main, "inbound_dedupe_db", None)
+    monkeypatch.setattr(main, "inbound_seen", main.OrderedDict())
+    threads = {}
+
+    def recording(name):
+        func = getattr(main, name)
+
+        def record(*args):
+            threads.setdefault(name, []).append(threading.get_ident())
+            return func(*args)
+        monkeypatch.setattr(main, name, record)
+
+    for name in ("enqueue_inbound_email", "claim_inbound_message", "release_inbound_message"):
+        recording(name)
+
+    async def scenario():
+        aio_app = web.Application()
+        aio_app.router.add_post("/email-webhook", main.aio_email_webhook)
+        runner, port = await start_site(aio_app)
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.post(f"http://127.0.0.1:{port}/email-webhook", json=build_payload("general")) as response:
+                    assert response.status == 202
+                monkeypatch.setattr(main, "parse_email_webhook", lambda data: 1 / 0)  # Fails after the claim: released
+                async with session.post(f"http://127.0.0.1:{port}/email-webhook", json=build_payload("general", message_id="m2")) as response:
+                    assert response.status == 500
+        finally:
+            await runner.cleanup()
+        return threading.get_ident()
+
+    try:
+        loop_thread = asyncio.run(scenario())
+        assert {name: len(idents) for name, idents in threads.items()} == {
+            "claim_inbound_message": 2, "enqueue_inbound_email": 1, "release_inbound_message": 1}
+        assert loop_thread not in {ident for idents in threads.values() for ident in idents}
+        assert main.inbound_queue_stats()[0] == 1 and main.claim_inbound_message("m2")
+    finally:
+        main.inbound_queue_db.close()
+        main.inbound_dedupe_db.close()
+
+def test_inbound_dispatcher_keeps_channel_order(monkeypatch):
+    """Emails for one channel are delivered in arrival order, channels run side by side, and the global cap holds"""
+    import random
+    from types import SimpleNamespace
+    import main
+
+    channels = {name: SimpleNamespace(id=i, name=name) for i, name in enumerate(("a", "b", "c", "d"))}
+    delivered = {name: [] for name in channels}
+    active = Counter()
+
+    def resolve(subject, reply_to):
+        return channels.get(subject.split(":")[0]), None, None
+
+    async def fake_send(subject, target=None, **kwargs):
+        if target[0] is None:
+            return  # Like send_email_to_discord, log and give up
+        active["now"] += 1
+        active["peak"] = max(active["peak"], active["now"])
+        await asyncio.sleep(random.uniform(0, 0.01))  # Uneven send times would reorder independent tasks
+        active["now"] -= 1
+        name, n = subject.split(":")
+        delivered[name].append(int(n))
+        if n == "3":
+            raise RuntimeError("send failed")  # A failure must not stall the rest of the lane
+
+    monkeypatch.setattr(main, "resolve_inbound_target", resolve)
+    monkeypatch.setattr(main, "send_email_to_discord", fake_send)
+
+    async def scenario():
+        dispatcher = main.InboundDispatcher(concurrency=3)
+        futures = [dispatcher.submit({"subject": f"{name}:{n}"}) for n in range(20) for name in channels]
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        assert sum(isinstance(result, RuntimeError) for result in results) == len(channels)
+        assert not dispatcher.lanes
+        unroutable = dispatcher.submit({"subject": "nowhere:0"})
+        await unroutable
+        await dispatcher.stop()
+
+    asyncio.run(scenario())
+    for name in channels:
+        assert delivered[name] == list(range(20))
+    assert active["peak"] == 3
+
+# --- Offline load test -------------------------------------------------------
+
+STUB_GUILD_ID = "1405628370301091860"  # Routed to MAILEROO_TO_EMAIL through DISCORD_GUILD_ID
+STUB_BOT_ID = "1300000000000000001"
+STUB_AUTHOR_ID = "1300000000000000002"
+STUB_CHANNEL_BASE = 1300000000000001000
+LOAD_ID_PATTERN = re.compile(rb"ytt-load-([a-z]\d+)")  # Tag carried in every generated message
+STUB_BUCKET_LIMIT, STUB_BUCKET_WINDOW = 5, 2.0  # --discord-rate-limits: posts per webhook (or channel) per window
+STUB_GLOBAL_LIMIT = 50  # --discord-rate-limits: requests per second overall
+
+STUB_BOT_USER = {"id": STUB_BOT_ID, "username": "ytt-stub", "discriminator": "0", "global_name": None, "avatar": None, "bot": True}
+STUB_AUTHOR = {"id": STUB_AUTHOR_ID, "username": "loadtester", "discriminator": "0", "global_name": None, "avatar": None}
+STUB_TIMESTAMP = "2024-01-01T00:00:00+00:00"
+
+def percentiles(values):
+    """p50/p95/p99/max/mean of a list of seconds, in milliseconds (nearest rank)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = lambda p: ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+    return {
+        "p50": round(rank(50) * 1000, 2),
+        "p95": round(rank(95) * 1000, 2),
+        "p99": round(rank(99) * 1000, 2),
+        "max": round(ordered[-1] * 1000, 2),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 2),
+    }
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def discord_json(data):
+    """JSON response the way Discord sends it (discord.py only parses an exact application/json content type)"""
+    return web.Response(body=json.dumps(data).encode(), content_type="application/json")
+
+def message_payload(message_id, channel_id, content, author=STUB_BOT_USER):
+    return {
+        "id": str(message_id), "channel_id": str(channel_id), "guild_id": STUB_GUILD_ID, "author": author,
+        "content": content, "timestamp": STUB_TIMESTAMP, "edited_timestamp": None, "tts": False,
+        "mention_everyone": False, "mentions": [], "mention_roles": [], "attachments": [], "embeds": [],
+        "pinned": False, "type": 0,
+    }
+
+class DiscordStub:
+    """Stand-in for the Discord REST API and gateway: one guild of text channels, records deliveries by load tag"""
+
+    def __init__(self, channels, latency=0.0, rate_limits=False):
+        self.channels = {f"load-{i}": str(STUB_CHANNEL_BASE + i) for i in range(channels)}
+        self.latency = latency
+        self.webhooks = {}  # channel ID -> webhook payload
+        self.delivered = {}  # load tag -> monotonic time the first message carrying it arrived
+        self.arrivals = {}  # channel ID -> load tags in the order they first arrived
+        self.requests = Counter()
+        self.rate_limits = rate_limits  # Enforce Discord's limits: 5 posts per 2s per bucket, 50 requests/s overall
+        self.rate_limited = Counter()  # "bucket" / "global" -> 429s sent
+        self.windows = {}  # bucket -> (window start, posts in window)
+        self.global_tokens = float(STUB_GLOBAL_LIMIT)
+        self.global_updated = time.monotonic()
+        self.sockets = []
+        self.sequence = 0
+        self.next_id = STUB_CHANNEL_BASE + 100000
+        self.ready = asyncio.Event()
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_get("/gateway", self.gateway)
+        app.router.add_get("/api/v10/users/@me", self.get_me)
+        app.router.add_get("/api/v10/oauth2/applications/@me", self.get_application)
+        app.router.add_get("/api/v10/channels/{channel_id}/webhooks", self.get_webhooks)
+        app.router.add_post("/api/v10/channels/{channel_id}/webhooks", self.create_webhook)
+        app.router.add_post("/api/v10/channels/{channel_id}/messages", self.create_message)
+        app.router.add_post("/api/v10/webhooks/{webhook_id}/{token}", self.execute_webhook)
+        return app
+
+    def snowflake(self):
+        self.next_id += 1
+        return str(self.next_id)
+
+    def record(self, route, raw, channel_id):
+        self.requests[route] += 1
+        match = LOAD_ID_PATTERN.search(raw)
+        if match and match.group(1).decode() not in self.delivered:
+            self.delivered[match.group(1).decode()] = time.monotonic()
+            self.arrivals.setdefault(channel_id, []).append(match.group(1).decode())
+
+    def check_rate_limit(self, bucket):
+        """Apply the Discord-style limits to one post; returns (rate limit headers, 429 response or None)"""
+        if not self.rate_limits:
+            return {}, None
+        now = time.monotonic()
+        self.global_tokens = min(STUB_GLOBAL_LIMIT, self.global_tokens + (now - self.global_updated) * STUB_GLOBAL_LIMIT)
+        self.global_updated = now
+        if self.global_tokens < 1:
+            self.rate_limited["global"] += 1
+            return {}, self.too_many_requests((1 - self.global_tokens) / STUB_GLOBAL_LIMIT, True)
+        start, count = self.windows.get(bucket, (now, 0))
+        if now - start >= STUB_BUCKET_WINDOW:
+            start, count = now, 0
+        reset_after = start + STUB_BUCKET_WINDOW - now
+        if count >= STUB_BUCKET_LIMIT:
+            self.rate_limited["bucket"] += 1
+            return {}, self.too_many_requests(reset_after, False)
+        self.global_tokens -= 1
+        self.windows[bucket] = (start, count + 1)
+        return {"X-RateLimit-Limit": str(STUB_BUCKET_LIMIT), "X-RateLimit-Remaining": str(STUB_BUCKET_LIMIT - count - 1),
+                "X-RateLimit-Reset-After": f"{reset_after:.3f}", "X-RateLimit-Bucket": bucket}, None
+
+    def too_many_requests(self, retry_after, is_global):
+        # discord.py only retries webhook 429s that came through Discord's proxy (a Via header)
+        headers = {"Via": "1.1 google", "Retry-After": f"{retry_after:.3f}"}
+        if is_global:
+            headers["X-RateLimit-Global"] = "true"
+        body = {"message": "You are being rate limited.", "retry_after": round(retry_after, 3), "global": is_global}
+        return web.Response(body=json.dumps(body).encode(), status=429, content_type="application/json", headers=headers)
+
+    async def get_me(self, request):
+        return discord_json(STUB_BOT_USER)
+
+    async def get_application(self, request):
+        return discord_json({"id": STUB_BOT_ID, "name": "ytt-stub", "description": "", "icon": None, "bot_public": False,
+                             "bot_require_code_grant": False, "owner": STUB_AUTHOR, "verify_key": "", "flags": 0})
+
+    async def get_webhooks(self, request):
+        self.requests["get_webhooks"] += 1
+        webhook = self.webhooks.get(request.match_info["channel_id"])
+        return discord_json([webhook] if webhook else [])
+
+    async def create_webhook(self, request):
+        self.requests["create_webhook"] += 1
+        channel_id = request.match_info["channel_id"]
+        webhook = {
+            "id": self.snowflake(), "type": 1, "name": "sophia", "avatar": None, "token": f"stub-{channel_id}",
+            "channel_id": channel_id, "guild_id": STUB_GUILD_ID, "application_id": None, "user": STUB_BOT_USER,
+        }
+        self.webhooks[channel_id] = webhook
+        return discord_json(webhook)
+
+    async def create_message(self, request):
+        raw = await request.read()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        channel_id = request.match_info["channel_id"]
+        headers, limited = self.check_rate_limit(f"channel-{channel_id}")
+        if limited:
+            return limited
+        self.record("create_message", raw, channel_id)
+        response = discord_json(message_payload(self.snowflake(), channel_id, raw.decode(errors="replace")[:2000]))
+        response.headers.update(headers)
+        return response
+
+    async def execute_webhook(self, request):
+        raw = await request.read()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        headers, limited = self.check_rate_limit(f"webhook-{request.match_info['webhook_id']}")
+        if limited:
+            return limited
+        self.record("execute_webhook", raw, request.match_info["token"].removeprefix("stub-"))
+        return web.Response(status=204, headers=headers)
+
+    def guild_payload(self):
+        everyone = {"id": STUB_GUILD_ID, "name": "@everyone", "permissions": str((1 << 41) - 1), "position": 0,
+                    "color": 0, "hoist": False, "managed": False, "mentionable": False}
+        channels = [{"id": channel_id, "type": 0, "name": name, "position": position, "guild_id": STUB_GUILD_ID,
+                     "permission_overwrites": [], "nsfw": False, "parent_id": None, "topic": None,
+                     "last_message_id": None, "rate_limit_per_user": 0}
+                    for position, (name, channel_id) in enumerate(self.channels.items())]
+        member = {"user": STUB_BOT_USER, "roles": [], "joined_at": STUB_TIMESTAMP, "deaf": False, "mute": False, "flags": 0}
+        return {
+            "id": STUB_GUILD_ID, "name": "ytt load test", "owner_id": STUB_AUTHOR_ID, "roles": [everyone],
+            "channels": channels, "members": [member], "member_count": 2, "emojis": [], "stickers": [],
+            "features": [], "large": False, "unavailable": False, "voice_states": [], "presences": [],
+            "threads": [], "stage_instances": [], "guild_scheduled_events": [], "premium_tier": 0,
+            "preferred_locale": "en-US", "verification_level": 0, "default_message_notifications": 0,
+            "explicit_content_filter": 0, "mfa_level": 0, "system_channel_flags": 0, "nsfw_level": 0,
+        }
+
+    async def send_event(self, ws, event, data):
+        self.sequence += 1
+        await ws.send_str(json.dumps({"op": 0, "t": event, "s": self.sequence, "d": data}))
+
+    async def dispatch(self, event, data):
+        for ws in list(self.sockets):
+            await self.send_event(ws, event, data)
+
+    async def gateway(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_str(json.dumps({"op": 10, "d": {"heartbeat_interval": 41250}}))
+        async for msg in ws:
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                continue
+            payload = json.loads(msg.data)
+            if payload["op"] == 1:  # Heartbeat
+                await ws.send_str(json.dumps({"op": 11}))
+            elif payload["op"] == 2:  # Identify
+                await self.send_event(ws, "READY", {
+                    "v": 10, "user": STUB_BOT_USER, "guilds": [{"id": STUB_GUILD_ID, "unavailable": True}],
+                    "session_id": "stub-session", "resume_gateway_url": str(request.url.with_query(None)),
+                    "application": {"id": STUB_BOT_ID, "flags": 0},
+                })
+                await self.send_event(ws, "GUILD_CREATE", self.guild_payload())
+                self.sockets.append(ws)
+                self.ready.set()
+        if ws in self.sockets:
+            self.sockets.remove(ws)
+        return ws
+
+class MailerooStub:
+    """Stand-in for the Maileroo send API, records deliveries by load tag; optionally rate limited like the real one"""
+
+    def __init__(self, latency=0.0, rate_limit=0.0, burst=10, retry_after=1.0):
+        self.latency = latency
+        self.delivered = {}
+        self.requests = 0
+        self.rejected = 0
+        self.rate_limit = rate_limit  # Accepted sends per second (0 = unlimited); the rest get 429 + Retry-After
+        self.burst = burst
+        self.retry_after = retry_after
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/api/v2/emails", self.send)
+        return app
+
+    async def send(self, request):
+        raw = await request.read()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.requests += 1
+        if self.rate_limit:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate_limit)
+            self.updated = now
+            if self.tokens < 1:
+                self.rejected += 1
+                return web.json_response({"success": False, "message": "Too many requests"}, status=429,
+                                         headers={"Retry-After": str(self.retry_after)})
+            self.tokens -= 1
+        for match in LOAD_ID_PATTERN.finditer(raw):  # A digest carries several messages
+            self.delivered.setdefault(match.group(1).decode(), time.monotonic())
+        return web.json_response({"success": True, "message": "queued", "data": {"reference_id": f"stub-{self.requests}"}})
+
+async def start_site(app):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    port = free_port()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner, port
+
+def start_app(args, discord_port, maileroo_port, app_port, workdir, log_file):
+    """Launch main.py in child processes wired to the local stubs; returns the processes"""
+    env = dict(os.environ)
+    env.update({
+        "token": "stub-token",
+        "PORT": str(app_port),
+        "WEB_SERVER_MODE": args.mode,
+        "LOG_LEVEL": args.app_log_level,
+        "DISCORD_API_BASE": f"http://127.0.0.1:{discord_port}/api/v10",
+        "DISCORD_GATEWAY_URL": f"ws://127.0.0.1:{discord_port}/gateway",
+        "DISCORD_GUILD_ID": STUB_GUILD_ID,
+        "DISCORD_CHANNEL_ID": "",
+        "MAILEROO_API_URL": f"http://127.0.0.1:{maileroo_port}/api/v2/emails",
+        "MAILEROO_API_KEY": "stub-key",
+        "MAILEROO_FROM_EMAIL": "bot@loadtest.invalid",
+        "MAILEROO_TO_EMAIL": "owner@loadtest.invalid",
+        "OUTBOX_PATH": os.path.join(workdir, "outbox.db"),
+        "WEBHOOK_CACHE_PATH": os.path.join(workdir, "webhooks.json"),
+        "INBOUND_DEDUPE_PATH": os.path.join(workdir, "inbound-dedupe.db") if args.split else "",
+        "INBOUND_QUEUE_PATH": os.path.join(workdir, "inbound-queue.db") if args.split else "",
+        "PRIORITY_CHANNELS": ",".join(str(STUB_CHANNEL_BASE + i) for i in range(args.priority_channels)),
+        "EMAIL_DIGEST_ENABLED": "true" if args.digest_window else "false",
+    })
+    if args.digest_window:
+        env.update({"EMAIL_DIGEST_WINDOW": str(args.digest_window), "EMAIL_DIGEST_MAX_MESSAGES": str(args.digest_max)})
+    # Maileroo send limits; main.py's own defaults apply unless given
+    for option, name in (("mail_rate", "MAILEROO_RATE"), ("mail_burst", "MAILEROO_BURST"),
+                         ("mail_channel_rate", "MAILEROO_CHANNEL_RATE"), ("mail_channel_burst", "MAILEROO_CHANNEL_BURST")):
+        if getattr(args, option) is not None:
+            env[name] = str(getattr(args, option))
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    if args.workers:
+        # Run under gunicorn like production; several workers elect one bot leader
+        env.update({
+            "WEB_CONCURRENCY": str(args.workers),
+            "BOT_LEADER_LOCK_PATH": os.path.join(workdir, "bot-leader.lock"),
+            "BOT_LEADER_SOCKET_PATH": os.path.join(workdir, "bot-leader.sock"),
+        })
+        command = [sys.executable, "-m", "gunicorn", "-c", os.path.join(repo_dir, "gunicorn.conf.py"),
+                   "--chdir", repo_dir, "main:create_async_app" if args.mode == "async" else "main:app"]
+    else:
+        command = [sys.executable, os.path.join(repo_dir, "main.py")]
+    if not args.split:
+        return [subprocess.Popen(command, env=env, cwd=workdir, stdout=log_file, stderr=subprocess.STDOUT)]
+    # Ingestion and delivery as separate processes sharing the durable queue
+    deliver = subprocess.Popen([sys.executable, os.path.join(repo_dir, "main.py")], env=dict(env, PROCESS_ROLE="deliver"),
+                               cwd=workdir, stdout=log_file, stderr=subprocess.STDOUT)
+    ingest = subprocess.Popen(command, env=dict(env, PROCESS_ROLE="ingest"), cwd=workdir,
+                              stdout=log_file, stderr=subprocess.STDOUT)
+    return [ingest, deliver]
+
+def stop_app(procs):
+    for proc in procs:
+        if proc.poll() is None:
+            proc.send_signal(signal.SIGINT)
+    for proc in procs:
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+async def wait_for_deliveries(stub, tags, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and not all(tag in stub.delivered for tag in tags):
+        await asyncio.sleep(0.05)
+
+async def paced(count, rate, concurrency, send):
+    """Call send(i, scheduled_at) count times, starting one every 1/rate seconds, at most concurrency at once"""
+    semaphore = asyncio.Semaphore(concurrency)
+    start = time.monotonic()
+
+    async def one(i, scheduled_at):
+        async with semaphore:
+            await send(i, scheduled_at)
+
+    tasks = []
+    for i in range(count):
+        scheduled_at = start + i / rate if rate else time.monotonic()
+        delay = scheduled_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(one(i, scheduled_at)))
+    await asyncio.gather(*tasks)
+    return time.monotonic() - start
+
+def summarize(sent, statuses, response_times, delivered, duration, drain_end):
+    """Build the result block for one direction of traffic"""
+    errors = sum(count for status, count in statuses.items() if not str(status).startswith("2"))
+    accepted = len(sent) - errors
+    end_to_end = [delivered[tag] - sent_at for tag, sent_at in sent.items() if tag in delivered]
+    first = min(sent.values(), default=0)
+    last = max((delivered[tag] for tag in sent if tag in delivered), default=first)
+    return {
+        "sent": len(sent),
+        "status_counts": {str(status): count for status, count in sorted(statuses.items(), key=str)},
+        "errors": errors,
+        "error_rate": round(errors / len(sent), 4) if sent else 0,
+        "delivered": len(end_to_end),
+        "lost": max(accepted - len(end_to_end), 0),
+        "loss_rate": round(max(accepted - len(end_to_end), 0) / accepted, 4) if accepted > 0 else 0,
+        "response_ms": percentiles(response_times),
+        "end_to_end_ms": percentiles(end_to_end),
+        "send_seconds": round(duration, 3),
+        "offered_rps": round(len(sent) / duration, 1) if duration else None,
+        "delivered_per_second": round(len(end_to_end) / (last - first), 1) if last > first else None,
+        "drain_seconds": round(drain_end, 3),
+    }
+
+async def run_inbound(args, session, url, stub):
+    """Post args.requests webhook payloads and time each one until it reaches the Discord stub"""
+    sent = {}
+    statuses = Counter()
+    response_times = []
+    filler = "Load test body line.\n" * max(args.body_size // 21, 0)
+
+    async def send(i, scheduled_at):
+        tag = f"i{i}"
+        channel = i % args.channels
+        payload = build_payload(f"load-{channel}", message_id=f"{tag}-{time.time_ns()}@loadtest.invalid",
+                                body=f"ytt-load-{tag}\n{filler}", channel_id=STUB_CHANNEL_BASE + channel)
+        sent[tag] = scheduled_at  # Measured from the scheduled start so queueing in the client counts too
+        started = time.monotonic()
+        try:
+            async with session.post(url, json=payload) as response:
+                await response.read()
+                statuses[response.status] += 1
+        except Exception as e:
+            statuses[type(e).__name__] += 1
+        response_times.append(time.monotonic() - started)
+
+    duration = await paced(args.requests, args.rate, args.concurrency, send)
+    drain_started = time.monotonic()
+    await wait_for_deliveries(stub, list(sent), args.drain_timeout)
+    result = summarize(sent, statuses, response_times, stub.delivered, duration, time.monotonic() - drain_started)
+    # Emails were sent to each channel in tag order; count the ones that arrived after a later one
+    result["out_of_order"] = 0
+    for tags in stub.arrivals.values():
+        latest = -1
+        for n in (int(tag[1:]) for tag in tags if tag.startswith("i")):
+            if n < latest:
+                result["out_of_order"] += 1
+            latest = max(latest, n)
+    return result
+
+def outbound_channel(args, i):
+    """Channel index for the i-th outbound message: --raid-share of them go to the last channel, the rest round-robin"""
+    if args.raid_share and int((i + 1) * args.raid_share) > int(i * args.raid_share):
+        return args.channels - 1
+    return i % max(args.channels - (1 if args.raid_share else 0), 1)
+
+async def run_outbound(args, discord_stub, maileroo_stub):
+    """Inject Discord messages over the stub gateway and time each one until it reaches the Maileroo stub"""
+    sent = {}
+    groups = {}
+    statuses = Counter()
+    channel_ids = list(discord_stub.channels.values())
+
+    async def send(i, scheduled_at):
+        tag = f"o{i}"
+        sent[tag] = scheduled_at
+        channel = outbound_channel(args, i)
+        if channel < args.priority_channels:
+            groups[tag] = "priority"
+        elif args.raid_share and channel == args.channels - 1:
+            groups[tag] = "raid"
+        else:
+            groups[tag] = "other"
+        message = message_payload(discord_stub.snowflake(), channel_ids[channel],
+                                  f"ytt-load-{tag} hello from the load test", author=STUB_AUTHOR)
+        message["member"] = {"roles": [], "joined_at": STUB_TIMESTAMP, "deaf": False, "mute": False, "flags": 0}
+        await discord_stub.dispatch("MESSAGE_CREATE", message)
+        statuses["dispatched"] += 1
+
+    duration = await paced(args.outbound, args.rate, args.concurrency, send)
+    drain_started = time.monotonic()
+    await wait_for_deliveries(maileroo_stub, list(sent), args.drain_timeout)
+    result = summarize(sent, statuses, [], maileroo_stub.delivered, duration, time.monotonic() - drain_started)
+    del result["response_ms"]
+    result["errors"] = 0
+    result["error_rate"] = 0
+    result["lost"] = len(sent) - result["delivered"]
+    result["loss_rate"] = round(result["lost"] / len(sent), 4) if sent else 0
+    if args.priority_channels or args.raid_share:
+        result["groups"] = {}
+        for group in ("priority", "other", "raid"):
+            tags = [tag for tag in sent if groups[tag] == group]
+            if tags:
+                result["groups"][group] = {
+                    "sent": len(tags),
+                    "delivered": sum(tag in maileroo_stub.delivered for tag in tags),
+                    "end_to_end_ms": percentiles([maileroo_stub.delivered[tag] - sent[tag] for tag in tags if tag in maileroo_stub.delivered]),
+                }
+    return result
+
+async def warm_up(args, session, base_url, stub, procs):
+    """Wait for the app and its (stub) gateway session, then prime one webhook per channel"""
+    deadline = time.monotonic() + args.startup_timeout
+    while True:
+        exited = [proc for proc in procs if proc.poll() is not None]
+        if exited:
+            raise RuntimeError(f"main.py exited with code {exited[0].returncode} during startup")
+        if time.monotonic() > deadline:
+            raise RuntimeError("main.py did not become ready in time")
+        try:
+            async with session.get(f"{base_url}/health") as response:
+                if response.status == 200 and stub.ready.is_set():
+                    break
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    tags = []
+    for i in range(args.channels):
+        tag = f"w{i}"
+        tags.append(tag)
+        while time.monotonic() < deadline:
+            payload = build_payload(f"load-{i}", message_id=f"{tag}-{time.time_ns()}@loadtest.invalid", body=f"ytt-load-{tag}",
+                                    channel_id=STUB_CHANNEL_BASE + i)
+            async with session.post(f"{base_url}/email-webhook", json=payload) as response:
+                if response.status < 500:
+                    break
+            await asyncio.sleep(0.5)
+    await wait_for_deliveries(stub, tags, max(deadline - time.monotonic(), 1))
+    if not all(tag in stub.delivered for tag in tags):
+        raise RuntimeError("warm-up messages never reached the Discord stub")
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def run_load(args):
+    discord_stub = DiscordStub(args.channels, args.discord_latency, args.discord_rate_limits)
+    maileroo_stub = MailerooStub(args.maileroo_latency, args.maileroo_rate_limit, args.maileroo_burst, args.maileroo_retry_after)
+    discord_runner, discord_port = await start_site(discord_stub.app())
+    maileroo_runner, maileroo_port = await start_site(maileroo_stub.app())
+    app_port = free_port()
+    base_url = f"http://127.0.0.1:{app_port}"
+    results = {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("command", "output", "compare")},
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        log_path = args.app_log or os.path.join(workdir, "app.log")
+        with open(log_path, "wb") as log_file:
+            procs = start_app(args, discord_port, maileroo_port, app_port, workdir, log_file)
+            try:
+                connector = aiohttp.TCPConnector(limit=args.concurrency)
+                timeout = aiohttp.ClientTimeout(total=args.request_timeout)
+                async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+                    print(f"Starting main.py ({args.mode} mode{', split' if args.split else ''}) against local stubs...")
+                    await warm_up(args, session, base_url, discord_stub, procs)
+                    if args.requests:
+                        print(f"Sending {args.requests} webhook(s) at {args.rate or 'max'}/s, concurrency {args.concurrency}...")
+                        results["inbound"] = await run_inbound(args, session, f"{base_url}/email-webhook", discord_stub)
+                    if args.outbound:
+                        print(f"Injecting {args.outbound} Discord message(s) at {args.rate or 'max'}/s...")
+                        results["outbound"] = await run_outbound(args, discord_stub, maileroo_stub)
+                        results["outbound"]["maileroo_calls_per_1000"] = round(maileroo_stub.requests / args.outbound * 1000, 1)
+            except RuntimeError as e:
+                print(f"❌ {e}")
+                log_file.flush()
+                with open(log_path, "rb") as log:
+                    print(log.read()[-4000:].decode(errors="replace"))
+                return None
+            finally:
+                stop_app(procs)
+                await discord_runner.cleanup()
+                await maileroo_runner.cleanup()
+    results["stubs"] = {"discord_requests": dict(discord_stub.requests), "discord_rate_limited": dict(discord_stub.rate_limited),
+                        "maileroo_requests": maileroo_stub.requests, "maileroo_rejected": maileroo_stub.rejected}
+    return results
+
+def print_results(results, previous=None):
+    for direction in ("inbound", "outbound"):
+        block = results.get(direction)
+        if not block:
+            continue
+        print(f"\n{direction}: {block['delivered']}/{block['sent']} delivered, "
+              f"{block['errors']} error(s) ({block['error_rate']:.2%}), {block['lost']} lost")
+        print(f"   offered {block['offered_rps']}/s, delivered {block['delivered_per_second']}/s")
+        if "maileroo_calls_per_1000" in block:
+            print(f"   {block['maileroo_calls_per_1000']} Maileroo call(s) per 1,000 messages")
+        if block.get("out_of_order"):
+            print(f"   {block['out_of_order']} email(s) posted out of order within their channel")
+        for key in ("response_ms", "end_to_end_ms"):
+            stats = block.get(key)
+            if not stats:
+                continue
+            line = f"   {key:14} p50 {stats['p50']:8.2f}  p95 {stats['p95']:8.2f}  p99 {stats['p99']:8.2f}"
+            old = ((previous or {}).get(direction) or {}).get(key)
+            if old:
+                line += f"   (was {old['p50']:.2f} / {old['p95']:.2f} / {old['p99']:.2f})"
+            print(line)
+        for group, stats in (block.get("groups") or {}).items():
+            e2e = stats["end_to_end_ms"] or {"p50": 0, "p95": 0, "p99": 0}
+            print(f"   {group:9} {stats['delivered']:5}/{stats['sent']:<5} p50 {e2e['p50']:8.2f}  p95 {e2e['p95']:8.2f}  p99 {e2e['p99']:8.2f}")
+    stubs = results.get("stubs") or {}
+    if stubs.get("discord_rate_limited"):
+        print(f"\nDiscord stub answered 429 to {sum(stubs['discord_rate_limited'].values())} post(s): {stubs['discord_rate_limited']}")
+    if stubs.get("maileroo_rejected"):
+        print(f"\nMaileroo stub answered 429 to {stubs['maileroo_rejected']} of {stubs['maileroo_requests']} send(s)")
+
+def load_parser():
+    parser = argparse.ArgumentParser(prog="test_webhook.py load", description="Offline load test for the email webhook")
+    parser.add_argument("-n", "--requests", type=int, default=500, help="Inbound webhook payloads to send")
+    parser.add_argument("-c", "--concurrency", type=int, default=50, help="Max requests in flight")
+    parser.add_argument("-r", "--rate", type=float, default=100, help="Target requests per second (0 = as fast as possible)")
+    parser.add_argument("--outbound", type=int, default=0, help="Also inject this many Discord messages for the email path")
+    parser.add_argument("--channels", type=int, default=10, help="Stub Discord channels to spread traffic over")
+    parser.add_argument("--body-size", type=int, default=200, help="Approximate email body size in bytes")
+    parser.add_argument("--mode", choices=("flask", "async"), default=os.getenv("WEB_SERVER_MODE", "flask"), help="WEB_SERVER_MODE for main.py")
+    parser.add_argument("--workers", type=int, default=0, help="Run main.py under gunicorn with this many workers (0 = python main.py)")
+    parser.add_argument("--split", action="store_true", help="Run ingestion and delivery as separate processes over the durable queue")
+    parser.add_argument("--discord-latency", type=float, default=0.0, help="Seconds the Discord stub waits before answering")
+    parser.add_argument("--discord-rate-limits", action="store_true", help="Make the Discord stub enforce Discord's per-webhook and global rate limits")
+    parser.add_argument("--maileroo-latency", type=float, default=0.0, help="Seconds the Maileroo stub waits before answering")
+    parser.add_argument("--maileroo-rate-limit", type=float, default=0.0, help="Sends per second the Maileroo stub accepts before answering 429 (0 = unlimited)")
+    parser.add_argument("--maileroo-burst", type=int, default=10, help="Sends the rate-limited Maileroo stub accepts back to back")
+    parser.add_argument("--maileroo-retry-after", type=float, default=1.0, help="Retry-After seconds in the Maileroo stub's 429s")
+    parser.add_argument("--mail-rate", type=float, help="MAILEROO_RATE for main.py")
+    parser.add_argument("--mail-burst", type=int, help="MAILEROO_BURST for main.py")
+    parser.add_argument("--mail-channel-rate", type=float, help="MAILEROO_CHANNEL_RATE for main.py")
+    parser.add_argument("--mail-channel-burst", type=int, help="MAILEROO_CHANNEL_BURST for main.py")
+    parser.add_argument("--digest-window", type=float, default=0.0, help="Turn on digest mode with this EMAIL_DIGEST_WINDOW in seconds (0 = off)")
+    parser.add_argument("--digest-max", type=int, default=25, help="EMAIL_DIGEST_MAX_MESSAGES in digest mode")
+    parser.add_argument("--priority-channels", type=int, default=0, help="Make the first N stub channels PRIORITY_CHANNELS")
+    parser.add_argument("--raid-share", type=float, default=0.0, help="Share of outbound messages sent to the last channel, like a spam raid")
+    parser.add_argument("--request-timeout", type=float, default=30, help="Seconds before a webhook request counts as failed")
+    parser.add_argument("--drain-timeout", type=float, default=30, help="Seconds to wait for outstanding deliveries")
+    parser.add_argument("--startup-timeout", type=float, default=60, help="Seconds to wait for main.py to come up")
+    parser.add_argument("--app-log", help="Keep main.py's output in this file")
+    parser.add_argument("--app-log-level", default="WARNING", help="LOG_LEVEL for main.py")
+    parser.add_argument("-o", "--output", default="load-results.json", help="Where to write the JSON results")
+    parser.add_argument("--compare", help="Earlier results file to show next to this run")
+    return parser
+
+def load_main(argv):
+    args = load_parser().parse_args(argv)
+
+    results = asyncio.run(run_load(args))
+    if results is None:
+        sys.exit(1)
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print_results(results, previous)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+# --- Focused benchmarks ------------------------------------------------------
+
+async def bench_maileroo_session(args):
+    """Sequential send_email calls against the Maileroo stub, over the shared session and over a new one per send"""
+    import main
+
+    iterations = args.iterations or 500
+    stub = MailerooStub(args.latency)
+    runner, port = await start_site(stub.app())
+    main.maileroo_api_url = f"http://127.0.0.1:{port}/api/v2/emails"
+    main.email_configured = True
+    results = {}
+    try:
+        for mode in ("new session per send", "pooled session"):
+            timings = []
+            for i in range(iterations):
+                started = time.perf_counter()
+                assert await main.send_email(f"bench {i}", "hello")
+                timings.append(time.perf_counter() - started)
+                if mode == "new session per send":
+                    await main.close_http_session()  # What send_email did before: a new connector and connection each time
+            results[mode] = percentiles(timings)
+    finally:
+        await main.close_http_session()
+        await runner.cleanup()
+    for mode, stats in results.items():
+        print(f"{mode:22} mean {stats['mean']:6.2f} ms  p50 {stats['p50']:6.2f}  p99 {stats['p99']:6.2f}")
+
+def time_per_call(func, iterations):
+    """Mean seconds per call of func()"""
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - started) / iterations
+
+async def bench_channels(args):
+    """Subject -> channel lookups in one guild of --channels channels, for the last channel (the scan's worst case)"""
+    from types import SimpleNamespace
+    import discord
+    import main
+
+    iterations = args.iterations or 2000
+    count = args.channels or 5000
+    guild = SimpleNamespace(id=1)
+    channels = [SimpleNamespace(id=STUB_CHANNEL_BASE + i, name=f"channel-{i}", guild=guild) for i in range(count)]
+    main.guild_routes, main.channel_routes = main.parse_routes([{"guild": 1}])
+    for channel in channels:
+        main.route_channel(channel)
+    last = channels[-1]
+    legacy_subject = f"Re: [Discord] #{last.name} - someone"
+    subject = "Re: " + main.outbound_subject(last.id, last.name, "someone")
+
+    def linear_scan():
+        # What find_channel_from_subject did before the index: parse, then scan guild.text_channels
+        match = re.search(r'\[Discord\]\s*#(\S+)', re.sub(r'^(Re|RE):\s*', '', legacy_subject))
+        return discord.utils.get(channels, name=match.group(1))
+
+    assert linear_scan() is last and main.find_channel_from_subject(legacy_subject) is last
+    results = {
+        "linear scan (before)": linear_scan,
+        "name index": lambda: main.find_channel_from_subject(legacy_subject),
+        "channel ID in subject": lambda: main.find_channel_from_subject(subject),
+        "cached miss": lambda: main.find_channel_from_subject("Re: [Discord] #no-such-channel - someone"),
+    }
+    print(f"{count} channels, {iterations} lookups each")
+    for name, lookup in results.items():
+        print(f"{name:22} {time_per_call(lookup, iterations) * 1e6:8.2f} us/lookup")
+
+def old_split(full_message):
+    """The bot fallback's splitter before split_message (chunks could still pass 2000 characters)"""
+    chunks = []
+    current_chunk = ""
+    for line in full_message.split('\n'):
+        if len(current_chunk) + len(line) + 1 <= 1900:
+            current_chunk += line + '\n'
+        else:
+            if current_chunk:
+                chunks.append(current_chunk.strip())
+            current_chunk = line + '\n'
+    if current_chunk:
+        chunks.append(current_chunk.strip())
+    return chunks
+
+def long_email_body(size=50_000):
+    """Prose, code blocks and a few very long lines, like a forwarded newsletter or log dump"""
+    parts = []
+    i = 0
+    while sum(map(len, parts)) < size:
+        parts.append(f"Paragraph {i}: " + "Plain prose that wraps onto a fairly long line of text. " * 4 + "\n")
+        if i % 5 == 0:
+            parts.append("```python\n" + "".join(f"result_{j} = compute({j}, retries=3)\n" for j in range(40)) + "```\n")
+        if i % 17 == 0:
+            parts.append("x" * 4500 + "\n")
+        i += 1
+    return "".join(parts)[:size]
+
+async def bench_split(args):
+    """Split one 50 KB body both ways, then deliver it to --channels channels one email at a time and side by side"""
+    from types import SimpleNamespace
+    import main
+
+    iterations = args.iterations or 200
+    channels = args.channels or 3
+    latency = args.latency or 0.05
+    body = long_email_body()
+    for name, split in (("old loop", old_split), ("split_message", main.split_message)):
+        chunks = split(body)
+        print(f"{name:14} {time_per_call(lambda: split(body), iterations) * 1e6:7.0f} us  {len(chunks)} chunks, "
+              f"longest {max(map(len, chunks))} chars, {sum(chunk.count('```') % 2 for chunk in chunks)} with an unclosed code block")
+
+    posts = {}
+
+    class FakeWebhook:
+        def __init__(self, channel_id):
+            self.id = channel_id
+            self.channel_id = channel_id
+
+        async def send(self, content=None, **kwargs):
+            await asyncio.sleep(latency)  # Discord's round trip
+            posts.setdefault(self.channel_id, []).append(content)
+
+    async def fake_webhook(channel):
+        return FakeWebhook(channel.id)
+
+    main.email_to_discord_configured = True
+    main.get_or_create_sophia_webhook = fake_webhook
+    expected = main.split_message(body + "\n\n> sent from my email")
+    print(f"{channels} channel(s), {len(expected)} chunks each, {latency * 1000:.0f} ms per post, DISCORD_WEBHOOK_RATE="
+          f"{main.discord_webhook_rate}/s (burst {main.discord_webhook_burst}), DISCORD_GLOBAL_RATE={main.discord_global_rate}/s:")
+    for mode, base in (("one email at a time", 1000), ("channels side by side", 2000)):
+        deliveries = [main.send_email_to_discord("a@example.com", "subject", body, target=(SimpleNamespace(id=base + i, name=f"c{i}"), None, None))
+                      for i in range(channels)]
+        started = time.perf_counter()
+        if mode == "one email at a time":
+            for delivery in deliveries:
+                await delivery
+        else:
+            await asyncio.gather(*deliveries)
+        elapsed = time.perf_counter() - started
+        in_order = all(posts[base + i] == expected for i in range(channels))
+        print(f"{mode:22} {elapsed:6.1f} s  {channels * len(expected) / elapsed:5.1f} posts/s  "
+              f"{'chunks in order' if in_order else 'CHUNKS OUT OF ORDER'}")
+
+async def bench_web_modes(args):
+    """The same inbound load against one gunicorn worker per server mode: webhook response latency and throughput"""
+    iterations = args.iterations or 2000
+    load_argv = ["-n", str(iterations), "-r", "0", "-c", "16", "--workers", "1", "--channels", str(args.channels or 10)]
+    results = {}
+    for mode in ("flask", "async"):
+        results[mode] = await run_load(load_parser().parse_args(load_argv + ["--mode", mode]))
+        if results[mode] is None:
+            return
+    for mode, result in results.items():
+        block = result["inbound"]
+        stats = block["response_ms"]
+        print(f"{mode:6} {block['offered_rps']:7} req/s   response p50 {stats['p50']} ms  p99 {stats['p99']} ms   "
+              f"{block['errors']} error(s)")
+
+def time_webhook_requests(iterations):
+    """Mean seconds per /email-webhook request in this process, with the Discord hand-off stubbed out"""
+    import main
+
+    main.email_to_discord_configured = True
+    main.bot_ready.set()
+    main.schedule_discord_send = lambda email_kwargs: None
+    client = main.app.test_client()
+    payloads = [build_payload("general", message_id=f"bench-{i}@example.com") for i in range(iterations + 100)]
+    for payload in payloads[:100]:  # Warm-up
+        client.post("/email-webhook", json=payload)
+    started = time.perf_counter()
+    for payload in payloads[100:]:
+        assert client.post("/email-webhook", json=payload).status_code == 200
+    return (time.perf_counter() - started) / iterations
+
+async def bench_logging(args):
+    """Webhook requests in a fresh process per LOG_LEVEL (read at import), log output to /dev/null"""
+    iterations = args.iterations or 5000
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = f"import sys, test_webhook, main; print(test_webhook.time_webhook_requests({iterations}), main.NonBlockingQueueHandler.dropped, file=sys.stderr)"
+    for level in ("WARNING", "INFO", "DEBUG"):
+        proc = subprocess.run([sys.executable, "-c", code], cwd=here, env={**os.environ, "LOG_LEVEL": level},
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+        seconds, dropped = proc.stderr.split()[-2:]
+        print(f"LOG_LEVEL={level:8} {float(seconds) * 1e6:7.1f} us/request   {dropped} record(s) dropped")
+
+async def bench_snipes(args):
+    """-n deletions spread over --channels channels through on_message_delete, measured with tracemalloc"""
+    import tracemalloc
+    from types import SimpleNamespace
+    import main
+
+    iterations = args.iterations or 60000
+    channels = args.channels or 10000
+    content = "A deleted message of a typical length, long enough to be worth sniping. " * 3
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    started = time.perf_counter()
+    for i in range(iterations):
+        # Built per deletion so the store is the only thing keeping a message's content alive
+        await main.on_message_delete(SimpleNamespace(channel=SimpleNamespace(id=STUB_CHANNEL_BASE + i % channels),
+                                                     content=content[:200] + str(i), author=f"user{i % 500}#0001"))
+    elapsed = time.perf_counter() - started
+    retained = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(before, "filename"))
+    tracemalloc.stop()
+    print(f"{iterations} deletions over {channels} channels: {main.client.snipe_count} snipes kept in "
+          f"{len(main.client.snipes)} channels (SNIPE_MAX_ENTRIES={main.snipe_max_entries})")
+    print(f"retained {retained / 2 ** 20:.1f} MiB ({retained / max(main.client.snipe_count, 1):.0f} bytes/snipe), "
+          f"{elapsed / iterations * 1e6:.1f} us/deletion (under tracemalloc)")
+
+async def bench_html(args):
+    """Convert one large generated marketing email (a style block and a long table of linked rows) to text"""
+    import main
+
+    iterations = args.iterations or 5
+    row = '<tr><td style="padding:4px"><p>Deal number %d &mdash; <a href="https://shop.example.com/item/%d?utm=x">Buy now</a></p></td></tr>\n'
+    newsletter = ("<html><head><style>" + "td{}" * 5000 + "</style></head><body><table>"
+                  + "".join(row % (i, i) for i in range(20000)) + "</table></body></html>")
+    converters = {
+        "old regex": lambda: re.sub('<[^<]+?>', '', newsletter),  # What email_webhook did before html_to_text
+        f"html_to_text (HTML_BODY_MAX_CHARS={main.html_body_max_chars})": lambda: main.html_to_text(newsletter),
+        "html_to_text (uncapped)": lambda: main.html_to_text(newsletter, max_chars=len(newsletter)),
+    }
+    print(f"{len(newsletter) / 2 ** 20:.1f} MiB of HTML, mean of {iterations} run(s):")
+    for name, convert in converters.items():
+        chars = len(convert())
+        print(f"{name:42} {time_per_call(convert, iterations) * 1000:8.1f} ms  {chars} chars out")
+
+async def bench_startup(args):
+    """Best-of-n import times in fresh interpreters, then median time from spawning main.py to a 200 from /livez"""
+    iterations = args.iterations or 5
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    for statement in ("pass", "import discord", "import flask", "import aiohttp.web", "import main"):
+        timings = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, "-c", statement], cwd=repo_dir, capture_output=True, check=True)
+            timings.append(time.perf_counter() - started)
+        print(f"{statement:18} {min(timings) * 1000:7.1f} ms")
+    commands = {
+        "python main.py": [sys.executable, os.path.join(repo_dir, "main.py")],
+        "gunicorn, 1 worker": [sys.executable, "-m", "gunicorn", "-c", os.path.join(repo_dir, "gunicorn.conf.py"),
+                               "--chdir", repo_dir, "main:app"],
+    }
+    async with aiohttp.ClientSession() as session:
+        for name, command in commands.items():
+            timings = []
+            for _ in range(iterations):
+                port = free_port()
+                with tempfile.TemporaryDirectory() as workdir:
+                    env = dict(os.environ, token="", PORT=str(port), WEB_CONCURRENCY="1", OUTBOX_PATH=os.path.join(workdir, "outbox.db"))
+                    started = time.perf_counter()
+                    proc = subprocess.Popen(command, env=env, cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                    try:
+                        while proc.poll() is None:
+                            try:
+                                async with session.get(f"http://127.0.0.1:{port}/livez") as response:
+                                    if response.status == 200:
+                                        timings.append(time.perf_counter() - started)
+                                        break
+                            except aiohttp.ClientError:
+                                await asyncio.sleep(0.002)
+                    finally:
+                        stop_app([proc])
+            if len(timings) < iterations:
+                print(f"{name:18} exited before /livez answered")
+            else:
+                print(f"{name:18} {percentiles(timings)['p50']:7.1f} ms to the first /livez (median)")
+
+BENCHMARKS = {
+    "maileroo-session": bench_maileroo_session,
+    "channels": bench_channels,
+    "split": bench_split,
+    "web-modes": bench_web_modes,
+    "logging": bench_logging,
+    "snipes": bench_snipes,
+    "html": bench_html,
+    "startup": bench_startup,
+}
+
+def bench_main(argv):
+    parser = argparse.ArgumentParser(prog="test_webhook.py bench", description="Focused benchmarks of single code paths")
+    parser.add_argument("name", choices=BENCHMARKS, help="Benchmark to run")
+    parser.add_argument("-n", "--iterations", type=int, help="Iterations (each benchmark has its own default)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the stubs wait before answering")
+    parser.add_argument("--channels", type=int, help="Discord channels to simulate (each benchmark has its own default)")
+    args = parser.parse_args(argv)
+    os.environ.setdefault("LOG_LEVEL", "ERROR")  # Read when main.py is imported; keeps the output to the results
+    asyncio.run(BENCHMARKS[args.name](args))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "load":
+        load_main(sys.argv[2:])
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        bench_main(sys.argv[2:])
+        sys.exit(0)
+
+    # Get channel name from command line or use default
+    channel = sys.argv[1] if len(sys.argv) > 1 else "test"
+
+    print("=" * 60)
+    print("Email Webhook Test Script")
+    print("=" * 60)
+    print()
+    print("This script simulates a Maileroo webhook for testing.")
+    print()
+
+    test_email(channel)
+
+    print()
+    print("=" * 60)
+    if len(sys.argv) == 1:
+        print("Usage: python test_webhook.py [channel-name]")
+        print("       python test_webhook.py load [--help]")
+        print("       python test_webhook.py bench <name> [--help]")
+        print("Example: python test_webhook.py general")
+        print("=" * 60)